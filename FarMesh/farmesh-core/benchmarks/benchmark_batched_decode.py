@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Measures decoding steps of several sessions with the same prefix length through a span of blocks, as run by the
+merged inference pool: one session at a time vs. batched into one step (see BatchingTaskPool). The batched step
+includes copying the sessions' caches into one layer_past, so this shows whether batching pays for that copy.
+Runs the runtime's code directly, without networking; works on CPU.
+"""
+
+import argparse
+import asyncio
+import contextlib
+from itertools import chain
+from time import perf_counter
+
+import numpy as np
+import torch
+from hivemind import BatchTensorDescriptor
+from hivemind.utils.logging import get_logger
+from hivemind.utils.nested import nested_pack
+
+from farmesh import AutoDistributedConfig
+from farmesh.constants import DTYPE_MAP
+from farmesh.data_structures import InferenceMetadata
+from farmesh.server.backend import TransformerBackend, merge_inference_pools_inplace
+from farmesh.server.from_pretrained import load_pretrained_block
+from farmesh.server.memory_cache import MemoryCache
+from farmesh.utils.convert_block import QuantType, convert_block
+from farmesh.utils.misc import DUMMY_INT64
+
+logger = get_logger()
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--model", type=str, required=True, help="Model")
+    parser.add_argument("--num_blocks", type=int, default=8, help="Number of consecutive blocks to run")
+    parser.add_argument("--device", type=str, default="cpu", help="Device")
+    parser.add_argument("--torch_dtype", type=str, default="float32", help="Torch dtype")
+    parser.add_argument("--num_sessions", type=int, default=8, help="Number of sessions decoding at the same time")
+    parser.add_argument("--batch_size", type=int, default=1, help="Batch size of each session")
+    parser.add_argument("--prefix_length", type=int, default=128, help="Number of tokens in cache before decoding")
+    parser.add_argument("--cache_page_tokens", type=int, default=None, help="Use paged caches with this page size")
+    parser.add_argument("--n_steps", type=int, default=50, help="Number of benchmark steps")
+    parser.add_argument("--warmup_steps", type=int, default=5, help="Number of warmup steps")
+    args = parser.parse_args()
+
+    asyncio.run(benchmark_batched_decode(args))
+
+
+async def benchmark_batched_decode(args):
+    device, dtype = torch.device(args.device), DTYPE_MAP[args.torch_dtype]
+    config = AutoDistributedConfig.from_pretrained(args.model)
+    memory_cache = MemoryCache(max_size_bytes=None, page_tokens=args.cache_page_tokens)
+
+    backends = {}
+    for block_index in range(args.num_blocks):
+        block = load_pretrained_block(args.model, block_index, config=config, torch_dtype=dtype)
+        block = convert_block(block, block_index, config, [device], device, QuantType.NONE, freeze=True)
+        schema = (BatchTensorDescriptor(1, 2048, config.hidden_size, dtype=dtype),)
+        uid = f"benchmark.{block_index}"
+        backends[uid] = TransformerBackend(
+            uid,
+            block,
+            config=config,
+            memory_cache=memory_cache,
+            backend_dtype=dtype,
+            max_chunk_size_bytes=256 * 1024 * 1024,
+            args_schema=schema,
+            kwargs_schema={},
+            outputs_schema=schema,
+            min_batch_size=1,
+            max_batch_size=8192,
+        )
+    merge_inference_pools_inplace(backends)
+    merged_step = next(iter(backends.values())).inference_pool.process_func
+
+    max_length = args.prefix_length + 2 * (args.warmup_steps + args.n_steps)
+    if args.cache_page_tokens is not None:
+        descriptors = [backend.get_inference_token_descriptors(args.batch_size) for backend in backends.values()]
+    else:
+        descriptors = [
+            backend.get_inference_cache_descriptors(args.batch_size, max_length) for backend in backends.values()
+        ]
+    async with contextlib.AsyncExitStack() as stack:
+        sessions = []
+        memory_cache.runtime_pid += 1  # allocate_cache is meant for connection handlers, pretend to be one
+        for _ in range(args.num_sessions):
+            handles = await stack.enter_async_context(
+                memory_cache.allocate_cache(*chain(*descriptors), timeout=float("inf"))
+            )
+            sessions.append(nested_pack(handles, descriptors))
+        memory_cache.runtime_pid -= 1
+
+        def make_args(cache_handles, prefix_length: int):
+            hidden_states = torch.randn(args.batch_size, 1, config.hidden_size, dtype=dtype, device=device)
+            infos = tuple(
+                InferenceMetadata(uid, prefix_length, tuple(block_handles), "")
+                for uid, block_handles in zip(backends, cache_handles)
+            )
+            return (hidden_states, DUMMY_INT64, infos, *[None] * len(infos))
+
+        with torch.inference_mode():
+            prompt_shape = (args.batch_size, args.prefix_length, config.hidden_size)
+            for cache_handles in sessions:
+                prompt = torch.randn(*prompt_shape, dtype=dtype, device=device)
+                for (uid, backend), block_handles in zip(backends.items(), cache_handles):
+                    inference_info = InferenceMetadata(uid, 0, tuple(block_handles), "")
+                    (prompt,) = backend.inference_step(prompt, DUMMY_INT64, inference_info)
+
+            prefix_length = args.prefix_length
+            for batched in [False, True]:
+                step_times = []
+                for step in range(args.warmup_steps + args.n_steps):
+                    tasks_args = [make_args(cache_handles, prefix_length) for cache_handles in sessions]
+                    start_time = perf_counter()
+                    if batched:
+                        merged_step.split_outputs(merged_step(*merged_step.merge_args(tasks_args)), tasks_args)
+                    else:
+                        for task_args in tasks_args:
+                            merged_step(*task_args)
+                    if step >= args.warmup_steps:
+                        step_times.append(perf_counter() - start_time)
+                    prefix_length += 1
+                mean_time = np.mean(step_times)
+                logger.info(
+                    f"{'Batched' if batched else 'One session at a time'}: {mean_time * 1000:.2f} ms per step of "
+                    f"{args.num_sessions} sessions, {args.num_sessions * args.batch_size / mean_time:.1f} tokens/sec"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Measures a decoding step through a span of blocks hosted by one server, as run by the merged inference pool:
+block by block (a full inference_step per block) vs. fused (see _MergedInferenceStep._fused_decode_step).
+Runs the runtime's code directly, without networking; works on CPU.
+"""
+
+import argparse
+import asyncio
+from itertools import chain
+from time import perf_counter
+
+import numpy as np
+import torch
+from hivemind import BatchTensorDescriptor
+from hivemind.utils.logging import get_logger
+from hivemind.utils.nested import nested_pack
+
+from farmesh import AutoDistributedConfig
+from farmesh.constants import DTYPE_MAP
+from farmesh.data_structures import InferenceMetadata
+from farmesh.server.backend import TransformerBackend, merge_inference_pools_inplace
+from farmesh.server.from_pretrained import load_pretrained_block
+from farmesh.server.memory_cache import MemoryCache
+from farmesh.utils.convert_block import QuantType, convert_block
+from farmesh.utils.misc import DUMMY_INT64
+
+logger = get_logger()
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--model", type=str, required=True, help="Model")
+    parser.add_argument("--num_blocks", type=int, default=8, help="Number of consecutive blocks to run")
+    parser.add_argument("--device", type=str, default="cpu", help="Device")
+    parser.add_argument("--torch_dtype", type=str, default="float32", help="Torch dtype")
+    parser.add_argument("--batch_size", type=int, default=1, help="Batch size")
+    parser.add_argument("--prefix_length", type=int, default=128, help="Number of tokens in cache before decoding")
+    parser.add_argument("--n_steps", type=int, default=100, help="Number of benchmark steps")
+    parser.add_argument("--warmup_steps", type=int, default=10, help="Number of warmup steps")
+    args = parser.parse_args()
+
+    asyncio.run(benchmark_decode_step(args))
+
+
+async def benchmark_decode_step(args):
+    device, dtype = torch.device(args.device), DTYPE_MAP[args.torch_dtype]
+    config = AutoDistributedConfig.from_pretrained(args.model)
+    memory_cache = MemoryCache(max_size_bytes=None)
+
+    backends = {}
+    for block_index in range(args.num_blocks):
+        block = load_pretrained_block(args.model, block_index, config=config, torch_dtype=dtype)
+        block = convert_block(block, block_index, config, [device], device, QuantType.NONE, freeze=True)
+        schema = (BatchTensorDescriptor(1, 2048, config.hidden_size, dtype=dtype),)
+        uid = f"benchmark.{block_index}"
+        backends[uid] = TransformerBackend(
+            uid,
+            block,
+            config=config,
+            memory_cache=memory_cache,
+            backend_dtype=dtype,
+            max_chunk_size_bytes=256 * 1024 * 1024,
+            args_schema=schema,
+            kwargs_schema={},
+            outputs_schema=schema,
+            min_batch_size=1,
+            max_batch_size=8192,
+        )
+    merge_inference_pools_inplace(backends)
+    merged_step = next(iter(backends.values())).inference_pool.process_func
+
+    max_length = args.prefix_length + 2 * (args.warmup_steps + args.n_steps)
+    descriptors = [
+        backend.get_inference_cache_descriptors(args.batch_size, max_length) for backend in backends.values()
+    ]
+    memory_cache.runtime_pid += 1  # allocate_cache is meant for connection handlers, pretend to be one
+    async with memory_cache.allocate_cache(*chain(*descriptors), timeout=float("inf")) as handles:
+        memory_cache.runtime_pid -= 1
+        cache_handles = nested_pack(handles, descriptors)
+
+        def make_infos(prefix_length: int):
+            return tuple(
+                InferenceMetadata(uid, prefix_length, tuple(block_handles), "")
+                for uid, block_handles in zip(backends, cache_handles)
+            )
+
+        with torch.inference_mode():
+            prompt = torch.randn(args.batch_size, args.prefix_length, config.hidden_size, dtype=dtype, device=device)
+            for backend, inference_info in zip(backends.values(), make_infos(0)):
+                (prompt,) = backend.inference_step(prompt, DUMMY_INT64, inference_info)
+
+            prefix_length = args.prefix_length
+            for fuse in [False, True]:
+                merged_step.fuse_decode_steps = fuse
+                step_times = []
+                for step in range(args.warmup_steps + args.n_steps):
+                    hidden_states = torch.randn(args.batch_size, 1, config.hidden_size, dtype=dtype, device=device)
+                    infos = make_infos(prefix_length)
+                    start_time = perf_counter()
+                    merged_step(hidden_states, DUMMY_INT64, infos, *[None] * len(infos))
+                    if step >= args.warmup_steps:
+                        step_times.append(perf_counter() - start_time)
+                    prefix_length += 1
+                mean_time = np.mean(step_times)
+                logger.info(
+                    f"{'Fused' if fuse else 'Block by block'}: {mean_time * 1000:.2f} ms per step, "
+                    f"{mean_time / args.num_blocks * 1e6:.1f} us per block"
+                )
+
+
+if __name__ == "__main__":
+    main()
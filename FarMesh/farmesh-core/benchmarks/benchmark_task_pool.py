@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""Measures the round trip of a tiny task through PrioritizedTaskPool: connection handler -> runtime -> handler"""
+
+import argparse
+import multiprocessing as mp
+from time import perf_counter
+
+import numpy as np
+import torch
+from hivemind.moe.server.runtime import Runtime
+from hivemind.utils.logging import get_logger
+
+from farmesh.constants import DTYPE_MAP
+from farmesh.server.task_pool import PrioritizedTaskPool
+from farmesh.server.task_transport import SLAB_SLOT_TOKENS, SharedTensorSlab
+from farmesh.utils.misc import get_size_in_bytes
+
+logger = get_logger()
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--hidden_size", type=int, default=8192, help="Hidden size of the activations")
+    parser.add_argument("--torch_dtype", type=str, default="bfloat16", help="Torch dtype")
+    parser.add_argument("--batch_size", type=int, default=1, help="Batch size (a decoding step has 1 token per row)")
+    parser.add_argument("--n_steps", type=int, default=1000, help="Number of benchmark steps")
+    parser.add_argument("--warmup_steps", type=int, default=100, help="Number of warmup steps")
+    args = parser.parse_args()
+
+    dtype = DTYPE_MAP[args.torch_dtype]
+    slot_bytes = SLAB_SLOT_TOKENS * args.hidden_size * get_size_in_bytes(dtype)
+    for slab in [None, SharedTensorSlab(num_slots=16, slot_bytes=slot_bytes)]:
+        step_time = benchmark_pool(args, dtype, slab)
+        logger.info(f"{'Shared slab' if slab is not None else 'Pickled tensors'}: {step_time * 1e6:.1f} us per step")
+
+
+def benchmark_pool(args, dtype: torch.dtype, slab) -> float:
+    pool = PrioritizedTaskPool(_identity, name="benchmark", max_batch_size=2**20, slab=slab)
+    runtime = Runtime({"0": _DummyBackend(pool)}, prefetch_batches=0)
+    runtime.ready = runtime_ready = mp.Event()
+    result_recv, result_send = mp.Pipe(duplex=False)
+
+    proc = mp.context.ForkProcess(target=_submit_steps, args=(args, dtype, pool, runtime_ready, result_send))
+    proc.start()
+    runtime.start()
+    step_time = result_recv.recv()
+    proc.join()
+    runtime.shutdown()
+    return step_time
+
+
+def _submit_steps(args, dtype: torch.dtype, pool: PrioritizedTaskPool, runtime_ready, result_pipe):
+    runtime_ready.wait()
+    hidden_states = torch.randn(args.batch_size, 1, args.hidden_size, dtype=dtype)
+    hypo_ids = torch.arange(args.batch_size)
+    step_times = []
+    for step in range(args.warmup_steps + args.n_steps):
+        start_time = perf_counter()
+        (outputs,) = pool.submit_task(hidden_states, hypo_ids).result()
+        if step >= args.warmup_steps:
+            step_times.append(perf_counter() - start_time)
+    assert torch.equal(outputs, hidden_states)
+    result_pipe.send(np.mean(step_times))
+
+
+def _identity(hidden_states: torch.Tensor, hypo_ids: torch.Tensor):
+    return (hidden_states,)
+
+
+class _DummyBackend:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def get_pools(self):
+        return [self.pool]
+
+
+if __name__ == "__main__":
+    main()
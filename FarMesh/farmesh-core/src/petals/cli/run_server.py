@@ -81,6 +81,29 @@ def main():
     parser.add_argument('--attn_cache_tokens', type=int, default=None,
                         help='The number of past attention key/value pairs that will be stored between inference steps. '
                              'Default: 16384 for models with multi-query attention (based on Llama 2, Falcon), 4096 for others')
+    parser.add_argument('--cache_page_tokens', type=int, default=None,
+                        help='If specified, store attention caches in pages of this many tokens that sessions take as '
+                             'they grow, instead of reserving inference_max_length tokens per session up front')
+    parser.add_argument('--cache_share_prefixes', action='store_true',
+                        help='Let inference sessions whose inputs start the same way (e.g., a common system prompt) '
+                             'share attention cache pages and skip recomputing that prefix. Requires --cache_page_tokens. '
+                             'This trades cache capacity for prefill compute: every session is still charged for all '
+                             'of its pages, shared or not, and 25%% of the cache budget is set aside for the block '
+                             'outputs of shared prefixes, so fewer sessions fit at once')
+    parser.add_argument('--cache_offload_idle_seconds', type=float, default=None,
+                        help='If specified, move attention caches of inference sessions idle for this many seconds '
+                             'out of the cache to host RAM (GPU servers) or to spill files (CPU servers) until their '
+                             'next step. Requires --cache_offload_host_size and/or --cache_offload_disk_size')
+    parser.add_argument('--cache_offload_host_size', type=str, default="0",
+                        help='Maximal host RAM used for offloaded attention caches. Example: 16GiB')
+    parser.add_argument('--cache_offload_disk_size', type=str, default="0",
+                        help='Maximal disk space used for offloaded attention caches. Example: 100GiB')
+    parser.add_argument('--cache_offload_dir', type=str, default=None,
+                        help='Directory for attention cache spill files. Default: a directory in the system temp dir')
+
+    parser.add_argument('--task_slab_size', type=str, default="64MiB",
+                        help='Shared memory for passing small activations (e.g. of decoding steps) between connection '
+                             'handlers and the runtime without per-step shared memory allocations. 0 disables it')
 
     parser.add_argument('--cache_dir', type=str, default=None,
                         help='Path to a directory in which a downloaded pretrained model configuration should be cached if the standard cache should not be used.')
@@ -134,7 +157,18 @@ def main():
                         help='On *nix, increase the max number of files a server can open '
                              'before hitting "Too many open files" (set to zero to keep the system limit)')
     parser.add_argument('--stats_report_interval', type=int, required=False,
-                        help='Interval between two reports of batch processing performance statistics')
+                        help='Interval between two reports of batch processing performance statistics '
+                             'and of how long tasks waited in each pool')
+    parser.add_argument('--prefill_chunk_tokens', type=int, default=512,
+                        help='Split inference steps with more tokens (e.g. long prompts) into chunks of this many '
+                             'tokens processed as separate tasks, so that other sessions can decode in between. '
+                             'Set to 0 to process every step in one go. Note: single-token steps of different '
+                             'sessions run as one batch only if the sessions are at exactly the same prefix length '
+                             '(there is no padding), so with typical traffic they are rarely combined')
+    parser.add_argument('--priority_seconds_per_point', type=float, default=0.0,
+                        help='Process requests earlier by this many seconds per point their client pays. '
+                             'Tasks are ordered by deadline: decoding steps are due at once, prefills in 0.1 s, '
+                             'forward/backward passes in 1 s. Default: points do not affect the order')
 
     parser.add_argument('--custom_module_path', type=str, required=False,
                         help='Path of a file with custom nn.modules, wrapped into special decorator')
@@ -203,6 +237,11 @@ def main():
         max_disk_space, (int, type(None))
     ), "Unrecognized value for --max_disk_space. Correct examples: 1.5GB or 1500MB or 1572864000 (bytes)"
 
+    for name in ("cache_offload_host_size", "cache_offload_disk_size", "task_slab_size"):
+        size = parse_size(args.pop(name))
+        assert isinstance(size, int), f"Unrecognized value for --{name}. Correct examples: 1.5GB or 1500MB or 0"
+        args[name.replace("_size", "_bytes")] = size
+
     if args.pop("new_swarm"):
         args["initial_peers"] = []
 
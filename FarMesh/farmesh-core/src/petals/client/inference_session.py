@@ -4,12 +4,12 @@ import asyncio
 import itertools
 import time
 import uuid
-from typing import AsyncIterator, List, Optional, Tuple
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
 
 import torch
 from hivemind import MSGPackSerializer, anext, deserialize_torch_tensor, get_logger, serialize_torch_tensor
 from hivemind.moe.client.remote_expert_worker import RemoteExpertWorker
-from hivemind.p2p import P2P
+from hivemind.p2p import P2P, PeerID
 from hivemind.proto import runtime_pb2
 from hivemind.utils.tensor_descr import BatchTensorDescriptor
 
@@ -222,12 +222,24 @@ class InferenceSession:
     An interface to a multi-step *inference* session for a sequence of remote transformer blocks
     """
 
-    def __init__(self, sequence_manager: RemoteSequenceManager, max_length: int):
+    def __init__(
+        self,
+        sequence_manager: RemoteSequenceManager,
+        max_length: int,
+        *,
+        on_server_step: Optional[Callable[[Optional[PeerID], float, Optional[Exception]], None]] = None,
+    ):
+        """
+        :param on_server_step: optional callback invoked after each attempt to run a step on a server,
+          with (peer_id, elapsed seconds, exception or None); peer_id is None if no server could be chosen
+        """
         self._sequence_manager = sequence_manager
+        self._on_server_step = on_server_step
         self._closed = False
         self._server_sessions = []
         self._position = 0
         self._max_length = max_length
+        self._contributions: Dict[PeerID, int] = {}
         self.output_ids = None
         self.past_key_values = None
 
@@ -325,12 +337,14 @@ class InferenceSession:
             for attempt_no in itertools.count():
                 logger.debug(f"Inference: block {block_idx}, attempt {attempt_no}")
                 server_session = None
+                step_started = time.perf_counter()
                 try:
                     if not self._server_sessions or attempt_no >= 1:
                         self._update_sequence(server_idx, block_idx, attempt_no)
 
                     server_session = self._server_sessions[server_idx]
                     assert server_session.position == self.position, f"{server_session.position} and {self.position}"
+                    step_started = time.perf_counter()
                     inputs = server_session.step(
                         inputs,
                         prompts[server_session.span.start : server_session.span.end],
@@ -341,11 +355,24 @@ class InferenceSession:
                     server_idx += 1
                     block_idx = server_session.span.end
                     self._sequence_manager.on_request_success(server_session.span.peer_id)
+
+                    peer_id = server_session.span.peer_id
+                    self._contributions[peer_id] = (
+                        self._contributions.get(peer_id, 0) + server_session.num_blocks * n_input_tokens
+                    )
+                    if self._on_server_step is not None:
+                        self._on_server_step(peer_id, time.perf_counter() - step_started, None)
                     break
                 except Exception as e:
                     self._sequence_manager.on_request_failure(
                         server_session.span.peer_id if server_session is not None else None
                     )
+                    if self._on_server_step is not None:
+                        self._on_server_step(
+                            server_session.span.peer_id if server_session is not None else None,
+                            time.perf_counter() - step_started,
+                            e,
+                        )
                     if attempt_no + 1 == self._sequence_manager.config.max_retries:
                         raise
                     delay = self._sequence_manager.get_retry_delay(attempt_no)
@@ -361,6 +388,14 @@ class InferenceSession:
         outputs = outputs.to(device=inputs_device, dtype=inputs_dtype)
         return outputs
 
+    def contributions(self) -> Dict[str, int]:
+        """
+        Work done by each server in this session, as the number of (block, token) pairs it processed.
+        Only successful steps are counted, so servers that replaced failed ones are attributed exactly.
+        """
+        # list() copies the items atomically, so this is safe to call from other threads mid-step
+        return {peer_id.to_base58(): count for peer_id, count in list(self._contributions.items())}
+
     def _update_sequence(self, server_idx: int, block_idx: int, attempt_no: int) -> int:
         # If there is a failed server session, this code closes it
         self._exit_server_sessions(self._server_sessions[server_idx : server_idx + 1])
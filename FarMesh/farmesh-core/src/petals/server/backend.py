@@ -1,8 +1,9 @@
 from __future__ import annotations
 
+import dataclasses
 from collections import Counter
 from itertools import chain
-from typing import Any, Dict, Optional, Sequence, Tuple, Union
+from typing import Any, Dict, Hashable, List, Optional, Sequence, Tuple, Union
 
 import torch
 from hivemind import BatchTensorDescriptor, TensorDescriptor
@@ -14,8 +15,10 @@ from tensor_parallel.tensor_parallel import PerDeviceTensors
 from transformers import PretrainedConfig
 
 from farmesh.data_structures import InferenceMetadata
-from farmesh.server.memory_cache import MemoryCache
-from farmesh.server.task_pool import PrioritizedTaskPool
+from farmesh.server.memory_cache import PREFIX_OUTPUTS_MAX_SIZE_FRACTION, MemoryCache
+from farmesh.server.paged_cache import PagedCacheTensor, PagePool, PrefixHashes
+from farmesh.server.task_pool import BatchingTaskPool, PrioritizedTaskPool
+from farmesh.server.task_transport import SharedTensorSlab
 from farmesh.utils.misc import get_size_in_bytes, is_dummy
 
 logger = get_logger(__name__)
@@ -33,6 +36,7 @@ class TransformerBackend(ModuleBackend):
         memory_cache: MemoryCache,
         backend_dtype: torch.dtype,
         max_chunk_size_bytes: int,
+        task_slab: Optional[SharedTensorSlab] = None,
         **kwargs,
     ):
         import farmesh.utils.peft as _peft_module
@@ -52,15 +56,12 @@ class TransformerBackend(ModuleBackend):
 
         max_batch_size = self.forward_pool.max_batch_size
         device = self.module.devices[self.module.output_device_index]
+        pool_kwargs = dict(max_batch_size=max_batch_size, device=device, slab=task_slab)
         self.inference_pool = PrioritizedTaskPool(
-            self.inference_step, max_batch_size=max_batch_size, device=device, name=f"{self.name}_inference"
+            self.inference_step, name=f"{self.name}_inference", **pool_kwargs
         )  # note: inference_pools may be merged later, see merge_inference_pools_inplace
-        self.forward_pool = PrioritizedTaskPool(
-            self.forward, max_batch_size=max_batch_size, device=device, name=f"{self.name}_forward"
-        )
-        self.backward_pool = PrioritizedTaskPool(
-            self.backward, max_batch_size=max_batch_size, device=device, name=f"{self.name}_backward"
-        )
+        self.forward_pool = PrioritizedTaskPool(self.forward, name=f"{self.name}_forward", **pool_kwargs)
+        self.backward_pool = PrioritizedTaskPool(self.backward, name=f"{self.name}_backward", **pool_kwargs)
 
         self.dtype = backend_dtype
         self.dtype_bytes = get_size_in_bytes(self.dtype)
@@ -84,20 +85,36 @@ class TransformerBackend(ModuleBackend):
         self.cache_bytes_per_token: Dict[torch.device, int] = Counter()
         for descr in self.get_inference_cache_descriptors(batch_size=1, max_length=1):
             self.cache_bytes_per_token[descr.device] += descr.numel() * get_size_in_bytes(descr.dtype)
+        self.num_cache_tensors = 2 * len(self.module.devices)  # cache handles per session: keys and values per shard
 
     def get_inference_cache_descriptors(self, batch_size: int, max_length: int) -> Sequence[TensorDescriptor]:
         """Create tensor descriptors for attention cache tensors used during inference_step"""
         head_dim = self.config.hidden_size // self.config.num_attention_heads
         cache_tensors = []
-        for device, num_heads in zip(self.module.devices, self.shard_num_heads):
-            num_heads //= self.config.num_key_value_groups
-            if hasattr(self.config, "num_key_value_heads"):
-                num_heads = self.config.num_key_value_heads
+        for device, num_heads in zip(self.module.devices, self._get_shard_num_kv_heads()):
             keys = TensorDescriptor((batch_size, num_heads, head_dim, max_length), dtype=self.dtype, device=device)
             values = TensorDescriptor((batch_size, num_heads, max_length, head_dim), dtype=self.dtype, device=device)
             cache_tensors.extend((keys, values))
         return cache_tensors
 
+    def get_inference_token_descriptors(self, batch_size: int) -> Sequence[TensorDescriptor]:
+        """Create per-token descriptors [batch, num_kv_heads, head_dim] for paged cache tensors (see paged_cache.py)"""
+        head_dim = self.config.hidden_size // self.config.num_attention_heads
+        cache_tensors = []
+        for device, num_heads in zip(self.module.devices, self._get_shard_num_kv_heads()):
+            token_descr = TensorDescriptor((batch_size, num_heads, head_dim), dtype=self.dtype, device=device)
+            cache_tensors.extend((token_descr, token_descr))  # keys, values
+        return cache_tensors
+
+    def _get_shard_num_kv_heads(self) -> Sequence[int]:
+        shard_num_kv_heads = []
+        for num_heads in self.shard_num_heads:
+            num_heads //= self.config.num_key_value_groups
+            if hasattr(self.config, "num_key_value_heads"):
+                num_heads = self.config.num_key_value_heads
+            shard_num_kv_heads.append(num_heads)
+        return shard_num_kv_heads
+
     def forward(self, *inputs: Union[torch.Tensor, str]) -> Tuple[torch.Tensor, ...]:
         *inputs, active_adapter = inputs
         with self._peft_module.using_adapter(active_adapter):
@@ -121,7 +138,24 @@ class TransformerBackend(ModuleBackend):
         with self.memory_cache.use_cache(
             *inference_info.cache_handles
         ) as cache_tensors, self._peft_module.using_adapter(inference_info.active_adapter):
-            self._reorder_cache_inplace(cache_tensors, hypo_ids)
+            if len(cache_tensors) > self.num_cache_tensors:
+                return self._decode_step(hidden_states, hypo_ids, cache_tensors, inference_info.prefix_length)
+            for cache_tensor in cache_tensors:
+                if isinstance(cache_tensor, PagedCacheTensor):
+                    cache_tensor.ensure_capacity(inference_info.prefix_length + seq_len)
+            self._reorder_cache_inplace(cache_tensors, hypo_ids, inference_info.prefix_length)
+
+            # With prefix sharing, reuse pages (and block outputs) that other sessions computed for the same inputs
+            completed_pages = self._hash_prefix_pages(cache_tensors, hidden_states, inference_info)
+            reused_outputs = self._reuse_prefix_pages(cache_tensors, completed_pages, hidden_states, inference_info)
+            if reused_outputs is not None:
+                num_reused = reused_outputs.shape[1]
+                if num_reused == seq_len:
+                    return (reused_outputs,)
+                hidden_states, seq_len = hidden_states[:, num_reused:], seq_len - num_reused
+                inference_info = dataclasses.replace(
+                    inference_info, prefix_length=inference_info.prefix_length + num_reused
+                )
 
             # We chunk the inputs so that peak memory for long sequences fits into `autograd_memory`
             # reserved in `Server._choose_num_blocks()`. This saves us from OOMs if `max_chunk_size_bytes`
@@ -141,8 +175,65 @@ class TransformerBackend(ModuleBackend):
                 layer_past = new_kvs
 
             self._update_cache_inplace(cache_tensors, new_kvs, inference_info.prefix_length)
+            self._publish_prefix_pages(cache_tensors, completed_pages, output_hidden_states, inference_info)
+            if reused_outputs is not None:
+                output_hidden_states = torch.cat([reused_outputs, output_hidden_states], dim=1)
+            return (output_hidden_states,)
+
+    def _decode_step(
+        self,
+        hidden_states: torch.Tensor,
+        hypo_ids: torch.LongTensor,
+        cache_tensors: Sequence[Union[torch.Tensor, PagedCacheTensor]],
+        prefix_length: int,
+    ) -> Tuple[torch.Tensor, ...]:
+        """
+        Run a short step for one or more sessions at once (see BatchingTaskPool), on cache tensors already taken
+        from memory_cache and with the adapter already set (see _MergedInferenceStep). The sessions' caches follow
+        one another in cache_tensors, their rows in hidden_states and hypo_ids. All have the same prefix_length.
+        Unlike inference_step, this does not split the inputs into chunks or share prefixes.
+        """
+        seq_len = hidden_states.shape[1]
+        sessions = [
+            cache_tensors[i : i + self.num_cache_tensors] for i in range(0, len(cache_tensors), self.num_cache_tensors)
+        ]
+        batch_sizes = [_get_cache_batch_size(session[0]) for session in sessions]
+        assert sum(batch_sizes) == hidden_states.shape[0], "batch size does not match the sessions' caches"
+        offsets = [sum(batch_sizes[:i]) for i in range(len(sessions))]
+
+        for session, offset, batch_size in zip(sessions, offsets, batch_sizes):
+            for cache_tensor in session:
+                if isinstance(cache_tensor, PagedCacheTensor):
+                    cache_tensor.ensure_capacity(prefix_length + seq_len)
+                    cache_tensor.prefix_hashes = None  # decoding steps are past the shareable prefix
+            if not is_dummy(hypo_ids):
+                self._reorder_cache_inplace(session, hypo_ids[offset : offset + batch_size] - offset, prefix_length)
+
+        if len(sessions) == 1:
+            layer_past = self._gather_layer_past(cache_tensors, prefix_length)
+        elif isinstance(cache_tensors[0], PagedCacheTensor):
+            # read all sessions' pages at once instead of gathering each session and concatenating the copies
+            combined_tensors = [PagedCacheTensor.concat(tensors) for tensors in zip(*sessions)]
+            layer_past = self._gather_layer_past(combined_tensors, prefix_length)
+        else:
+            layer_pasts = [self._gather_layer_past(session, prefix_length) for session in sessions]
+            layer_past = tuple(torch.cat(tensors, dim=0) for tensors in zip(*layer_pasts))
+        output_hidden_states, new_kvs = self.module.forward(
+            hidden_states, layer_past=self._wrap_layer_past(layer_past), use_cache=True
+        )
+        if len(sessions) == 1:
+            self._update_cache_inplace(cache_tensors, new_kvs, prefix_length)
             return (output_hidden_states,)
 
+        total_batch_size = hidden_states.shape[0]
+        for session, offset, batch_size in zip(sessions, offsets, batch_sizes):
+            session_kvs = []
+            for new_kv in new_kvs:  # [total_batch_size * num_kv_heads, ...]
+                num_kv_heads = new_kv.shape[0] // total_batch_size
+                session_kvs.append(new_kv[offset * num_kv_heads : (offset + batch_size) * num_kv_heads])
+            self._update_cache_inplace(session, session_kvs, prefix_length)
+        return (output_hidden_states,)
+
     def _estimate_max_chunk_length(self, hidden_states: torch.Tensor, inference_info: InferenceMetadata) -> int:
         # We assume that attention logit matrices are the main thing that consumes memory, given that
         # the model uses multi-query attention
@@ -151,21 +242,45 @@ class TransformerBackend(ModuleBackend):
         attn_bytes_per_token = max(self.shard_num_heads) * batch_size * self.dtype_bytes * worst_case_length
         return max(1, self.max_chunk_size_bytes // attn_bytes_per_token)
 
-    def _reorder_cache_inplace(self, cache_tensors: torch.Tensor, hypo_ids: torch.Tensor):
+    def _reorder_cache_inplace(self, cache_tensors: torch.Tensor, hypo_ids: torch.Tensor, prefix_length: int):
         """If hypo_ids is specified, reorder elements of each cache tensor in-place by taking indices from hypo_ids"""
-        if not is_dummy(hypo_ids):
-            for cache_tensor in cache_tensors:
-                cache_tensor[...] = cache_tensor[hypo_ids.to(cache_tensor.device)]  # in-place reorder cache by hypo ids
+        if is_dummy(hypo_ids):
+            return
+        changed_rows = torch.nonzero(hypo_ids != torch.arange(len(hypo_ids), device=hypo_ids.device)).flatten()
+        if len(changed_rows) == 0:
+            return  # every beam continues itself
+        source_rows = hypo_ids[changed_rows]
+        for i, cache_tensor in enumerate(cache_tensors):
+            if isinstance(cache_tensor, PagedCacheTensor):
+                cache_tensor.reorder(hypo_ids)  # permutes page tables, copies nothing until rows diverge
+                if cache_tensor.prefix_hashes is not None:
+                    cache_tensor.prefix_hashes.reorder(hypo_ids)
+                continue
+            # copy only the rows that take another row's history, and only their first prefix_length tokens
+            # keys: [batch, num_kv_heads, head_dim, max_length], values: [batch, num_kv_heads, max_length, head_dim]
+            valid_cache = cache_tensor[..., :prefix_length] if i % 2 == 0 else cache_tensor[:, :, :prefix_length]
+            rows, sources = changed_rows.to(cache_tensor.device), source_rows.to(cache_tensor.device)
+            valid_cache.index_copy_(0, rows, valid_cache.index_select(0, sources))  # gathers before overwriting
 
     def _select_layer_past(self, cache_tensors: Sequence[torch.Tensor], prefix_length: int) -> Sequence[torch.Tensor]:
         """Extract first {prefix_length} tokens and reshape them such that they can be used as layer_past"""
+        return self._wrap_layer_past(self._gather_layer_past(cache_tensors, prefix_length))
+
+    def _gather_layer_past(self, cache_tensors: Sequence[torch.Tensor], prefix_length: int) -> Tuple[torch.Tensor, ...]:
         key_cache, value_cache = list(cache_tensors[0::2]), list(cache_tensors[1::2])
         for i in range(len(key_cache)):
+            if isinstance(key_cache[i], PagedCacheTensor):
+                # paged tensors store [batch, kv_length, num_kv_heads, head_dim], blocks expect contiguous layer_past
+                key_cache[i] = key_cache[i].gather(prefix_length).permute(0, 2, 3, 1).flatten(0, 1)
+                value_cache[i] = value_cache[i].gather(prefix_length).transpose(1, 2).flatten(0, 1)
+                continue
             key_cache[i] = key_cache[i].flatten(0, 1)[:, :, :prefix_length]
             # shape: [batch * num_kv_heads, head_dim, kv_length]
             value_cache[i] = value_cache[i].flatten(0, 1)[:, :prefix_length]
             # shape: [batch * num_kv_heads, kv_length, head_dim]
-        layer_past = tuple(chain(*zip(key_cache, value_cache)))
+        return tuple(chain(*zip(key_cache, value_cache)))
+
+    def _wrap_layer_past(self, layer_past: Tuple[torch.Tensor, ...]) -> Sequence[torch.Tensor]:
         return PerDeviceTensors(*layer_past) if len(self.module.module_shards) > 1 else layer_past
 
     def _update_cache_inplace(
@@ -173,6 +288,16 @@ class TransformerBackend(ModuleBackend):
     ):
         """Writes new key/value tensors back into cache, works in-place"""
         _batch_size_times_num_kv_heads, head_dim, new_length = new_kvs[0].shape
+        if isinstance(cache_tensors[0], PagedCacheTensor):
+            for cache_key, cache_value, new_key, new_value in zip(
+                cache_tensors[0::2], cache_tensors[1::2], new_kvs[0::2], new_kvs[1::2]
+            ):
+                batch_size, num_kv_heads = cache_key.batch_size, cache_key.pool.token_shape[0]
+                new_key = new_key.view(batch_size, num_kv_heads, head_dim, new_length)[..., prefix_length:]
+                cache_key.write(new_key.permute(0, 3, 1, 2), start=prefix_length)
+                new_value = new_value.view(batch_size, num_kv_heads, new_length, head_dim)[:, :, prefix_length:]
+                cache_value.write(new_value.transpose(1, 2), start=prefix_length)
+            return
         for cache_key, new_key in zip(cache_tensors[0::2], new_kvs[0::2]):
             new_key = new_key.view(*cache_key.shape[:3], new_length)
             cache_key[:, :, :, prefix_length:new_length] = new_key[:, :, :, prefix_length:new_length]
@@ -180,6 +305,84 @@ class TransformerBackend(ModuleBackend):
             new_value = new_value.view(*cache_value.shape[:2], new_length, head_dim)
             cache_value[:, :, prefix_length:new_length, :] = new_value[:, :, prefix_length:new_length, :]
 
+    def _hash_prefix_pages(
+        self, cache_tensors: Sequence[PagedCacheTensor], hidden_states: torch.Tensor, inference_info: InferenceMetadata
+    ) -> List[Tuple[int, List[bytes]]]:
+        """Hash the inputs of a session's prefill, return the pages they complete (see PrefixHashes.update)"""
+        if not self.memory_cache.share_prefixes:
+            return []
+        if inference_info.prefix_length == 0:
+            salt = f"{inference_info.uid} {inference_info.active_adapter}".encode()
+            cache_tensors[0].prefix_hashes = PrefixHashes(
+                cache_tensors[0].batch_size, self.memory_cache.page_tokens, salt=salt
+            )
+        prefix_hashes = cache_tensors[0].prefix_hashes
+        if prefix_hashes is None or prefix_hashes.num_tokens != inference_info.prefix_length:
+            return []  # the session has rewound (start_from_position) or is past its prefill
+        if hidden_states.shape[1] == 1:
+            cache_tensors[0].prefix_hashes = None  # decoding: stop hashing, the rest of the session is not shared
+            return []
+        return prefix_hashes.update(hidden_states)
+
+    def _get_prefix_outputs_pool(self, hidden_states: torch.Tensor) -> PagePool:
+        return self.memory_cache.paged_store.get_pool(
+            hidden_states.shape[2:],
+            hidden_states.dtype,
+            hidden_states.device,
+            max_size_fraction=PREFIX_OUTPUTS_MAX_SIZE_FRACTION,
+        )
+
+    def _reuse_prefix_pages(
+        self,
+        cache_tensors: Sequence[PagedCacheTensor],
+        completed_pages: List[Tuple[int, List[bytes]]],
+        hidden_states: torch.Tensor,
+        inference_info: InferenceMetadata,
+    ) -> Optional[torch.Tensor]:
+        """
+        Share the published pages for as many of this step's pages as possible (for all rows, from the first one),
+        return the block outputs for their tokens or None if nothing was reused
+        """
+        if not completed_pages or inference_info.prefix_length % self.memory_cache.page_tokens != 0:
+            return None
+        outputs_pool = self._get_prefix_outputs_pool(hidden_states)
+        reused_outputs = []
+        for page_index, digests in completed_pages:
+            output_pages = [outputs_pool.find(("outputs", digest)) for digest in digests]
+            cache_pages = [[t.pool.find((i, digest)) for digest in digests] for i, t in enumerate(cache_tensors)]
+            if None in output_pages or any(None in pages for pages in cache_pages):
+                break
+            for cache_tensor, pages in zip(cache_tensors, cache_pages):
+                for row_index, page in enumerate(pages):
+                    cache_tensor.share_page(row_index, page_index, page)
+            output_pages = [outputs_pool.page(page) for page in output_pages]
+            reused_outputs.append(torch.stack(output_pages))  # [batch_size, page_tokens, hid_size]
+        return torch.cat(reused_outputs, dim=1) if reused_outputs else None
+
+    def _publish_prefix_pages(
+        self,
+        cache_tensors: Sequence[PagedCacheTensor],
+        completed_pages: List[Tuple[int, List[bytes]]],
+        output_hidden_states: torch.Tensor,
+        inference_info: InferenceMetadata,
+    ):
+        """Publish the pages this step computed in full, along with the block outputs for their tokens"""
+        page_tokens = self.memory_cache.page_tokens
+        outputs_pool = None
+        for page_index, digests in completed_pages:
+            offset = page_index * page_tokens - inference_info.prefix_length
+            if offset < 0:
+                continue  # reused, or started before this step (its outputs are not available)
+            outputs_pool = outputs_pool or self._get_prefix_outputs_pool(output_hidden_states)
+            for row_index, digest in enumerate(digests):
+                if outputs_pool.find(("outputs", digest)) is None:
+                    (output_page,) = outputs_pool.allocate(1)
+                    outputs_pool.page(output_page)[:] = output_hidden_states[row_index, offset : offset + page_tokens]
+                    outputs_pool.publish(("outputs", digest), output_page)
+                    outputs_pool.release([output_page])  # no session holds it, it is cached until evicted
+                for i, cache_tensor in enumerate(cache_tensors):
+                    cache_tensor.pool.publish((i, digest), cache_tensor.page_table[row_index][page_index])
+
     def get_pools(self) -> Sequence[PrioritizedTaskPool]:
         return self.forward_pool, self.backward_pool, self.inference_pool
 
@@ -199,13 +402,22 @@ class TransformerBackend(ModuleBackend):
 
 
 def merge_inference_pools_inplace(backends: Dict[ExpertUID, TransformerBackend]):
-    """Replace each backend's rpc_inference pools with a combined pool runs multiple blocks in one call"""
+    """
+    Replace each backend's rpc_inference pools with a combined pool runs multiple blocks in one call.
+    The combined pool also batches single-token steps of different sessions, but only those at exactly the same
+    prefix length (see _MergedInferenceStep.get_batch_key): sessions are not padded to a common length
+    """
     assert len(backends) != 0 and all(isinstance(b, TransformerBackend) for b in backends.values())
     first_pool = next(iter(backends.values())).inference_pool
-    merged_pool = PrioritizedTaskPool(
-        _MergedInferenceStep(backends),
+    merged_step = _MergedInferenceStep(backends)
+    merged_pool = BatchingTaskPool(
+        merged_step,
+        batch_key=merged_step.get_batch_key,
+        merge_args=merged_step.merge_args,
+        split_outputs=merged_step.split_outputs,
         max_batch_size=first_pool.max_batch_size,
         device=first_pool.device,
+        slab=first_pool.slab,
         name=f"merged_inference",
     )
     for backend in backends.values():
@@ -216,6 +428,7 @@ def merge_inference_pools_inplace(backends: Dict[ExpertUID, TransformerBackend])
 class _MergedInferenceStep:
     def __init__(self, backends: Dict[ExpertUID, TransformerBackend]):
         self.backends = backends
+        self.fuse_decode_steps = True  # see _fused_decode_step; benchmark_decode_step.py compares both paths
 
     @torch.inference_mode()
     def __call__(
@@ -228,8 +441,80 @@ class _MergedInferenceStep:
         assert len(inference_infos) == len(
             optional_prompts
         ), f"found {len(inference_infos)} blocks but {len(optional_prompts)} prompts"
+        is_decode_step = self.get_batch_key(hidden_states, hypo_ids, inference_infos, *optional_prompts) is not None
+        if self.fuse_decode_steps and is_decode_step:
+            return self._fused_decode_step(hidden_states, hypo_ids, inference_infos)
         for inference_info, optional_prompt in zip(inference_infos, optional_prompts):
             if optional_prompt is not None:
                 hidden_states[:, : optional_prompt.shape[1]] += optional_prompt
             (hidden_states,) = self.backends[inference_info.uid].inference_step(hidden_states, hypo_ids, inference_info)
         return (hidden_states,)
+
+    def _fused_decode_step(
+        self, hidden_states: torch.Tensor, hypo_ids: torch.LongTensor, inference_infos: Sequence[InferenceMetadata]
+    ) -> Tuple[torch.Tensor, ...]:
+        """
+        Run a single-token step through all requested blocks back to back: take the caches of all blocks from
+        memory_cache and set the adapter once, then run each block's _decode_step on its slice of the caches
+        """
+        backends = [self.backends[inference_info.uid] for inference_info in inference_infos]
+        memory_cache = backends[0].memory_cache
+        assert all(backend.memory_cache is memory_cache for backend in backends), "blocks must share memory_cache"
+        all_handles = tuple(chain.from_iterable(inference_info.cache_handles for inference_info in inference_infos))
+        with memory_cache.use_cache(*all_handles) as all_cache_tensors, backends[0]._peft_module.using_adapter(
+            inference_infos[0].active_adapter
+        ):
+            offset = 0
+            for backend, inference_info in zip(backends, inference_infos):
+                cache_tensors = all_cache_tensors[offset : offset + len(inference_info.cache_handles)]
+                offset += len(cache_tensors)
+                (hidden_states,) = backend._decode_step(
+                    hidden_states, hypo_ids, cache_tensors, inference_info.prefix_length
+                )
+        return (hidden_states,)
+
+    @staticmethod
+    def get_batch_key(
+        hidden_states: torch.Tensor,
+        hypo_ids: torch.LongTensor,
+        inference_infos: Sequence[InferenceMetadata],
+        *optional_prompts: Optional[torch.Tensor],
+    ) -> Optional[Hashable]:
+        """
+        Steps with equal keys can run as one batch: single-token steps without prompts through the same blocks,
+        adapter and prefix length. Blocks derive positions from the length of layer_past, so sessions with
+        different prefix lengths cannot share a forward pass without padding.
+        """
+        if hidden_states.shape[1] != 1 or any(prompt is not None for prompt in optional_prompts):
+            return None
+        return tuple((info.uid, info.prefix_length, info.active_adapter) for info in inference_infos)
+
+    @staticmethod
+    def merge_args(tasks_args: Sequence[Sequence[Any]]) -> Tuple[Any, ...]:
+        """Combine the arguments of steps with equal batch keys into arguments of one step"""
+        hidden_states = torch.cat([args[0] for args in tasks_args], dim=0)
+        hypo_ids = tasks_args[0][1]
+        if not all(is_dummy(args[1]) for args in tasks_args):
+            hypo_ids, offset = [], 0
+            for task_hidden_states, task_hypo_ids, *_ in tasks_args:
+                batch_size = task_hidden_states.shape[0]
+                if is_dummy(task_hypo_ids):
+                    task_hypo_ids = torch.arange(batch_size, device=task_hidden_states.device)
+                hypo_ids.append(task_hypo_ids.to(task_hidden_states.device) + offset)
+                offset += batch_size
+            hypo_ids = torch.cat(hypo_ids)
+        inference_infos = tuple(
+            dataclasses.replace(block_infos[0], cache_handles=tuple(chain(*(i.cache_handles for i in block_infos))))
+            for block_infos in zip(*(args[2] for args in tasks_args))
+        )
+        return (hidden_states, hypo_ids, inference_infos, *tasks_args[0][3:])
+
+    @staticmethod
+    def split_outputs(outputs: Sequence[torch.Tensor], tasks_args: Sequence[Sequence[Any]]) -> List[Tuple[Any, ...]]:
+        (hidden_states,) = outputs
+        batch_sizes = [args[0].shape[0] for args in tasks_args]
+        return [(task_hidden_states,) for task_hidden_states in hidden_states.split(batch_sizes)]
+
+
+def _get_cache_batch_size(cache_tensor: Union[torch.Tensor, PagedCacheTensor]) -> int:
+    return cache_tensor.batch_size if isinstance(cache_tensor, PagedCacheTensor) else cache_tensor.shape[0]
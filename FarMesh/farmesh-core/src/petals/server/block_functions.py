@@ -17,7 +17,7 @@ from farmesh.server.backend import TransformerBackend
 from farmesh.server.task_pool import PrioritizedTaskPool
 from farmesh.server.task_prioritizer import TaskPrioritizerBase
 from farmesh.utils.convert_block import QuantType
-from farmesh.utils.misc import DUMMY, is_dummy
+from farmesh.utils.misc import DUMMY, DUMMY_INT64, is_dummy
 from farmesh.utils.packaging import unpack_args_kwargs
 
 # We prioritize short inference requests and make them use a *merged* inference pool,
@@ -153,8 +153,19 @@ async def iterate_rpc_inference(
     points: int,
     quant_type: QuantType,
     args_structure: Any = None,
+    alloc_timeout: Optional[float] = None,
+    prefill_chunk_tokens: Optional[int] = None,
 ) -> AsyncIterator[Tuple[Sequence[runtime_pb2.Tensor], bool, Dict]]:
+    """
+    Run inference steps for one session, yield the outputs of each step
+
+    :param prefill_chunk_tokens: if specified, steps with more tokens (over all sequences) are submitted to the task
+      pools as several chunks, so that the runtime can run other sessions' steps in between (e.g. decoding steps
+      can go between the chunks of a long prompt)
+    """
     assert len(cache_handles) == len(requested_backends)
+    memory_cache = requested_backends[0].memory_cache
+    flat_cache_handles = tuple(nested_flatten(cache_handles))
 
     prefix_length = 0
     point_per_piece = points / max_length if max_length > 0 else 0.0
@@ -195,35 +206,51 @@ async def iterate_rpc_inference(
                 f"Maximum length exceeded: prefix {prefix_length} + current {length_increment}"
                 f" exceeds pre-allocated maximum {max_length}"
             )
+        # bring back the cache if it was offloaded while idle; in paged mode, account for the pages this step needs
+        await memory_cache.restore(flat_cache_handles)
+        await memory_cache.reserve_tokens(flat_cache_handles, prefix_length + length_increment, timeout=alloc_timeout)
 
         merge_max_tokens = MAX_NF4_SHORT_INFERENCE_TOKENS if quant_type == QuantType.NF4 else MAX_SHORT_INFERENCE_TOKENS
-        can_merge_pools = batch_size * length_increment <= merge_max_tokens
-        priority = prioritizer.prioritize(
-            hidden_states,
-            hypo_ids,
-            points=point_per_piece,
-            requested_uids=requested_uids,
-            type="inference",
-        )
 
         # A client may pass a tensor with 0 tokens. This is a special case that occurs, e.g.
         # when user wants to pre-allocate cache or check that server *can* allocate that cache.
         if hidden_states.numel() > 0:
             assert hidden_states.ndim == 3, f"hidden states must be a single 3d tensor"
-            if can_merge_pools:
-                inference_infos = tuple(
-                    InferenceMetadata(uid, prefix_length, tuple(handles), active_adapter)
-                    for uid, handles in zip(requested_uids, cache_handles)
-                )
-                (hidden_states,) = await requested_backends[0].inference_pool.submit_task(
-                    hidden_states, hypo_ids, inference_infos, *prompts, priority=priority
+            # Deep prompts are added to the first positions of each step, so steps with prompts are not chunked
+            chunk_length = length_increment
+            if prefill_chunk_tokens is not None and not has_prompts:
+                chunk_length = _get_prefill_chunk_length(prefill_chunk_tokens, batch_size, memory_cache.page_tokens)
+            output_chunks = []
+            for offset in range(0, length_increment, chunk_length):
+                hidden_states_chunk = hidden_states[:, offset : offset + chunk_length]
+                chunk_hypo_ids = hypo_ids if offset == 0 else DUMMY_INT64  # reorder the cache once per step
+                priority = prioritizer.prioritize(
+                    hidden_states_chunk,
+                    chunk_hypo_ids,
+                    points=point_per_piece * hidden_states_chunk.shape[1] / length_increment,
+                    requested_uids=requested_uids,
+                    type="inference",
                 )
-            else:
-                for backend, uid, handles, prompt in zip(requested_backends, requested_uids, cache_handles, prompts):
-                    inference_infos = (InferenceMetadata(uid, prefix_length, tuple(handles), active_adapter),)
-                    (hidden_states,) = await backend.inference_pool.submit_task(
-                        hidden_states, hypo_ids, inference_infos, prompt, priority=priority
+                if batch_size * hidden_states_chunk.shape[1] <= merge_max_tokens:
+                    inference_infos = tuple(
+                        InferenceMetadata(uid, prefix_length + offset, tuple(handles), active_adapter)
+                        for uid, handles in zip(requested_uids, cache_handles)
+                    )
+                    (hidden_states_chunk,) = await requested_backends[0].inference_pool.submit_task(
+                        hidden_states_chunk, chunk_hypo_ids, inference_infos, *prompts, priority=priority
                     )
+                else:
+                    for backend, uid, handles, prompt in zip(
+                        requested_backends, requested_uids, cache_handles, prompts
+                    ):
+                        inference_infos = (
+                            InferenceMetadata(uid, prefix_length + offset, tuple(handles), active_adapter),
+                        )
+                        (hidden_states_chunk,) = await backend.inference_pool.submit_task(
+                            hidden_states_chunk, chunk_hypo_ids, inference_infos, prompt, priority=priority
+                        )
+                output_chunks.append(hidden_states_chunk)
+            hidden_states = output_chunks[0] if len(output_chunks) == 1 else torch.cat(output_chunks, dim=1)
 
         # serialize and send last layer outputs
         output_tensors = [
@@ -235,3 +262,13 @@ async def iterate_rpc_inference(
 
         # prepare for next step
         prefix_length += length_increment
+        memory_cache.schedule_offload(flat_cache_handles)  # offload the cache if the client goes idle
+
+
+def _get_prefill_chunk_length(prefill_chunk_tokens: int, batch_size: int, page_tokens: Optional[int]) -> int:
+    """Tokens per sequence in one chunk of a long inference step"""
+    chunk_length = max(prefill_chunk_tokens // batch_size, 1)
+    if page_tokens is not None:
+        # Chunks of whole pages keep prefix sharing working: pages are published and reused within one task
+        chunk_length = max(chunk_length // page_tokens, 1) * page_tokens
+    return chunk_length
@@ -0,0 +1,87 @@
+"""
+Lower tiers for the attention caches of idle inference sessions: host RAM (for caches on GPU) and memory-mapped
+spill files (for caches on CPU, or when host RAM is full). MemoryCache decides what to move and keeps per-tier
+accounting in connection handlers; this module moves the tensors themselves and runs in the runtime process.
+"""
+import os
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Sequence, Tuple
+
+import torch
+from hivemind.utils import get_logger
+
+from farmesh.data_structures import Handle
+from farmesh.utils.misc import get_size_in_bytes
+
+logger = get_logger(__name__)
+
+HOST, DISK = "host", "disk"
+
+
+def get_offload_tiers(devices: Sequence[torch.device]) -> Tuple[str, ...]:
+    """Tiers a cache on these devices may be moved to, in order of preference"""
+    if any(torch.device(device).type != "cpu" for device in devices):
+        return HOST, DISK
+    return (DISK,)  # moving a cpu cache to host RAM would not free anything
+
+
+@dataclass
+class OffloadState:
+    """Where one allocation's tensors live (tracked by the connection handler that made it)"""
+
+    size_bytes: int
+    tiers: Tuple[str, ...]  # tiers it may be moved to, in order of preference
+    tier: Optional[str] = None  # None means it is on its devices
+    timer: Optional[object] = field(default=None, repr=False)  # asyncio.TimerHandle of a scheduled offload
+
+
+class CacheOffloader:
+    """Moves cache tensors between their devices and the lower tiers, used by MemoryCache in the runtime process"""
+
+    def __init__(self, offload_dir: str):
+        self.offload_dir = offload_dir
+        self._origins: Dict[Handle, Tuple[torch.device, Optional[str]]] = {}  # handle -> (device, spill file path)
+
+    def is_offloaded(self, handle: Handle) -> bool:
+        return handle in self._origins
+
+    def offload(self, handle: Handle, tensor: torch.Tensor, tier: str) -> torch.Tensor:
+        """Return a copy of tensor in the given tier; the caller should drop its reference to the original"""
+        assert not self.is_offloaded(handle), f"handle {handle} is already offloaded"
+        path = None
+        if tier == HOST:
+            offloaded = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=torch.cuda.is_available())
+        elif tier == DISK:
+            os.makedirs(self.offload_dir, exist_ok=True)
+            path = os.path.join(self.offload_dir, f"cache_{os.getpid()}_{handle}.bin")
+            with open(path, "wb") as file:
+                file.truncate(tensor.numel() * get_size_in_bytes(tensor.dtype))
+            offloaded = torch.from_file(path, shared=True, size=tensor.numel(), dtype=tensor.dtype)
+            offloaded = offloaded.view(tensor.shape)
+        else:
+            raise ValueError(f"Unknown offload tier: {tier}")
+        offloaded.copy_(tensor)
+        self._origins[handle] = (tensor.device, path)
+        return offloaded
+
+    def restore(self, handle: Handle, offloaded: torch.Tensor) -> torch.Tensor:
+        """Copy an offloaded tensor back to its device"""
+        device, path = self._origins.pop(handle)
+        tensor = torch.empty(offloaded.shape, dtype=offloaded.dtype, device=device)
+        tensor.copy_(offloaded, non_blocking=path is None)
+        del offloaded
+        self._remove(path)
+        return tensor
+
+    def discard(self, handle: Handle):
+        """Forget a tensor that was deleted while offloaded"""
+        _device, path = self._origins.pop(handle)
+        self._remove(path)
+
+    @staticmethod
+    def _remove(path: Optional[str]):
+        if path is not None:
+            try:
+                os.remove(path)  # the mapping (if still referenced) stays valid until it is released
+            except OSError as e:
+                logger.warning(f"Failed to remove cache spill file {path}: {e}")
@@ -32,7 +32,7 @@ import farmesh
 from farmesh.data_structures import CHAIN_DELIMITER, UID_DELIMITER, Handle, ModuleUID
 from farmesh.server.backend import TransformerBackend
 from farmesh.server.block_functions import iterate_rpc_inference, run_rpc_backward, run_rpc_forward
-from farmesh.server.task_prioritizer import DummyTaskPrioritizer, TaskPrioritizerBase
+from farmesh.server.task_prioritizer import TaskPrioritizer, TaskPrioritizerBase
 from farmesh.utils.convert_block import QuantType
 
 logger = get_logger(__name__)
@@ -70,7 +70,8 @@ class TransformerConnectionHandler(ConnectionHandler):
         request_timeout: float,
         session_timeout: float,
         step_timeout: float,
-        task_prioritizer: TaskPrioritizerBase = DummyTaskPrioritizer(),
+        task_prioritizer: TaskPrioritizerBase = TaskPrioritizer(),
+        prefill_chunk_tokens: Optional[int] = None,
         quant_type: QuantType,
     ):
         super().__init__(dht, module_backends)
@@ -89,6 +90,7 @@ class TransformerConnectionHandler(ConnectionHandler):
         self.request_timeout = request_timeout
         self.session_timeout, self.step_timeout = session_timeout, step_timeout
         self._prioritizer = task_prioritizer
+        self.prefill_chunk_tokens = prefill_chunk_tokens
         self.quant_type = quant_type
 
     async def add_p2p_handlers(self, *args, **kwargs) -> None:
@@ -184,6 +186,8 @@ class TransformerConnectionHandler(ConnectionHandler):
                         points=points,
                         quant_type=self.quant_type,
                         args_structure=args_structure,
+                        alloc_timeout=alloc_timeout,
+                        prefill_chunk_tokens=self.prefill_chunk_tokens,
                     ):
                         if can_push:
                             task = asyncio.create_task(self._push_outputs(request, output_tensors[0], step_metadata))
@@ -542,7 +546,10 @@ class TransformerConnectionHandler(ConnectionHandler):
         Allocate memory cache for all transformer blocks, return cache handle
         :returns: a list of {len(backends)} elements, where i-th element is a tuple of cache handles for i-th backend
         """
-        descriptors = [backend.get_inference_cache_descriptors(batch_size, max_length) for backend in backends]
+        if backends[0].memory_cache.page_tokens:
+            descriptors = [backend.get_inference_token_descriptors(batch_size) for backend in backends]
+        else:
+            descriptors = [backend.get_inference_cache_descriptors(batch_size, max_length) for backend in backends]
         async with backends[0].memory_cache.allocate_cache(*chain(*descriptors), timeout=timeout) as handles:
             yield nested_pack(handles, descriptors)
 
@@ -579,7 +586,9 @@ class TransformerConnectionHandler(ConnectionHandler):
         result = {
             "version": farmesh.__version__,
             "dht_client_mode": self.dht.client_mode,
-            CACHE_TOKENS_AVAILABLE: backend.memory_cache.bytes_left // max(backend.cache_bytes_per_token.values()),
+            CACHE_TOKENS_AVAILABLE: (
+                backend.memory_cache.effective_bytes_left // max(backend.cache_bytes_per_token.values())
+            ),
         }
 
         if request.uid:
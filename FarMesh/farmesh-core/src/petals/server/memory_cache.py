@@ -9,32 +9,91 @@ import contextlib
 import ctypes
 import multiprocessing as mp
 import os
+import tempfile
+import threading
 import time
-from typing import AsyncContextManager, Dict, Optional, Sequence
+from dataclasses import dataclass
+from typing import AsyncContextManager, Dict, Optional, Sequence, Tuple, Union
 
 import async_timeout
 import torch
 from hivemind.utils import TensorDescriptor, enter_asynchronously, get_logger
 
 from farmesh.data_structures import Handle
+from farmesh.server.cache_offload import DISK, HOST, CacheOffloader, OffloadState, get_offload_tiers
+from farmesh.server.paged_cache import PagedCacheStore, PagedCacheTensor
 from farmesh.utils.asyncio import shield_and_wait
 from farmesh.utils.misc import get_size_in_bytes
 
 logger = get_logger(__name__)
 
+# Block outputs of shared prefixes are kept next to their pages (so later sessions can skip their prefill), in pools
+# outside of the pages accounted by MemoryCache: this fraction of the cache budget is set aside for them
+PREFIX_OUTPUTS_MAX_SIZE_FRACTION = 0.25
+
+
+@dataclass
+class PageReservation:
+    """Pages accounted for one allocation in paged mode (tracked by the connection handler that made it)"""
+
+    page_bytes: int  # bytes of one page in every cache tensor of the allocation (max over devices)
+    num_pages: int
+
+    @property
+    def size_bytes(self) -> int:
+        return self.page_bytes * self.num_pages
+
 
 class MemoryCache:
     """A shared cache for storing tensors that persist across calls. Main use case: storing past attention KVs"""
 
-    def __init__(self, max_size_bytes: Optional[int], max_alloc_timeout: Optional[float] = None):
-        self.max_size_bytes = max_size_bytes if max_size_bytes is not None else (2**64 - 1)
+    def __init__(
+        self,
+        max_size_bytes: Optional[int],
+        max_alloc_timeout: Optional[float] = None,
+        page_tokens: Optional[int] = None,
+        share_prefixes: bool = False,
+        offload_idle_seconds: Optional[float] = None,
+        offload_host_bytes: int = 0,
+        offload_disk_bytes: int = 0,
+        offload_dir: Optional[str] = None,
+    ):
+        """
+        :param max_size_bytes: maximum total size of all allocated tensors, None means unlimited
+        :param max_alloc_timeout: cap on how long an allocation may wait for free memory
+        :param page_tokens: if specified, store caches in pages of this many tokens (see paged_cache.py) that are
+          accounted and allocated as sessions grow (reserve_tokens), instead of reserving max_length up front
+        :param share_prefixes: in paged mode, let sessions whose inputs start the same way share the pages (and skip
+          the prefill) for that prefix, see TransformerBackend.inference_step. Sessions may then allocate up to
+          (1 - PREFIX_OUTPUTS_MAX_SIZE_FRACTION) of max_size_bytes, the rest holds the prefixes' block outputs
+        :param offload_idle_seconds: if specified, move caches of sessions idle for this long out of max_size_bytes
+          to host RAM (caches on GPU) or to spill files (caches on CPU, or host RAM is full), see cache_offload.py
+        :param offload_host_bytes: maximum total size of caches offloaded to host RAM
+        :param offload_disk_bytes: maximum total size of caches offloaded to spill files
+        :param offload_dir: directory for spill files, defaults to a temporary directory
+        """
         self.max_alloc_timeout = max_alloc_timeout
+        self.page_tokens = page_tokens
+        self._paged_store = PagedCacheStore(page_tokens, max_size_bytes) if page_tokens else None
+        self.share_prefixes = share_prefixes and bool(page_tokens)
+        if self.share_prefixes and max_size_bytes is not None:
+            max_size_bytes -= int(max_size_bytes * PREFIX_OUTPUTS_MAX_SIZE_FRACTION)
+        self.max_size_bytes = max_size_bytes if max_size_bytes is not None else (2**64 - 1)
+        self._page_reservations: Dict[Tuple[Handle, ...], PageReservation] = {}  # per connection handler process
+        self.offload_idle_seconds = offload_idle_seconds if not page_tokens else None  # pages are shared by sessions
+        self.max_offload_bytes = {HOST: offload_host_bytes, DISK: offload_disk_bytes}
+        self._offloaded_size = {tier: mp.Value(ctypes.c_int64, 0, lock=False) for tier in self.max_offload_bytes}
+        self._offload_states: Dict[Tuple[Handle, ...], OffloadState] = {}  # per connection handler process
+        self._offloader = CacheOffloader(offload_dir or os.path.join(tempfile.gettempdir(), "farmesh_cache"))
         self._lock_metadata = mp.Lock()
         self._current_size = mp.Value(ctypes.c_int64, 0, lock=False)
         self._enqueued_size = mp.Value(ctypes.c_int64, 0, lock=True)
         self._handle_counter = mp.Value(ctypes.c_int64, 0, lock=False)
         self._allocated_tensors: Dict[Handle, torch.Tensor] = {}
         self.runtime_pid = os.getpid()
+        self._lock_tensors = threading.Lock()  # runtime process: guards _pipe_recv and _allocated_tensors
+        self._allocator_thread: Optional[threading.Thread] = None
+        self._allocator_stop = threading.Event()
 
         self._pipe_recv, self._pipe_send = mp.Pipe(duplex=False)  # any ConnectionHandler -> runtime
         self._lock_acquire_memory = mp.Lock()
@@ -56,10 +115,27 @@ class MemoryCache:
     def enqueued_size_bytes(self, value: int):
         self._enqueued_size.value = value
 
+    @property
+    def paged_store(self) -> Optional[PagedCacheStore]:
+        return self._paged_store
+
     @property
     def bytes_left(self) -> int:
         return self.max_size_bytes - self.current_size_bytes
 
+    def get_offloaded_size_bytes(self, tier: str) -> int:
+        return self._offloaded_size[tier].value
+
+    @property
+    def effective_bytes_left(self) -> int:
+        """Free bytes for new sessions, counting the room that caches of idle sessions can be offloaded to"""
+        if self.offload_idle_seconds is None:
+            return self.bytes_left
+        offload_bytes_left = sum(
+            max(0, max_size - self.get_offloaded_size_bytes(tier)) for tier, max_size in self.max_offload_bytes.items()
+        )
+        return self.bytes_left + offload_bytes_left
+
     @property
     def handle_counter(self) -> int:
         return self._handle_counter.value
@@ -76,6 +152,7 @@ class MemoryCache:
         Create a handle that is associated with buffers on unique device. If cache full, raises AllocationFailed.
 
         :param descriptors: one or more tensors tensor of this size, dtype, etc
+          (in paged mode, descriptors of a single token: [batch_size, *token_shape])
         :param timeout: optional maximum time to wait for cache allocation; None (default) means no time limit
 
         :note: if descriptors reside on different devices, it is expected that they are approximately balanced across devices;
@@ -89,6 +166,8 @@ class MemoryCache:
         if self.max_alloc_timeout is not None:
             timeout = min(timeout, self.max_alloc_timeout)
         max_alloc_size = self.get_allocation_size(*descriptors)
+        if self.page_tokens:
+            max_alloc_size *= self.page_tokens  # reserve the first page now, the rest in reserve_tokens()
 
         gib = 1024**3
         cur_size, max_size = self.current_size_bytes, self.max_size_bytes
@@ -102,10 +181,108 @@ class MemoryCache:
         try:
             handles = await shield_and_wait(alloc_task)
             logger.info(f"rpc_inference.alloc_done(size={max_alloc_size / gib:.2f} GiB)")
+            if self.page_tokens:
+                self._page_reservations[handles] = PageReservation(page_bytes=max_alloc_size, num_pages=1)
+            if self.offload_idle_seconds is not None:
+                tiers = get_offload_tiers([descr.device for descr in descriptors])
+                self._offload_states[handles] = OffloadState(size_bytes=max_alloc_size, tiers=tiers)
             yield handles
         finally:
             self._free(max_alloc_size, alloc_task)
 
+    async def reserve_tokens(self, handles: Sequence[Handle], num_tokens: int, timeout: Optional[float]):
+        """
+        Paged mode only: account for enough pages to hold num_tokens tokens in every tensor of an allocation
+        before the runtime writes them. Waits for free memory like allocate_cache; a no-op in the default mode.
+
+        :param handles: all handles returned by one allocate_cache call
+        :note: This function should be called by the connection handler that allocated the handles.
+        """
+        if not self.page_tokens:
+            return
+        reservation = self._page_reservations[tuple(handles)]
+        num_pages = -(-num_tokens // self.page_tokens)
+        if num_pages <= reservation.num_pages:
+            return
+        if self.max_alloc_timeout is not None:
+            timeout = min(timeout, self.max_alloc_timeout) if timeout is not None else self.max_alloc_timeout
+        await shield_and_wait(asyncio.create_task(self._schedule_reserve(reservation, num_pages, timeout=timeout)))
+
+    async def _schedule_reserve(self, reservation: PageReservation, num_pages: int, timeout: Optional[float]):
+        """Like _schedule_alloc, this should be called inside asyncio.shield()"""
+        extra_size = (num_pages - reservation.num_pages) * reservation.page_bytes
+        try:
+            async with self._wait_for_free_memory(extra_size, timeout):
+                with self._lock_metadata:
+                    self.current_size_bytes += extra_size
+                    reservation.num_pages = num_pages
+        except TimeoutError:
+            raise AllocationFailed(f"Could not allocate {extra_size} (timeout={timeout})")
+
+    def schedule_offload(self, handles: Sequence[Handle]):
+        """
+        Offload an allocation's tensors if it is not used again within offload_idle_seconds (a no-op if disabled).
+        The next restore() cancels this.
+
+        :param handles: all handles returned by one allocate_cache call
+        :note: This function should be called by the connection handler that allocated the handles.
+        """
+        state = self._offload_states.get(tuple(handles))
+        if state is None or state.tier is not None:
+            return
+        if state.timer is not None:
+            state.timer.cancel()
+        loop = asyncio.get_event_loop()
+        state.timer = loop.call_later(self.offload_idle_seconds, self._offload, tuple(handles))
+
+    def _offload(self, handles: Tuple[Handle, ...]):
+        """Move an allocation out of max_size_bytes to the first lower tier with enough room, if any"""
+        state = self._offload_states.get(handles)
+        if state is None or state.tier is not None:
+            return
+        state.timer = None
+        with self._lock_metadata:
+            for tier in state.tiers:
+                if self.get_offloaded_size_bytes(tier) + state.size_bytes <= self.max_offload_bytes[tier]:
+                    break
+            else:
+                return  # stays on device: all tiers are full
+            self._offloaded_size[tier].value += state.size_bytes
+            self.current_size_bytes -= state.size_bytes
+            self._pipe_send.send((handles, tier))  # signal runtime to move these tensors
+            state.tier = tier
+        self._memory_freed_event.set()
+        logger.debug(f"Offloaded idle cache to {tier} ({state.size_bytes / 1024**3:.2f} GiB)")
+
+    async def restore(self, handles: Sequence[Handle]):
+        """
+        Cancel a scheduled offload and, if the allocation was offloaded, account for it in max_size_bytes again.
+        The runtime copies the tensors back on their next use. Since the session was already admitted, this waits
+        for free memory for up to max_alloc_timeout.
+
+        :param handles: all handles returned by one allocate_cache call
+        :note: This function should be called by the connection handler that allocated the handles.
+        """
+        state = self._offload_states.get(tuple(handles))
+        if state is None:
+            return
+        if state.timer is not None:
+            state.timer.cancel()
+            state.timer = None
+        if state.tier is not None:
+            await shield_and_wait(asyncio.create_task(self._schedule_restore(state, timeout=self.max_alloc_timeout)))
+
+    async def _schedule_restore(self, state: OffloadState, timeout: Optional[float]):
+        """Like _schedule_alloc, this should be called inside asyncio.shield()"""
+        try:
+            async with self._wait_for_free_memory(state.size_bytes, timeout):
+                with self._lock_metadata:
+                    self.current_size_bytes += state.size_bytes
+                    self._offloaded_size[state.tier].value -= state.size_bytes
+                    state.tier = None
+        except TimeoutError:
+            raise AllocationFailed(f"Could not restore {state.size_bytes} (timeout={timeout})")
+
     @staticmethod
     def get_allocation_size(*descriptors: TensorDescriptor) -> int:
         """Return the memory size (bytes) to be allocated on a device. If there are many devices, return maximum"""
@@ -170,10 +347,18 @@ class MemoryCache:
         if alloc_task.exception() is not None:
             return
         handles = alloc_task.result()
+        if handles in self._page_reservations:
+            alloc_size = self._page_reservations.pop(handles).size_bytes  # including pages reserved after allocation
+        offload_state = self._offload_states.pop(handles, None)
+        if offload_state is not None and offload_state.timer is not None:
+            offload_state.timer.cancel()
 
         with self._lock_metadata:
             self._pipe_send.send((handles, None))  # signal runtime to free these handles
-            self.current_size_bytes -= alloc_size
+            if offload_state is not None and offload_state.tier is not None:
+                self._offloaded_size[offload_state.tier].value -= alloc_size
+            else:
+                self.current_size_bytes -= alloc_size
         self._memory_freed_event.set()
 
     def _wait_until_available(self, allocated_size: int, timeout: Optional[float] = None):
@@ -193,9 +378,9 @@ class MemoryCache:
             self._memory_freed_event.clear()
 
     @contextlib.contextmanager
-    def use_cache(self, *handles: Handle) -> Sequence[torch.Tensor]:
+    def use_cache(self, *handles: Handle) -> Sequence[Union[torch.Tensor, PagedCacheTensor]]:
         """
-        Return one or more tensors previously allocated with allocate_cache,
+        Return one or more tensors previously allocated with allocate_cache (PagedCacheTensor-s in paged mode),
 
         :note: This method is called by ModuleBackend in runtime: a single process with NO process parallelism.
         However, runtime may call use_cache concurrently with one or more connection handlers calling allocate_cache
@@ -203,13 +388,58 @@ class MemoryCache:
         assert os.getpid() == self.runtime_pid
         # note: this specific function is not concurrent, so you can safely allocate/offload/defragment data here
 
-        # read creation/deletion requests from connection handlers
+        with self._lock_tensors:
+            self._process_requests()  # the allocator thread may have done this already
+            for handle in handles:
+                if self._offloader.is_offloaded(handle):
+                    self._allocated_tensors[handle] = self._offloader.restore(handle, self._allocated_tensors[handle])
+            tensors = tuple(self._allocated_tensors[handle] for handle in handles)
+        yield tensors
+
+    def start_allocator(self):
+        """
+        Create tensors for new allocations (and move offloaded ones) in a background thread of the runtime process
+        as soon as a connection handler asks for it, instead of on the session's next step inside the runtime.
+        Paged caches (see paged_cache.py) are created empty and grow in the runtime, so they do not need this.
+        """
+        assert os.getpid() == self.runtime_pid
+        if self._paged_store is None and self._allocator_thread is None:
+            self._allocator_stop.clear()
+            self._allocator_thread = threading.Thread(
+                target=self._allocate_forever, name="cache_allocator", daemon=True
+            )
+            self._allocator_thread.start()
+
+    def stop_allocator(self):
+        if self._allocator_thread is not None:
+            self._allocator_stop.set()
+            self._allocator_thread.join()
+            self._allocator_thread = None
+
+    def _allocate_forever(self):
+        while not self._allocator_stop.is_set():
+            if self._pipe_recv.poll(timeout=0.1):
+                with self._lock_tensors:
+                    self._process_requests()
+
+    def _process_requests(self):
+        """Read creation/offload/deletion requests from connection handlers, should be called under _lock_tensors"""
         while self._pipe_recv.poll():
             recv_handles, recv_data = self._pipe_recv.recv()
-            if recv_data is not None:  # create new tensors
+            if isinstance(recv_data, str):  # offload tensors to a lower tier
+                for handle in recv_handles:
+                    tensor = self._allocated_tensors.pop(handle)
+                    self._allocated_tensors[handle] = self._offloader.offload(handle, tensor, tier=recv_data)
+                    del tensor
+            elif recv_data is not None:  # create new tensors
                 assert len(recv_handles) == len(recv_data)
                 for handle, descr in zip(recv_handles, recv_data):
-                    self._allocated_tensors[handle] = descr.make_zeros()
+                    if self._paged_store is not None:
+                        self._allocated_tensors[handle] = self._paged_store.make_tensor(descr)
+                    else:
+                        # no memset: inference only reads the first prefix_length tokens, which it wrote before
+                        tensor = torch.empty(descr.shape, dtype=descr.dtype, device=descr.device)
+                        self._allocated_tensors[handle] = tensor
                     assert handle in self._allocated_tensors, f"Sanity check failed: no such handle ({handle})"
             else:  # delete tensors by handle
                 for handle in recv_handles:
@@ -217,8 +447,11 @@ class MemoryCache:
                         logger.warning(
                             f"Sanity check failed: asked to delete handle {handle}, but there is no such handle"
                         )
-                    self._allocated_tensors.pop(handle, None)
-        yield tuple(self._allocated_tensors[handle] for handle in handles)
+                    tensor = self._allocated_tensors.pop(handle, None)
+                    if isinstance(tensor, PagedCacheTensor):
+                        tensor.release()  # return its pages to the pool
+                    elif self._offloader.is_offloaded(handle):
+                        self._offloader.discard(handle)
 
 
 class AllocationFailed(Exception):
@@ -0,0 +1,366 @@
+"""
+Paged storage for attention caches: instead of one [batch, ..., max_length] tensor per session, each cache tensor
+is a per-row table of fixed-size token pages taken from a pool shared by all sessions. Pages are added as the prefix
+grows, so a session only holds memory for the tokens it actually has.
+
+Pages are reference-counted, so rows and sessions can share them: beam reorders only permute page tables, and
+pages of a common prompt prefix can be published under a hash of the inputs that produced them (see PrefixHashes)
+and reused by later sessions. A shared page is read-only, writes copy it first (copy-on-write).
+
+Used by MemoryCache when the server runs with --cache_page_tokens. Everything here runs in the runtime process.
+"""
+import bisect
+import hashlib
+import math
+from collections import OrderedDict
+from typing import Dict, Hashable, List, NamedTuple, Optional, Sequence, Tuple
+
+import torch
+from hivemind.utils import TensorDescriptor, get_logger
+
+from farmesh.utils.misc import get_size_in_bytes
+
+logger = get_logger(__name__)
+
+MAX_POOL_SEGMENTS = 16  # a pool with a size limit is allocated in at most this many segments
+DEFAULT_SEGMENT_PAGES = 256  # segment size of pools without a size limit
+
+
+class PageGroup(NamedTuple):
+    """The pages of a [rows, columns] grid of page ids that live in one segment of a PagePool (see PagePool.locate)"""
+
+    segment: int
+    positions: Optional[torch.LongTensor]  # positions in the flattened grid, None if this segment holds every page
+    indices: torch.LongTensor  # indices of these pages in the segment
+    grid_indices: torch.LongTensor  # [rows, columns]: index in the segment, or its spare page for other segments
+
+
+class PagePool:
+    """
+    Fixed-size token pages of one shape, dtype and device. Pages are stored in segments, [num_pages + 1, page_tokens,
+    ...] each: the pool grows by allocating another segment, so existing pages are never copied or moved. The extra
+    page of each segment is a spare that absorbs writes meant for pages in other segments.
+    """
+
+    def __init__(
+        self,
+        token_shape: Tuple[int, ...],
+        dtype: torch.dtype,
+        device: torch.device,
+        page_tokens: int,
+        max_pages: Optional[int] = None,
+    ):
+        self.token_shape, self.dtype, self.device = tuple(token_shape), dtype, device
+        self.page_tokens, self.max_pages = page_tokens, max_pages
+        self.segments: List[torch.Tensor] = []
+        self._segment_starts: List[int] = []  # id of the first page in each segment
+        self._free_pages: List[int] = []
+        self._refcounts: List[int] = []
+        self._published: Dict[Hashable, int] = {}  # key -> page
+        self._page_keys: Dict[int, Hashable] = {}  # page -> key, for published pages
+        self._unused_published: "OrderedDict[int, None]" = OrderedDict()  # published, unreferenced, LRU first
+
+    @property
+    def page_bytes(self) -> int:
+        return self.page_tokens * math.prod(self.token_shape) * get_size_in_bytes(self.dtype)
+
+    @property
+    def num_pages(self) -> int:
+        return self._segment_starts[-1] + self.segments[-1].shape[0] - 1 if self.segments else 0
+
+    @property
+    def num_free_pages(self) -> int:
+        return len(self._free_pages)
+
+    def allocate(self, num_pages: int) -> List[int]:
+        """Take num_pages exclusive pages (with one reference each), evicting unused published pages if full"""
+        if num_pages > len(self._free_pages):
+            room = self.max_pages - self.num_pages if self.max_pages is not None else num_pages
+            while len(self._free_pages) + room < num_pages and self._unused_published:
+                self._evict_one()
+        if num_pages > len(self._free_pages):
+            self._grow(num_pages - len(self._free_pages))
+        pages = self._free_pages[-num_pages:] if num_pages > 0 else []
+        del self._free_pages[len(self._free_pages) - num_pages :]
+        for page in pages:
+            self._refcounts[page] = 1
+        return pages
+
+    def page(self, page: int) -> torch.Tensor:
+        """View of one page: [page_tokens, *token_shape]"""
+        segment = bisect.bisect_right(self._segment_starts, page) - 1
+        return self.segments[segment][page - self._segment_starts[segment]]
+
+    def locate(self, page_grid: Sequence[Sequence[int]]) -> List[PageGroup]:
+        """Split a [rows, columns] grid of page ids by the segments that hold them, with indices on the pool's device"""
+        grid = torch.tensor(page_grid, dtype=torch.int64)
+        if grid.numel() == 0:
+            return []
+        starts = torch.tensor(self._segment_starts, dtype=torch.int64)
+        segment_ids = torch.bucketize(grid, starts, right=True) - 1
+        indices = grid - starts[segment_ids]
+        used_segments = segment_ids.unique().tolist()
+        if len(used_segments) == 1:
+            indices = indices.to(self.device)
+            return [PageGroup(used_segments[0], None, indices.flatten(), indices)]
+
+        groups = []
+        for segment in used_segments:
+            in_segment = segment_ids == segment
+            spare_page = self.segments[segment].shape[0] - 1
+            groups.append(
+                PageGroup(
+                    segment,
+                    in_segment.flatten().nonzero().flatten().to(self.device),
+                    indices[in_segment].to(self.device),
+                    indices.masked_fill(~in_segment, spare_page).to(self.device),
+                )
+            )
+        return groups
+
+    def read(self, groups: Sequence[PageGroup], num_rows: int, num_columns: int) -> torch.Tensor:
+        """Copy the pages of a located grid into a new [rows, columns, page_tokens, *token_shape] tensor"""
+        if len(groups) == 1:
+            return self.segments[groups[0].segment][groups[0].grid_indices]
+        pages = torch.empty(
+            (num_rows * num_columns, self.page_tokens, *self.token_shape), dtype=self.dtype, device=self.device
+        )
+        for group in groups:
+            pages[group.positions] = self.segments[group.segment][group.indices]
+        return pages.view(num_rows, num_columns, self.page_tokens, *self.token_shape)
+
+    def write(
+        self, groups: Sequence[PageGroup], columns: torch.LongTensor, offsets: torch.LongTensor, values: torch.Tensor
+    ):
+        """Write values [rows, tokens, *token_shape] to the given [tokens] grid columns and offsets in their pages"""
+        for group in groups:
+            self.segments[group.segment][group.grid_indices[:, columns], offsets] = values
+
+    def incref(self, page: int):
+        if self._refcounts[page] == 0:
+            del self._unused_published[page]
+        self._refcounts[page] += 1
+
+    def release(self, pages: Sequence[int]):
+        """Drop one reference to each page; published pages stay cached until evicted, others are freed"""
+        for page in pages:
+            self._refcounts[page] -= 1
+            if self._refcounts[page] == 0:
+                if page in self._page_keys:
+                    self._unused_published[page] = None
+                else:
+                    self._free_pages.append(page)
+
+    def is_writable(self, page: int) -> bool:
+        return self._refcounts[page] == 1 and page not in self._page_keys
+
+    def publish(self, key: Hashable, page: int):
+        """Make a page findable by key; it becomes read-only and is kept after its last reference until evicted"""
+        if key not in self._published and page not in self._page_keys:
+            self._published[key], self._page_keys[page] = page, key
+
+    def find(self, key: Hashable) -> Optional[int]:
+        """Return the page published under key (without taking a reference), or None"""
+        page = self._published.get(key)
+        if page is not None and page in self._unused_published:
+            self._unused_published.move_to_end(page)
+        return page
+
+    def _evict_one(self):
+        page, _ = self._unused_published.popitem(last=False)
+        del self._published[self._page_keys.pop(page)]
+        self._free_pages.append(page)
+
+    def _grow(self, min_extra_pages: int):
+        # Pages are only requested for tokens MemoryCache has already accounted for, so the pool stays within the
+        # cache budget. Segments are a fixed fraction of it (the last one is cut at the budget), so growing never
+        # copies pages or holds more memory than the pool itself
+        if self.max_pages is not None:
+            segment_pages = max(1, -(-self.max_pages // MAX_POOL_SEGMENTS))
+        else:
+            segment_pages = DEFAULT_SEGMENT_PAGES
+        target_num_pages = self.num_pages + min_extra_pages
+        while self.num_pages < target_num_pages:
+            first_page = self.num_pages
+            num_pages = segment_pages
+            if self.max_pages is not None:
+                num_pages = min(num_pages, max(self.max_pages, target_num_pages) - first_page)
+            self.segments.append(
+                torch.empty((num_pages + 1, self.page_tokens, *self.token_shape), dtype=self.dtype, device=self.device)
+            )
+            self._segment_starts.append(first_page)
+            self._free_pages[:0] = range(first_page + num_pages - 1, first_page - 1, -1)
+            self._refcounts.extend([0] * num_pages)
+
+
+class PagedCacheTensor:
+    """
+    One attention cache tensor of a session, stored as a page table per batch row.
+
+    Token t of row b lives at pool.page(page_table[b][t // page_tokens])[t % page_tokens].
+    The backend reads it with gather() and writes new tokens with write(); both take [batch, tokens, *token_shape].
+    """
+
+    def __init__(self, pool: PagePool, batch_size: int):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.page_table: List[List[int]] = [[] for _ in range(batch_size)]
+        self.prefix_hashes: Optional[PrefixHashes] = None  # set by TransformerBackend if it shares prefixes
+        self._located: Dict[Tuple[int, int], List[PageGroup]] = {}  # (first, end) page columns -> their pages
+
+    @classmethod
+    def concat(cls, tensors: Sequence["PagedCacheTensor"]) -> "PagedCacheTensor":
+        """Rows of several tensors of one pool, one tensor after another, to read them with one gather() call"""
+        assert all(tensor.pool is tensors[0].pool for tensor in tensors), "tensors must share their pool"
+        combined = cls(tensors[0].pool, sum(tensor.batch_size for tensor in tensors))
+        combined.page_table = [row for tensor in tensors for row in tensor.page_table]
+        return combined
+
+    @property
+    def capacity(self) -> int:
+        """Number of tokens each row can hold without taking more pages"""
+        return len(self.page_table[0]) * self.pool.page_tokens
+
+    def ensure_capacity(self, num_tokens: int):
+        """Take pages from the pool until every row can hold num_tokens tokens"""
+        num_pages = -(-num_tokens // self.pool.page_tokens)
+        missing = num_pages - len(self.page_table[0])
+        if missing > 0:
+            new_pages = self.pool.allocate(missing * self.batch_size)
+            for row, offset in zip(self.page_table, range(0, len(new_pages), missing)):
+                row.extend(new_pages[offset : offset + missing])
+            self._located.clear()
+
+    def locate(self, first_column: int, end_column: int) -> List[PageGroup]:
+        """Pages of the table's columns first_column .. end_column grouped by pool segment, cached until it changes"""
+        key = (first_column, end_column)
+        groups = self._located.get(key)
+        if groups is None:
+            groups = self._located[key] = self.pool.locate([row[first_column:end_column] for row in self.page_table])
+        return groups
+
+    def gather(self, length: int) -> torch.Tensor:
+        """Return the first length tokens of every row as a new [batch_size, length, *token_shape] tensor"""
+        num_pages = -(-length // self.pool.page_tokens)
+        pages = self.pool.read(self.locate(0, num_pages), self.batch_size, num_pages)
+        return pages.flatten(1, 2)[:, :length]
+
+    def write(self, values: torch.Tensor, start: int):
+        """Write values of shape [batch_size, num_tokens, *token_shape] to positions start .. start + num_tokens"""
+        num_tokens = values.shape[1]
+        if num_tokens == 0:
+            return
+        self.ensure_capacity(start + num_tokens)
+        first_column, last_column = start // self.pool.page_tokens, (start + num_tokens - 1) // self.pool.page_tokens
+        self._make_writable(first_column, last_column)
+        positions = torch.arange(start, start + num_tokens, device=self.pool.device)
+        columns = positions // self.pool.page_tokens - first_column
+        groups = self.locate(first_column, last_column + 1)
+        self.pool.write(groups, columns, positions % self.pool.page_tokens, values.to(self.pool.dtype))
+
+    def reorder(self, hypo_ids: torch.LongTensor):
+        """Reorder batch rows by hypo_ids by permuting page tables; rows that end up sharing pages copy on write"""
+        old_page_table = self.page_table
+        self.page_table = [list(old_page_table[hypo_id]) for hypo_id in hypo_ids.tolist()]
+        for row in self.page_table:
+            for page in row:
+                self.pool.incref(page)
+        for row in old_page_table:
+            self.pool.release(row)
+        self._located.clear()
+
+    def share_page(self, row_index: int, page_index: int, page: int):
+        """Use a published page instead of this row's own page at page_index"""
+        row = self.page_table[row_index]
+        self.pool.incref(page)
+        self.pool.release([row[page_index]])
+        row[page_index] = page
+        self._located.clear()
+
+    def release(self):
+        for row in self.page_table:
+            self.pool.release(row)
+        self.page_table = [[] for _ in range(self.batch_size)]
+        self._located.clear()
+
+    def _make_writable(self, first_page_index: int, last_page_index: int):
+        for row in self.page_table:
+            for page_index in range(first_page_index, last_page_index + 1):
+                page = row[page_index]
+                if not self.pool.is_writable(page):
+                    (new_page,) = self.pool.allocate(1)
+                    self.pool.page(new_page).copy_(self.pool.page(page))
+                    self.pool.release([page])
+                    row[page_index] = new_page
+                    self._located.clear()
+
+
+class PrefixHashes:
+    """
+    Running hashes of one session's inputs to a block, one per batch row. The digest at the end of page i identifies
+    the block's keys, values and outputs for tokens 0 .. (i + 1) * page_tokens, so sessions whose inputs agree up to
+    there can share those pages.
+    """
+
+    def __init__(self, batch_size: int, page_tokens: int, salt: bytes):
+        self.page_tokens = page_tokens
+        self.num_tokens = 0
+        self._pending: Optional[torch.Tensor] = None  # inputs of the page in progress, hashed once it is complete
+        self._hashers = []
+        for _ in range(batch_size):
+            hasher = hashlib.blake2b(digest_size=16)
+            hasher.update(salt)
+            self._hashers.append(hasher)
+
+    def update(self, hidden_states: torch.Tensor) -> List[Tuple[int, List[bytes]]]:
+        """Hash the next tokens [batch, num_tokens, hid_size], return (page index, digest of each row) of full pages"""
+        first_page = self.num_tokens // self.page_tokens
+        self.num_tokens += hidden_states.shape[1]
+        if self._pending is not None:
+            hidden_states = torch.cat([self._pending, hidden_states], dim=1)
+        num_pages = self.num_tokens // self.page_tokens - first_page
+        num_hashed_tokens = num_pages * self.page_tokens
+        self._pending = hidden_states[:, num_hashed_tokens:].clone() if self.num_tokens % self.page_tokens else None
+        if num_pages == 0:
+            return []
+
+        page_bytes = hidden_states[:, :num_hashed_tokens].cpu().contiguous().view(torch.uint8)
+        page_bytes = page_bytes.reshape(len(self._hashers), num_pages, -1).numpy()
+        completed_pages = []
+        for page_offset in range(num_pages):
+            for hasher, row in zip(self._hashers, page_bytes):
+                hasher.update(row[page_offset])
+            completed_pages.append((first_page + page_offset, [hasher.digest() for hasher in self._hashers]))
+        return completed_pages
+
+    def reorder(self, hypo_ids: torch.LongTensor):
+        self._hashers = [self._hashers[hypo_id].copy() for hypo_id in hypo_ids.tolist()]
+        if self._pending is not None:
+            self._pending = self._pending[hypo_ids.to(self._pending.device)]
+
+
+class PagedCacheStore:
+    """Page pools of the runtime process, one per (token shape, dtype, device)"""
+
+    def __init__(self, page_tokens: int, max_size_bytes: Optional[int] = None):
+        self.page_tokens = page_tokens
+        self.max_size_bytes = max_size_bytes
+        self._pools: Dict[Tuple, PagePool] = {}
+
+    def make_tensor(self, descr: TensorDescriptor) -> PagedCacheTensor:
+        """Create an empty paged tensor for a per-token descriptor of shape [batch_size, *token_shape]"""
+        batch_size, *token_shape = descr.shape
+        return PagedCacheTensor(self.get_pool(token_shape, descr.dtype, descr.device), batch_size)
+
+    def get_pool(
+        self, token_shape: Sequence[int], dtype: torch.dtype, device: torch.device, max_size_fraction: float = 1.0
+    ) -> PagePool:
+        """Return the pool for pages of this kind, its size is capped by max_size_fraction of the cache budget"""
+        key = (tuple(token_shape), dtype, torch.device(device))
+        pool = self._pools.get(key)
+        if pool is None:
+            pool = PagePool(tuple(token_shape), dtype, device, self.page_tokens)
+            if self.max_size_bytes is not None:
+                pool.max_pages = int(self.max_size_bytes * max_size_fraction) // pool.page_bytes
+            self._pools[key] = pool
+        return pool
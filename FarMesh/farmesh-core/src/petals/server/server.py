@@ -8,7 +8,7 @@ import random
 import sys
 import threading
 import time
-from typing import Dict, List, Optional, Sequence, Union
+from typing import Any, Dict, List, Optional, Sequence, Union
 
 import hivemind
 import psutil
@@ -31,6 +31,8 @@ from farmesh.server.from_pretrained import load_pretrained_block
 from farmesh.server.handler import TransformerConnectionHandler
 from farmesh.server.memory_cache import MemoryCache
 from farmesh.server.reachability import ReachabilityProtocol, check_direct_reachability, validate_reachability
+from farmesh.server.task_prioritizer import TaskPrioritizer
+from farmesh.server.task_transport import SharedTensorSlab, get_slab_slot_bytes
 from farmesh.server.throughput import get_dtype_name, get_server_throughput
 from farmesh.utils.auto_config import AutoDistributedConfig
 from farmesh.utils.convert_block import QuantType, check_device_balance, convert_block
@@ -66,6 +68,15 @@ class Server:
         max_chunk_size_bytes: int = 256 * 1024 * 1024,
         max_alloc_timeout: float = 600,
         attn_cache_tokens: Optional[int] = None,
+        cache_page_tokens: Optional[int] = None,
+        cache_share_prefixes: bool = False,
+        cache_offload_idle_seconds: Optional[float] = None,
+        cache_offload_host_bytes: int = 0,
+        cache_offload_disk_bytes: int = 0,
+        cache_offload_dir: Optional[str] = None,
+        task_slab_bytes: int = 64 * 1024**2,
+        priority_seconds_per_point: float = 0.0,
+        prefill_chunk_tokens: Optional[int] = 512,
         torch_dtype: str = "auto",
         revision: Optional[str] = None,
         cache_dir: Optional[str] = None,
@@ -200,6 +211,19 @@ class Server:
         self.inference_max_length = inference_max_length
         self.max_chunk_size_bytes = max_chunk_size_bytes
         self.max_alloc_timeout = max_alloc_timeout
+        self.cache_page_tokens = cache_page_tokens
+        self.cache_share_prefixes = cache_share_prefixes
+        if cache_share_prefixes and cache_page_tokens is None:
+            raise ValueError("cache_share_prefixes requires cache_page_tokens (prefixes are shared in pages)")
+        self.cache_offload_kwargs = dict(
+            offload_idle_seconds=cache_offload_idle_seconds,
+            offload_host_bytes=cache_offload_host_bytes,
+            offload_disk_bytes=cache_offload_disk_bytes,
+            offload_dir=cache_offload_dir,
+        )
+        self.task_slab_bytes = task_slab_bytes
+        self.priority_seconds_per_point = priority_seconds_per_point
+        self.prefill_chunk_tokens = prefill_chunk_tokens or None  # 0 disables chunking
 
         # For attention cache in GPU or RAM
         if attn_cache_tokens is None:
@@ -342,6 +366,12 @@ class Server:
                 max_batch_size=self.max_batch_size,
                 max_chunk_size_bytes=self.max_chunk_size_bytes,
                 max_alloc_timeout=self.max_alloc_timeout,
+                cache_page_tokens=self.cache_page_tokens,
+                cache_share_prefixes=self.cache_share_prefixes,
+                cache_offload_kwargs=self.cache_offload_kwargs,
+                task_slab_bytes=self.task_slab_bytes,
+                priority_seconds_per_point=self.priority_seconds_per_point,
+                prefill_chunk_tokens=self.prefill_chunk_tokens,
                 inference_max_length=self.inference_max_length,
                 torch_dtype=self.torch_dtype,
                 cache_dir=self.cache_dir,
@@ -448,6 +478,10 @@ class ModuleContainer(threading.Thread):
         max_batch_size: int,
         max_chunk_size_bytes: int,
         max_alloc_timeout: float,
+        cache_page_tokens: Optional[int],
+        cache_share_prefixes: bool,
+        cache_offload_kwargs: Dict[str, Any],
+        task_slab_bytes: int,
         torch_dtype: torch.dtype,
         cache_dir: str,
         max_disk_space: int,
@@ -463,7 +497,17 @@ class ModuleContainer(threading.Thread):
         **kwargs,
     ) -> ModuleContainer:
         module_uids = [f"{dht_prefix}{UID_DELIMITER}{block_index}" for block_index in block_indices]
-        memory_cache = MemoryCache(attn_cache_bytes, max_alloc_timeout)
+        memory_cache = MemoryCache(
+            attn_cache_bytes,
+            max_alloc_timeout,
+            page_tokens=cache_page_tokens,
+            share_prefixes=cache_share_prefixes,
+            **cache_offload_kwargs,
+        )
+        task_slab = None
+        if task_slab_bytes > 0:
+            slot_bytes = get_slab_slot_bytes(block_config.hidden_size, torch_dtype)
+            task_slab = SharedTensorSlab(max(task_slab_bytes // slot_bytes, 1), slot_bytes)
 
         server_info.state = ServerState.JOINING
         dht_announcer = ModuleAnnouncerThread(
@@ -515,6 +559,7 @@ class ModuleContainer(threading.Thread):
                     memory_cache=memory_cache,
                     backend_dtype=torch_dtype,
                     max_chunk_size_bytes=max_chunk_size_bytes,
+                    task_slab=task_slab,
                     args_schema=(
                         BatchTensorDescriptor(
                             1, 2048, block_config.hidden_size, dtype=torch_dtype, compression=compression
@@ -548,6 +593,7 @@ class ModuleContainer(threading.Thread):
             dht_prefix,
             blocks,
             dht_announcer=dht_announcer,
+            memory_cache=memory_cache,
             server_info=server_info,
             update_period=update_period,
             expiration=expiration,
@@ -563,18 +609,21 @@ class ModuleContainer(threading.Thread):
         inference_max_length: int,
         num_handlers: int,
         dht_announcer: ModuleAnnouncerThread,
+        memory_cache: MemoryCache,
         server_info: ServerInfo,
         update_period: float,
         expiration: Optional[float] = None,
         request_timeout: float,
         session_timeout: float,
         step_timeout: float,
+        priority_seconds_per_point: float,
+        prefill_chunk_tokens: Optional[int],
         start: bool,
         **kwargs,
     ):
         super().__init__()
 
-        self.dht, self.module_backends = dht, module_backends
+        self.dht, self.module_backends, self.memory_cache = dht, module_backends, memory_cache
         self.server_info, self.update_period, self.expiration = server_info, update_period, expiration
 
         handler_event_queues = [mp.Queue() for _ in range(num_handlers)]
@@ -590,6 +639,8 @@ class ModuleContainer(threading.Thread):
                 request_timeout=request_timeout,
                 session_timeout=session_timeout,
                 step_timeout=step_timeout,
+                task_prioritizer=TaskPrioritizer(seconds_per_point=priority_seconds_per_point),
+                prefill_chunk_tokens=prefill_chunk_tokens,
                 quant_type=QuantType[server_info.quant_type.upper()],
             )
             for i in range(num_handlers)
@@ -611,6 +662,7 @@ class ModuleContainer(threading.Thread):
         """
         for handler in self.conn_handlers:
             handler.run_in_background()
+        self.memory_cache.start_allocator()  # after forking handlers, so they do not inherit the thread's locks
 
         self.runtime.run()
 
@@ -663,6 +715,7 @@ class ModuleContainer(threading.Thread):
 
         logger.debug(f"Shutting down runtime")
         self.runtime.shutdown()
+        self.memory_cache.stop_allocator()
 
         logger.debug("Shutting down backends")
         for backend in self.module_backends.values():
@@ -718,7 +771,7 @@ class ModuleAnnouncerThread(threading.Thread):
         while True:
             start_time = time.perf_counter()
 
-            self.server_info.cache_tokens_left = self.memory_cache.bytes_left // self.bytes_per_token
+            self.server_info.cache_tokens_left = self.memory_cache.effective_bytes_left // self.bytes_per_token
             if self.server_info.state != ServerState.OFFLINE:
                 self._ping_next_servers()
                 self.server_info.next_pings = {
@@ -768,8 +821,32 @@ class ModuleAnnouncerThread(threading.Thread):
 
 
 class RuntimeWithDeduplicatedPools(Runtime):
-    """A version of hivemind.moe.server.runtime.Runtime that allows multiple backends to reuse a task pool"""
+    """
+    A version of hivemind.moe.server.runtime.Runtime that allows multiple backends to reuse a task pool.
+    If stats_report_interval is set, it also reports how long tasks waited in each pool.
+    """
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    def __init__(self, *args, stats_report_interval: Optional[int] = None, **kwargs):
+        super().__init__(*args, stats_report_interval=stats_report_interval, **kwargs)
         self.pools = tuple(set(self.pools))
+        self.queue_stats_interval = stats_report_interval
+        self._stop_reporting = threading.Event()
+
+    def run(self):
+        if self.queue_stats_interval is not None:
+            threading.Thread(target=self._report_queue_stats, name="QueueStatsReporter", daemon=True).start()
+        super().run()
+
+    def shutdown(self):
+        self._stop_reporting.set()
+        super().shutdown()
+
+    def _report_queue_stats(self):
+        while not self._stop_reporting.wait(self.queue_stats_interval):
+            for pool in sorted(self.pools, key=lambda pool: pool.name):
+                stats = pool.pop_queue_stats()
+                if stats.num_tasks > 0:
+                    logger.info(
+                        f"{pool.name}: {stats.num_tasks} tasks waited {stats.mean_wait * 1000:.1f} ms on average, "
+                        f"{stats.max_wait * 1000:.1f} ms max"
+                    )
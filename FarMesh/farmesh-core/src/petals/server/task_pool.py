@@ -1,16 +1,20 @@
 import ctypes
+import heapq
 import multiprocessing as mp
+import os
 import threading
 import time
 from concurrent.futures._base import PENDING
 from dataclasses import dataclass, field
 from queue import PriorityQueue
-from typing import Any, List, Optional, Sequence, Tuple, Union
+from typing import Any, Callable, Dict, Hashable, List, Optional, Sequence, Tuple, Union
 
 import torch
 from hivemind import get_logger
 from hivemind.utils.mpfuture import ALL_STATES, MPFuture
 
+from farmesh.server.task_transport import SharedTensorSlab
+
 logger = get_logger(__name__)
 
 
@@ -26,6 +30,23 @@ class Task:
         return self.future._uid
 
 
+@dataclass
+class QueueStats:
+    """How long the tasks dispatched from a pool waited in it, in seconds"""
+
+    num_tasks: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+
+    @property
+    def mean_wait(self) -> float:
+        return self.total_wait / self.num_tasks if self.num_tasks else 0.0
+
+    def add(self, wait: float):
+        self.num_tasks += 1
+        self.total_wait, self.max_wait = self.total_wait + wait, max(self.max_wait, wait)
+
+
 class PrioritizedTaskPool(threading.Thread):
     """
     Aggregates requests from multiple ConnectionHandler instances, orders them for processing in Runtime, then
@@ -33,7 +54,7 @@ class PrioritizedTaskPool(threading.Thread):
     A single PrioritizedTaskPool services a specific function (e.g. layer1.forward, layer2.forward or layer1.backward)
 
     :note: unlike hivemind.moe TaskPool, this pool does *not* combine incoming requests into batches.
-      This would require grouping requests of different length.
+      This would require grouping requests of different length. See BatchingTaskPool for pools whose tasks can be.
 
     :param process_func: function to be applied to every formed batch; called by Runtime
         Note that process_func should accept only positional args (Tensors) and return a flat tuple of Tensors
@@ -43,6 +64,7 @@ class PrioritizedTaskPool(threading.Thread):
     :param name: pool name, used for logging
     :param min_batch_size: process at least this many inputs in a batch, otherwise wait for more
     :param device: if specified, input tensors will be moved to that device by default
+    :param slab: if specified, small input and output tensors are passed through this shared memory (see task_transport)
     :param start: if True, start automatically at the end of __init__
     """
 
@@ -53,11 +75,13 @@ class PrioritizedTaskPool(threading.Thread):
         name: str,
         min_batch_size=1,
         device: Optional[torch.device] = None,
+        slab: Optional[SharedTensorSlab] = None,
         daemon=True,
         start=False,
     ):
         super().__init__(daemon=daemon, name=name)
         self.process_func = process_func
+        self.slab = slab
         # the lower the priority is, the more urgent it is to process this pool
         self._priority = mp.Value(ctypes.c_double, 1.0)
 
@@ -71,6 +95,10 @@ class PrioritizedTaskPool(threading.Thread):
         self.batch_receiver, self.batch_sender = mp.Pipe(duplex=False)
         self._oldest_undispatched_timestamp = mp.Value(ctypes.c_double, 1.0)
         self.priority = float("inf"), float("inf")  # (first task priority, first task timestamp)
+        self._priority_lock = threading.Lock()  # orders priority updates of the pool thread and Runtime
+
+        self._queue_stats_lock = threading.Lock()
+        self._queue_stats = QueueStats()
 
         if start:
             self.start()
@@ -83,7 +111,12 @@ class PrioritizedTaskPool(threading.Thread):
                 logger.debug("Shutting down prioritizer thread")
                 break
 
-            self._ordered_tasks.put(task, block=True)
+            if self.slab is not None:
+                task = Task(task.priority, task.time_submitted, task.future, self.slab.unpack(task.args))
+            with self._priority_lock:
+                self._ordered_tasks.put(task, block=True)
+                if (task.priority, task.time_submitted) < self.priority:
+                    self.priority = (task.priority, task.time_submitted)
 
     def terminate(self):
         """An alias for hivemind.Runtime that assumes that each TaskPool is a process"""
@@ -94,7 +127,7 @@ class PrioritizedTaskPool(threading.Thread):
 
     def submit_task(self, *args: Any, priority: float = 0.0) -> MPFuture:
         """Add task to this pool's queue, return Future for its output"""
-        future = MPFuture()
+        future = MPFuture() if self.slab is None else _SlabFuture(self.slab)
         # Remove shmem from MPFuture. This disables the .cancel() feature but
         # saves the server from "could not unlink the shared memory file" crashes during rebalancing
         future._shared_state_code = torch.tensor([ALL_STATES.index(PENDING)], dtype=torch.uint8)
@@ -104,6 +137,8 @@ class PrioritizedTaskPool(threading.Thread):
             exc = ValueError(f"Task size greater than max_batch_size ({self.max_batch_size}), it can't be processed")
             task.future.set_exception(exc)
         else:
+            if self.slab is not None:
+                task = Task(task.priority, task.time_submitted, task.future, self.slab.pack(task.args))
             self.submitted_tasks.put(task)
             self.batch_sender.send(None)  # use this pipe to count the number of unfinished batches
             if (task.priority, task.time_submitted) < self.priority:
@@ -125,20 +160,40 @@ class PrioritizedTaskPool(threading.Thread):
         batch_inputs = [_move_to_device_if_tensor(arg, device, share_memory=False) for arg in task.args]
         self._dispatched_tasks[task.uid] = task
         self.batch_receiver.recv()  # reduce the number of active batches
-        if not self._ordered_tasks.empty():
-            first_remaining_task: Task = self._ordered_tasks.queue[0]
-            self.priority = (first_remaining_task.priority, first_remaining_task.time_submitted)
+        self._on_dispatch([task])
         return task.uid, batch_inputs
 
+    def _on_dispatch(self, tasks: Sequence[Task]):
+        with self._priority_lock:
+            if not self._ordered_tasks.empty():
+                first_remaining_task: Task = self._ordered_tasks.queue[0]
+                self.priority = (first_remaining_task.priority, first_remaining_task.time_submitted)
+            else:
+                self.priority = float("inf"), float("inf")  # the next task to arrive sets it, see run()
+        now = time.monotonic()
+        with self._queue_stats_lock:
+            for task in tasks:
+                self._queue_stats.add(now - task.time_submitted)
+
+    def pop_queue_stats(self) -> QueueStats:
+        """Return statistics of the tasks dispatched since the previous call"""
+        with self._queue_stats_lock:
+            stats, self._queue_stats = self._queue_stats, QueueStats()
+        return stats
+
     def send_outputs_from_runtime(self, uid: int, batch_outputs: List[torch.Tensor]):
         """send results for a processed batch, previously loaded through load_batch_to_runtime"""
-        batch_outputs = [_move_to_device_if_tensor(output, device="cpu", share_memory=True) for output in batch_outputs]
         task = self._dispatched_tasks.pop(uid, None)
         if task is None:
             logger.error(
                 f"Internal error: task task with index {uid} is missing from the dictionary; " f"Could not set result"
             )
         else:
+            if self.slab is not None:
+                batch_outputs = self.slab.pack(batch_outputs)
+            batch_outputs = [
+                _move_to_device_if_tensor(output, device="cpu", share_memory=True) for output in batch_outputs
+            ]
             task.future.set_result(batch_outputs)
 
     def send_exception_from_runtime(self, uid: int, exception: BaseException):
@@ -167,6 +222,107 @@ class PrioritizedTaskPool(threading.Thread):
         self._oldest_undispatched_timestamp.value = float(item[1])
 
 
+class BatchingTaskPool(PrioritizedTaskPool):
+    """
+    A PrioritizedTaskPool that combines compatible tasks into one call of process_func. When Runtime takes the most
+    urgent task, other queued tasks with the same batch key join it (in priority order, up to max_batch_size);
+    they are the tasks that arrived while Runtime was busy with the previous batch.
+
+    :param batch_key: returns a hashable key for task args that can be combined with other tasks, or None
+    :param merge_args: combines the args of several tasks (moved to device) into args of one process_func call
+    :param split_outputs: splits process_func outputs into outputs of each task, given the tasks' args
+    """
+
+    def __init__(
+        self,
+        process_func: callable,
+        *,
+        batch_key: Callable[..., Optional[Hashable]],
+        merge_args: Callable[[Sequence[Sequence[Any]]], Sequence[Any]],
+        split_outputs: Callable[[Sequence[torch.Tensor], Sequence[Sequence[Any]]], Sequence[Sequence[torch.Tensor]]],
+        **kwargs,
+    ):
+        self.batch_key, self.merge_args, self.split_outputs = batch_key, merge_args, split_outputs
+        self._batches: Dict[int, Tuple[List[int], List[Sequence[Any]]]] = {}  # uid -> (task uids, task args)
+        super().__init__(process_func, **kwargs)
+
+    def load_batch_to_runtime(
+        self, timeout: Optional[float] = None, device: Optional[torch.device] = None
+    ) -> Tuple[Any, List[torch.Tensor]]:
+        """receive the next task and the queued tasks it can be batched with"""
+        device = device if device is not None else self.device
+        task = self._ordered_tasks.get(block=True, timeout=timeout)
+        tasks = [task, *self._take_batchable_tasks(task)]
+        tasks_args = []
+        for task in tasks:
+            tasks_args.append([_move_to_device_if_tensor(arg, device, share_memory=False) for arg in task.args])
+            self._dispatched_tasks[task.uid] = task
+            self.batch_receiver.recv()  # reduce the number of active batches
+        self._on_dispatch(tasks)
+        if len(tasks) == 1:
+            return tasks[0].uid, tasks_args[0]
+        self._batches[tasks[0].uid] = [task.uid for task in tasks], tasks_args
+        return tasks[0].uid, self.merge_args(tasks_args)
+
+    def _take_batchable_tasks(self, first_task: Task) -> List[Task]:
+        key = self.batch_key(*first_task.args)
+        if key is None:
+            return []
+        total_size = self.get_task_size(first_task)
+        taken = []
+        with self._ordered_tasks.mutex:
+            queue = self._ordered_tasks.queue
+            for task in sorted(queue):
+                task_size = self.get_task_size(task)
+                if total_size + task_size <= self.max_batch_size and self.batch_key(*task.args) == key:
+                    taken.append(task)
+                    total_size += task_size
+            if taken:
+                taken_uids = {task.uid for task in taken}
+                queue[:] = [task for task in queue if task.uid not in taken_uids]
+                heapq.heapify(queue)
+        return taken
+
+    def send_outputs_from_runtime(self, uid: int, batch_outputs: List[torch.Tensor]):
+        """send results for a processed batch, split into the outputs of each task if it was combined"""
+        batch = self._batches.pop(uid, None)
+        if batch is None:
+            return super().send_outputs_from_runtime(uid, batch_outputs)
+        task_uids, tasks_args = batch
+        for task_uid, task_outputs in zip(task_uids, self.split_outputs(batch_outputs, tasks_args)):
+            super().send_outputs_from_runtime(task_uid, task_outputs)
+
+    def send_exception_from_runtime(self, uid: int, exception: BaseException):
+        batch = self._batches.pop(uid, None)
+        for task_uid in batch[0] if batch is not None else [uid]:
+            super().send_exception_from_runtime(task_uid, exception)
+
+
+class _SlabFuture(MPFuture):
+    """An MPFuture whose result may contain SlabTensor descriptors, replaced with tensors as soon as it arrives"""
+
+    _awaiting_results: Dict[int, "_SlabFuture"] = {}  # keeps futures alive until their slots are freed
+
+    def __init__(self, slab: SharedTensorSlab):
+        super().__init__()
+        self._slab, self._slab_pid = slab, os.getpid()  # not pickled: the runtime's copy of the future sends as usual
+        self._awaiting_results[self._uid] = self
+
+    def _is_local(self) -> bool:
+        return getattr(self, "_slab_pid", None) == os.getpid()
+
+    def set_result(self, result: Sequence[Any]):
+        if self._is_local():
+            self._awaiting_results.pop(self._uid, None)
+            result = list(self._slab.unpack(result))
+        super().set_result(result)
+
+    def set_exception(self, exception: Optional[BaseException]):
+        if self._is_local():
+            self._awaiting_results.pop(self._uid, None)
+        super().set_exception(exception)
+
+
 def _move_to_device_if_tensor(arg: Any, device: Union[torch.device, str], share_memory: bool = False):
     if isinstance(arg, torch.Tensor):
         arg = arg.detach().to(device, non_blocking=not share_memory).requires_grad_(arg.requires_grad)
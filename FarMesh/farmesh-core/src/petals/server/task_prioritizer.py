@@ -1,3 +1,4 @@
+import time
 from abc import ABC, abstractmethod
 
 import torch
@@ -18,3 +19,37 @@ class DummyTaskPrioritizer(TaskPrioritizerBase):
         if kwargs.get("type") == "inference":
             return 1.0
         return 2.0  # Forward, backward
+
+
+class TaskPrioritizer(TaskPrioritizerBase):
+    """
+    Gives each task a deadline: the time it was submitted plus the delay allowed for its kind. Decoding steps are due
+    at once, prefills (inference steps with longer inputs) after prefill_delay, forward and backward passes (e.g., of
+    fine-tuning clients) after forward_delay. Pools process the earliest deadline first, so a task that waits longer
+    than the difference in delays goes before newer, more urgent tasks and no kind of task starves.
+
+    :param max_decode_length: inference steps with at most this many tokens per sequence count as decoding
+      (several tokens per step are typical for speculative decoding)
+    :param seconds_per_point: if positive, each point paid for a task moves its deadline this much earlier
+    :note: priorities are time.monotonic() timestamps, so they are comparable across all handler processes
+    """
+
+    def __init__(
+        self,
+        *,
+        prefill_delay: float = 0.1,
+        forward_delay: float = 1.0,
+        max_decode_length: int = 8,
+        seconds_per_point: float = 0.0,
+    ):
+        self.prefill_delay, self.forward_delay = prefill_delay, forward_delay
+        self.max_decode_length = max_decode_length
+        self.seconds_per_point = seconds_per_point
+
+    def prioritize(self, *input: torch.Tensor, points: float = 0.0, **kwargs) -> float:
+        if kwargs.get("type") == "inference":
+            hidden_states = input[0]
+            delay = 0.0 if hidden_states.shape[1] <= self.max_decode_length else self.prefill_delay
+        else:
+            delay = self.forward_delay  # forward, forward_in_backward, backward
+        return time.monotonic() + delay - self.seconds_per_point * points
@@ -0,0 +1,117 @@
+"""
+Shared-memory transport for the tensors of PrioritizedTaskPool tasks. Connection handlers and the runtime live in
+different processes; sending a tensor through a multiprocessing queue or pipe moves it to a new shared memory
+segment and passes its file descriptor, which costs more than a whole decoding step of a small model.
+
+Instead, the server preallocates one slab of shared memory before forking the handlers and splits it into fixed-size
+slots. The sender copies all tensors of a task (or of its outputs) into one free slot and sends small picklable
+SlabTensor descriptors instead; the receiver copies them out and frees the slot. Tensors that do not fit a slot
+(e.g. long prefills) or arrive when all slots are taken are sent the usual way.
+"""
+import ctypes
+import multiprocessing as mp
+from typing import Any, NamedTuple, Optional, Sequence, Tuple
+
+import torch
+from hivemind.utils import get_logger
+
+from farmesh.utils.misc import get_size_in_bytes
+
+logger = get_logger(__name__)
+
+SLOT_ALIGNMENT = 64  # bytes; keeps every tensor in a slot aligned for any dtype
+SLAB_SLOT_TOKENS = 16  # servers size slots to fit hidden states of this many tokens, e.g. decoding 16 sequences
+SLAB_SLOT_SMALL_TENSORS = 2  # ... and this many small tensors besides their hypo_ids, each up to SLOT_ALIGNMENT bytes
+
+
+def get_slab_slot_bytes(hidden_size: int, dtype: torch.dtype) -> int:
+    """Slot size for a task of SLAB_SLOT_TOKENS tokens: their hidden states, hypo_ids and a few small tensors"""
+    hidden_states_bytes = SLAB_SLOT_TOKENS * hidden_size * get_size_in_bytes(dtype)
+    hypo_ids_bytes = SLAB_SLOT_TOKENS * get_size_in_bytes(torch.int64)
+    aligned_bytes = [
+        -(-num_bytes // SLOT_ALIGNMENT) * SLOT_ALIGNMENT for num_bytes in (hidden_states_bytes, hypo_ids_bytes)
+    ]
+    return sum(aligned_bytes) + SLAB_SLOT_SMALL_TENSORS * SLOT_ALIGNMENT
+
+
+class SlabTensor(NamedTuple):
+    """Descriptor of a tensor stored in a SharedTensorSlab, sent between processes instead of the tensor"""
+
+    slot: int
+    offset: int  # in bytes, from the start of the slot
+    dtype: torch.dtype
+    shape: Tuple[int, ...]
+    requires_grad: bool
+
+
+class SharedTensorSlab:
+    """
+    Shared memory of num_slots * slot_bytes bytes; each slot holds the tensors of one message. Slots are taken in
+    ring order (skipping the ones still in use) under a process-shared lock and freed by the receiver without it.
+
+    :note: create it before forking the processes that use it
+    """
+
+    def __init__(self, num_slots: int, slot_bytes: int):
+        assert num_slots > 0 and slot_bytes > 0
+        self.num_slots = num_slots
+        self.slot_bytes = -(-slot_bytes // SLOT_ALIGNMENT) * SLOT_ALIGNMENT
+        self.buffer = torch.empty(self.num_slots * self.slot_bytes, dtype=torch.uint8).share_memory_()
+        self._slot_busy = mp.RawArray(ctypes.c_bool, self.num_slots)
+        self._next_slot = mp.RawValue(ctypes.c_int64, 0)
+        self._lock = mp.Lock()
+
+    @property
+    def num_free_slots(self) -> int:
+        return self.num_slots - sum(self._slot_busy)
+
+    def pack(self, values: Sequence[Any]) -> Tuple[Any, ...]:
+        """Copy the tensors among values into one free slot and replace them with SlabTensor descriptors"""
+        offsets, total_bytes = {}, 0
+        for i, value in enumerate(values):
+            if isinstance(value, torch.Tensor):
+                offsets[i] = total_bytes
+                total_bytes += -(-value.numel() * value.element_size() // SLOT_ALIGNMENT) * SLOT_ALIGNMENT
+        if not offsets or total_bytes > self.slot_bytes:
+            return tuple(values)
+        slot = self._take_slot()
+        if slot is None:
+            logger.debug("All slots of the shared tensor slab are in use, sending tensors the usual way")
+            return tuple(values)
+
+        packed = list(values)
+        with torch.no_grad():
+            for i, offset in offsets.items():
+                tensor = values[i]
+                descr = SlabTensor(slot, offset, tensor.dtype, tuple(tensor.shape), tensor.requires_grad)
+                self._view(descr).copy_(tensor.detach())
+                packed[i] = descr
+        return tuple(packed)
+
+    def unpack(self, values: Sequence[Any]) -> Tuple[Any, ...]:
+        """Replace SlabTensor descriptors with copies of their tensors and free their slot"""
+        unpacked, slots = list(values), set()
+        for i, value in enumerate(values):
+            if isinstance(value, SlabTensor):
+                unpacked[i] = self._view(value).clone().requires_grad_(value.requires_grad)
+                slots.add(value.slot)
+        for slot in slots:
+            self._slot_busy[slot] = False  # only the receiver frees a slot, so this needs no lock
+        return tuple(unpacked)
+
+    def _take_slot(self) -> Optional[int]:
+        with self._lock:
+            for i in range(self.num_slots):
+                slot = (self._next_slot.value + i) % self.num_slots
+                if not self._slot_busy[slot]:
+                    self._slot_busy[slot] = True
+                    self._next_slot.value = (slot + 1) % self.num_slots
+                    return slot
+        return None
+
+    def _view(self, descr: SlabTensor) -> torch.Tensor:
+        start = descr.slot * self.slot_bytes + descr.offset
+        num_bytes = get_size_in_bytes(descr.dtype)
+        for dim in descr.shape:
+            num_bytes *= dim
+        return self.buffer[start : start + num_bytes].view(descr.dtype).view(descr.shape)
@@ -9,7 +9,9 @@ import pytest_asyncio  # make sure the module exists; otherwise the test will be
 import torch
 from hivemind import TensorDescriptor
 
-from farmesh.server.memory_cache import AllocationFailed, MemoryCache
+from farmesh.server.cache_offload import DISK, HOST, CacheOffloader
+from farmesh.server.memory_cache import PREFIX_OUTPUTS_MAX_SIZE_FRACTION, AllocationFailed, MemoryCache
+from farmesh.server.paged_cache import PagedCacheStore, PagedCacheTensor, PagePool, PrefixHashes
 from farmesh.utils.misc import get_size_in_bytes
 
 
@@ -182,3 +184,192 @@ async def test_cache_usage():
     assert cache.current_size_bytes == 0
     assert alloc_process1.exitcode == 0, "allocation process 1 failed or did not finish, see stderr for details"
     assert alloc_process2.exitcode == 0, "allocation process 2 failed or did not finish, see stderr for details"
+
+
+@pytest.mark.asyncio
+async def test_paged_cache_reservation():
+    cache = MemoryCache(max_size_bytes=1024, max_alloc_timeout=0.5, page_tokens=4)
+    cache.runtime_pid += 1  # pretend we're another process
+    token_descr = TensorDescriptor((2, 8), dtype=torch.float32)  # 64 bytes per token, 256 bytes per page
+
+    async with cache.allocate_cache(token_descr, timeout=0) as handles:
+        assert cache.current_size_bytes == 256  # only the first page is reserved up front
+        await cache.reserve_tokens(handles, 3, timeout=0)
+        assert cache.current_size_bytes == 256
+        await cache.reserve_tokens(handles, 9, timeout=0)
+        assert cache.current_size_bytes == 768
+
+        async with cache.allocate_cache(token_descr, timeout=0) as other_handles:
+            assert cache.current_size_bytes == 1024
+            with pytest.raises(AllocationFailed):
+                await cache.reserve_tokens(other_handles, 5, timeout=0.1)
+        assert cache.current_size_bytes == 768
+    assert cache.current_size_bytes == 0
+
+
+def test_prefix_outputs_budget():
+    cache = MemoryCache(max_size_bytes=1024, page_tokens=4, share_prefixes=True)
+    assert cache.max_size_bytes == 1024 * (1 - PREFIX_OUTPUTS_MAX_SIZE_FRACTION)  # the rest is for block outputs
+    outputs_pool = cache.paged_store.get_pool((8,), torch.float32, "cpu", PREFIX_OUTPUTS_MAX_SIZE_FRACTION)
+    assert outputs_pool.max_pages * outputs_pool.page_bytes <= 1024 - cache.max_size_bytes
+
+
+def test_paged_cache_tensor():
+    store = PagedCacheStore(page_tokens=3)
+    batch_size, num_heads, head_dim = 3, 2, 4
+    tensor = store.make_tensor(TensorDescriptor((batch_size, num_heads, head_dim), dtype=torch.float32))
+    reference = torch.randn(batch_size, 10, num_heads, head_dim)
+
+    tensor.write(reference[:, :7], start=0)
+    tensor.write(reference[:, 7:8], start=7)
+    assert tensor.capacity == 9
+    assert torch.equal(tensor.gather(8), reference[:, :8])
+
+    hypo_ids = torch.tensor([2, 0, 0])
+    tensor.reorder(hypo_ids)
+    reference = reference[hypo_ids]
+    tensor.write(reference[:, 8:10], start=8)
+    assert torch.equal(tensor.gather(10), reference)
+
+    other = store.make_tensor(TensorDescriptor((1, num_heads, head_dim), dtype=torch.float32))
+    other.write(torch.ones(1, 5, num_heads, head_dim), start=0)
+    tensor.release()
+    assert tensor.capacity == 0
+    assert torch.equal(other.gather(5), torch.ones(1, 5, num_heads, head_dim))
+
+
+def test_paged_cache_sharing():
+    pool = PagePool((2,), torch.float32, torch.device("cpu"), page_tokens=2, max_pages=4)
+    first = PagedCacheTensor(pool, batch_size=1)
+    first.write(torch.arange(8.0).view(1, 4, 2), start=0)
+    pool.publish("prefix", first.page_table[0][0])
+
+    second = PagedCacheTensor(pool, batch_size=1)
+    second.ensure_capacity(4)
+    second.share_page(0, 0, pool.find("prefix"))
+    second.write(torch.full((1, 2, 2), -1.0), start=2)
+    assert second.gather(4).tolist() == [[[0, 1], [2, 3], [-1, -1], [-1, -1]]]
+
+    second.write(torch.full((1, 1, 2), 5.0), start=1)  # the shared page is copied before writing
+    assert torch.equal(first.gather(4), torch.arange(8.0).view(1, 4, 2))
+    assert second.gather(2).tolist() == [[[0, 1], [5, 5]]]
+
+    first.release()
+    second.release()
+    assert pool.find("prefix") is not None  # kept after its last reference
+    PagedCacheTensor(pool, batch_size=1).ensure_capacity(8)  # needs every page, so the prefix is evicted
+    assert pool.find("prefix") is None
+
+
+def test_paged_cache_segments():
+    pool = PagePool((2,), torch.float32, torch.device("cpu"), page_tokens=2, max_pages=32)  # 2 pages per segment
+    tensor = PagedCacheTensor(pool, batch_size=3)
+    reference = torch.randn(3, 9, 2)
+    tensor.write(reference[:, :3], start=0)
+    first_page = pool.page(tensor.page_table[0][0])
+    first_page_ptr = first_page.data_ptr()
+
+    tensor.write(reference[:, 3:7], start=3)  # rows span several segments
+    assert len(pool.segments) > 1
+    assert pool.page(tensor.page_table[0][0]).data_ptr() == first_page_ptr  # growing never moves pages
+    assert torch.equal(tensor.gather(7), reference[:, :7])
+
+    hypo_ids = torch.tensor([1, 1, 0])
+    tensor.reorder(hypo_ids)
+    reference = reference[hypo_ids]
+    tensor.write(reference[:, 7:9], start=7)
+    assert torch.equal(tensor.gather(9), reference)
+
+    other = PagedCacheTensor(pool, batch_size=1)
+    other.write(reference[:1, :5], start=0)
+    combined = PagedCacheTensor.concat([tensor, other])
+    assert torch.equal(combined.gather(5), torch.cat([reference[:, :5], reference[:1, :5]]))
+
+
+def test_prefix_hashes_chunks():
+    hidden_states = torch.randn(2, 11, 4)
+    whole = PrefixHashes(batch_size=2, page_tokens=4, salt=b"block")
+    expected = whole.update(hidden_states)
+    assert [page_index for page_index, _ in expected] == [0, 1]
+
+    chunked = PrefixHashes(batch_size=2, page_tokens=4, salt=b"block")
+    assert chunked.update(hidden_states[:, :3]) == []  # no page is complete, nothing is hashed yet
+    assert chunked.update(hidden_states[:, 3:9]) == expected[:2]
+    assert chunked.update(hidden_states[:, 9:]) == []
+    assert chunked.num_tokens == 11
+
+
+@pytest.mark.asyncio
+async def test_cache_allocator_thread():
+    cache = MemoryCache(max_size_bytes=1024)
+    cache.start_allocator()
+    try:
+        cache.runtime_pid += 1  # pretend we're another process
+        async with cache.allocate_cache(TensorDescriptor((4, 8), dtype=torch.float32), timeout=0) as (handle,):
+            await asyncio.sleep(0.3)
+            assert handle in cache._allocated_tensors  # created before the runtime asks for it
+            cache.runtime_pid -= 1
+            with cache.use_cache(handle) as (tensor,):
+                assert tensor.shape == (4, 8) and tensor.dtype == torch.float32
+            cache.runtime_pid += 1
+        await asyncio.sleep(0.3)
+        assert handle not in cache._allocated_tensors
+    finally:
+        cache.runtime_pid -= 1
+        cache.stop_allocator()
+
+
+@pytest.mark.asyncio
+async def test_cache_offload_accounting(tmp_path):
+    cache = MemoryCache(
+        max_size_bytes=1024,
+        max_alloc_timeout=0.2,
+        offload_idle_seconds=0.1,
+        offload_disk_bytes=1024,
+        offload_dir=str(tmp_path),
+    )
+    cache.runtime_pid += 1  # pretend we're another process
+    descr = TensorDescriptor((96, 2), dtype=torch.float32, device=torch.device("cpu"))  # 768 bytes
+
+    async with cache.allocate_cache(descr, timeout=0) as idle_handles:
+        cache.schedule_offload(idle_handles)
+        await asyncio.sleep(0.2)
+        assert cache.current_size_bytes == 0 and cache.get_offloaded_size_bytes(DISK) == 768
+        assert cache.effective_bytes_left == 1024 + 256
+
+        async with cache.allocate_cache(descr, timeout=0):  # fits now that the idle cache is offloaded
+            assert cache.current_size_bytes == 768
+            with pytest.raises(AllocationFailed):
+                await cache.restore(idle_handles)
+            cache.schedule_offload(idle_handles)  # already offloaded, nothing changes
+            assert cache.get_offloaded_size_bytes(DISK) == 768
+
+        await cache.restore(idle_handles)
+        assert cache.current_size_bytes == 768 and cache.get_offloaded_size_bytes(DISK) == 0
+
+        cache.schedule_offload(idle_handles)
+        await cache.restore(idle_handles)  # the client came back in time, the offload is cancelled
+        await asyncio.sleep(0.2)
+        assert cache.current_size_bytes == 768 and cache.get_offloaded_size_bytes(DISK) == 0
+
+        cache.schedule_offload(idle_handles)
+        await asyncio.sleep(0.2)
+    assert cache.current_size_bytes == 0 and cache.get_offloaded_size_bytes(DISK) == 0
+
+
+@pytest.mark.parametrize("tier", [HOST, DISK])
+def test_cache_offloader(tmp_path, tier):
+    offloader = CacheOffloader(str(tmp_path))
+    tensor = torch.randn(3, 4, 5)
+
+    offloaded = offloader.offload(7, tensor, tier)
+    assert offloader.is_offloaded(7) and torch.equal(offloaded, tensor)
+    assert len(list(tmp_path.iterdir())) == (1 if tier == DISK else 0)
+
+    restored = offloader.restore(7, offloaded)
+    assert not offloader.is_offloaded(7) and torch.equal(restored, tensor) and restored.device == tensor.device
+    assert len(list(tmp_path.iterdir())) == 0
+
+    offloader.offload(8, tensor, tier)
+    offloader.discard(8)
+    assert not offloader.is_offloaded(8) and len(list(tmp_path.iterdir())) == 0
@@ -53,6 +53,8 @@ def test_chained_inference_exact_match(atol_inference=1e-4):
     with remote_blocks.inference_session(max_length=inputs.shape[1]) as sess:
         for i in range(inputs.shape[1]):
             outputs_inference.append(sess.step(inputs[:, i : i + 1, :]))
+        contributions = sess.contributions()
+    assert sum(contributions.values()) == 2 * inputs.shape[1]  # blocks 3..5, one token per step
     outputs_inference = torch.cat(outputs_inference, dim=1)
 
     dtype = torch.float32
@@ -0,0 +1,289 @@
+import contextlib
+from itertools import chain
+from typing import Dict, Optional, Sequence, Tuple
+
+import pytest
+import torch
+from hivemind import BatchTensorDescriptor
+from hivemind.utils.nested import nested_pack
+
+from farmesh.data_structures import Handle, InferenceMetadata
+from farmesh.server.backend import TransformerBackend, merge_inference_pools_inplace
+from farmesh.server.block_functions import _get_prefill_chunk_length
+from farmesh.server.block_utils import get_model_block
+from farmesh.server.memory_cache import MemoryCache
+from farmesh.utils.auto_config import AutoDistributedConfig
+from farmesh.utils.convert_block import QuantType, convert_block
+from farmesh.utils.misc import DUMMY_INT64
+from test_utils import MODEL_NAME
+
+
+def _make_backends(
+    num_blocks: int, page_tokens: Optional[int] = None, share_prefixes: bool = False
+) -> Dict[str, TransformerBackend]:
+    """Blocks with random weights served by one runtime on CPU, with their inference pools merged"""
+    config = AutoDistributedConfig.from_pretrained(MODEL_NAME)
+    memory_cache = MemoryCache(max_size_bytes=None, page_tokens=page_tokens, share_prefixes=share_prefixes)
+    backends = {}
+    for block_index in range(num_blocks):
+        block = get_model_block(config, layer_idx=block_index).to(torch.float32)
+        block = convert_block(block, block_index, config, ("cpu",), "cpu", quant_type=QuantType.NONE, freeze=True)
+        schema = (BatchTensorDescriptor(1, 2048, config.hidden_size, dtype=torch.float32),)
+        uid = f"test.{block_index}"
+        backends[uid] = TransformerBackend(
+            uid,
+            block,
+            config=config,
+            memory_cache=memory_cache,
+            backend_dtype=torch.float32,
+            max_chunk_size_bytes=256 * 1024 * 1024,
+            args_schema=schema,
+            kwargs_schema={},
+            outputs_schema=schema,
+            min_batch_size=1,
+            max_batch_size=8192,
+        )
+    merge_inference_pools_inplace(backends)
+    return backends
+
+
+async def _allocate_session(
+    stack: contextlib.AsyncExitStack, backends: Dict[str, TransformerBackend], batch_size: int, max_length: int
+) -> Sequence[Tuple[Handle, ...]]:
+    """Allocate a session's caches in every block the way a connection handler does, return handles per block"""
+    memory_cache = next(iter(backends.values())).memory_cache
+    if memory_cache.page_tokens:
+        descriptors = [backend.get_inference_token_descriptors(batch_size) for backend in backends.values()]
+    else:
+        descriptors = [backend.get_inference_cache_descriptors(batch_size, max_length) for backend in backends.values()]
+    memory_cache.runtime_pid += 1  # pretend we're another process
+    try:
+        handles = await stack.enter_async_context(memory_cache.allocate_cache(*chain(*descriptors), timeout=0))
+    finally:
+        memory_cache.runtime_pid -= 1
+    return [tuple(block_handles) for block_handles in nested_pack(handles, descriptors)]
+
+
+def _make_infos(
+    backends: Dict[str, TransformerBackend], session: Sequence[Tuple[Handle, ...]], prefix_length: int
+) -> Tuple[InferenceMetadata, ...]:
+    return tuple(InferenceMetadata(uid, prefix_length, handles, "") for uid, handles in zip(backends, session))
+
+
+def test_prefill_chunk_length():
+    assert _get_prefill_chunk_length(512, batch_size=1, page_tokens=None) == 512
+    assert _get_prefill_chunk_length(512, batch_size=3, page_tokens=None) == 170  # the limit counts all sequences
+    assert _get_prefill_chunk_length(3, batch_size=4, page_tokens=None) == 1
+    assert _get_prefill_chunk_length(512, batch_size=3, page_tokens=16) == 160  # chunks are whole pages
+    assert _get_prefill_chunk_length(8, batch_size=2, page_tokens=16) == 16
+
+
+@pytest.mark.asyncio
+@pytest.mark.forked
+@pytest.mark.parametrize("page_tokens", [None, 4])
+async def test_chunked_prefill_exact_match(page_tokens: Optional[int], atol: float = 1e-5):
+    backends = _make_backends(num_blocks=1, page_tokens=page_tokens)
+    (backend,) = backends.values()
+    batch_size, prefix_length, length = 2, 5, 23
+    hidden_size = backend.config.hidden_size
+    prompt = torch.randn(batch_size, prefix_length, hidden_size)
+    inputs = torch.randn(batch_size, length + 1, hidden_size)
+    hypo_ids = torch.tensor([1, 0])
+
+    async with contextlib.AsyncExitStack() as stack:
+        whole_session = await _allocate_session(stack, backends, batch_size, max_length=64)
+        chunked_session = await _allocate_session(stack, backends, batch_size, max_length=64)
+        with torch.inference_mode():
+            for session in [whole_session, chunked_session]:
+                (info,) = _make_infos(backends, session, prefix_length=0)
+                backend.inference_step(prompt, DUMMY_INT64, info)
+
+            # chunks as in iterate_rpc_inference: only the first one reorders the cache
+            (info,) = _make_infos(backends, whole_session, prefix_length)
+            (whole_outputs,) = backend.inference_step(inputs[:, :length], hypo_ids, info)
+            chunk_length = _get_prefill_chunk_length(8, batch_size, page_tokens)
+            chunked_outputs = []
+            for offset in range(0, length, chunk_length):
+                (info,) = _make_infos(backends, chunked_session, prefix_length + offset)
+                chunk_hypo_ids = hypo_ids if offset == 0 else DUMMY_INT64
+                chunk = inputs[:, offset : offset + chunk_length]
+                chunked_outputs.extend(backend.inference_step(chunk, chunk_hypo_ids, info))
+            assert len(chunked_outputs) > 1
+            assert torch.allclose(torch.cat(chunked_outputs, dim=1), whole_outputs, rtol=0, atol=atol)
+
+            # the next step reads every cached token, so equal outputs mean the caches match
+            next_outputs = []
+            for session in [whole_session, chunked_session]:
+                (info,) = _make_infos(backends, session, prefix_length + length)
+                next_outputs.extend(backend.inference_step(inputs[:, length:], DUMMY_INT64, info))
+            assert torch.allclose(next_outputs[0], next_outputs[1], rtol=0, atol=atol)
+
+
+@pytest.mark.forked
+def test_reorder_cache_inplace():
+    (backend,) = _make_backends(num_blocks=1).values()
+    batch_size, num_kv_heads, head_dim, max_length, prefix_length = 4, 2, 3, 10, 6
+    keys = torch.randn(batch_size, num_kv_heads, head_dim, max_length)
+    values = torch.randn(batch_size, num_kv_heads, max_length, head_dim)
+
+    # identity, a swap of two beams, beams that take each other's and a third beam's history, one beam for all
+    for hypo_ids in [[0, 1, 2, 3], [1, 0, 2, 3], [3, 3, 0, 1], [2, 2, 2, 2]]:
+        hypo_ids = torch.tensor(hypo_ids)
+        expected_keys, expected_values = keys.clone(), values.clone()
+        expected_keys[..., :prefix_length] = keys[hypo_ids][..., :prefix_length]
+        expected_values[:, :, :prefix_length] = values[hypo_ids][:, :, :prefix_length]  # later tokens are unused
+
+        backend._reorder_cache_inplace([keys, values], hypo_ids, prefix_length)
+        assert torch.equal(keys, expected_keys)
+        assert torch.equal(values, expected_values)
+
+
+@pytest.mark.asyncio
+@pytest.mark.forked
+@pytest.mark.parametrize("page_tokens", [None, 4])
+async def test_fused_decode_step_exact_match(page_tokens: Optional[int]):
+    backends = _make_backends(num_blocks=2, page_tokens=page_tokens)
+    merged_step = next(iter(backends.values())).inference_pool.process_func
+    memory_cache = next(iter(backends.values())).memory_cache
+    batch_size, prefix_length = 2, 7
+    hidden_size = next(iter(backends.values())).config.hidden_size
+    prompt = torch.randn(batch_size, prefix_length, hidden_size)
+
+    async with contextlib.AsyncExitStack() as stack:
+        sessions = [await _allocate_session(stack, backends, batch_size, max_length=32) for _ in range(2)]
+        with torch.inference_mode():
+            for session in sessions:
+                infos = _make_infos(backends, session, prefix_length=0)
+                merged_step(prompt, DUMMY_INT64, infos, *[None] * len(infos))
+
+            all_hypo_ids = [DUMMY_INT64, torch.tensor([1, 0]), torch.tensor([1, 1]), torch.tensor([0, 1])]
+            for step, hypo_ids in enumerate(all_hypo_ids):
+                inputs = torch.randn(batch_size, 1, hidden_size)
+                outputs = []
+                for session, fuse in zip(sessions, [False, True]):
+                    merged_step.fuse_decode_steps = fuse
+                    infos = _make_infos(backends, session, prefix_length + step)
+                    outputs.extend(merged_step(inputs, hypo_ids, infos, *[None] * len(infos)))
+                assert torch.equal(outputs[0], outputs[1]), step
+
+            length = prefix_length + step + 1
+            for (uid, backend), unfused_handles, fused_handles in zip(backends.items(), *sessions):
+                with memory_cache.use_cache(*unfused_handles, *fused_handles) as cache_tensors:
+                    unfused_caches = backend._gather_layer_past(cache_tensors[: len(unfused_handles)], length)
+                    fused_caches = backend._gather_layer_past(cache_tensors[len(unfused_handles) :], length)
+                    for unfused_cache, fused_cache in zip(unfused_caches, fused_caches):
+                        assert torch.equal(unfused_cache, fused_cache), uid
+
+
+@pytest.mark.asyncio
+@pytest.mark.forked
+@pytest.mark.parametrize("page_tokens", [None, 4])
+async def test_batched_decode_step_exact_match(page_tokens: Optional[int], atol: float = 1e-5):
+    backends = _make_backends(num_blocks=2, page_tokens=page_tokens)
+    merged_step = next(iter(backends.values())).inference_pool.process_func
+    memory_cache = next(iter(backends.values())).memory_cache
+    hidden_size = next(iter(backends.values())).config.hidden_size
+    prefix_length, batch_sizes = 6, [1, 2, 3]
+    prompts = [torch.randn(batch_size, prefix_length, hidden_size) for batch_size in batch_sizes]
+
+    async with contextlib.AsyncExitStack() as stack:
+        single_sessions, batched_sessions = [], []  # stepped one at a time and as one batch, with the same inputs
+        for batch_size, prompt in zip(batch_sizes, prompts):
+            for sessions in [single_sessions, batched_sessions]:
+                sessions.append(await _allocate_session(stack, backends, batch_size, max_length=32))
+                infos = _make_infos(backends, sessions[-1], prefix_length=0)
+                with torch.inference_mode():
+                    merged_step(prompt, DUMMY_INT64, infos, *[None] * len(infos))
+
+        with torch.inference_mode():
+            # sessions with and without hypo_ids in the same batch: the batched step offsets them by the rows before
+            all_hypo_ids = [
+                [DUMMY_INT64, torch.tensor([1, 0]), torch.tensor([2, 0, 0])],
+                [torch.tensor([0]), DUMMY_INT64, torch.tensor([1, 2, 1])],
+            ]
+            for step, step_hypo_ids in enumerate(all_hypo_ids):
+                inputs = [torch.randn(batch_size, 1, hidden_size) for batch_size in batch_sizes]
+                single_outputs = []
+                for session, session_inputs, hypo_ids in zip(single_sessions, inputs, step_hypo_ids):
+                    infos = _make_infos(backends, session, prefix_length + step)
+                    single_outputs.extend(merged_step(session_inputs, hypo_ids, infos, *[None] * len(infos)))
+
+                tasks_args = []
+                for session, session_inputs, hypo_ids in zip(batched_sessions, inputs, step_hypo_ids):
+                    infos = _make_infos(backends, session, prefix_length + step)
+                    tasks_args.append((session_inputs, hypo_ids, infos, *[None] * len(infos)))
+                assert len({merged_step.get_batch_key(*args) for args in tasks_args}) == 1
+                batched_outputs = merged_step.split_outputs(
+                    merged_step(*merged_step.merge_args(tasks_args)), tasks_args
+                )
+
+                for single_output, (batched_output,) in zip(single_outputs, batched_outputs):
+                    assert torch.allclose(single_output, batched_output, rtol=0, atol=atol), step
+
+            length = prefix_length + len(all_hypo_ids)
+            for (uid, backend), *block_handles in zip(backends.items(), *single_sessions, *batched_sessions):
+                single_handles, batched_handles = block_handles[: len(batch_sizes)], block_handles[len(batch_sizes) :]
+                for single_session_handles, batched_session_handles in zip(single_handles, batched_handles):
+                    with memory_cache.use_cache(*single_session_handles, *batched_session_handles) as cache_tensors:
+                        num_tensors = len(single_session_handles)
+                        single_caches = backend._gather_layer_past(cache_tensors[:num_tensors], length)
+                        batched_caches = backend._gather_layer_past(cache_tensors[num_tensors:], length)
+                        for single_cache, batched_cache in zip(single_caches, batched_caches):
+                            assert torch.allclose(single_cache, batched_cache, rtol=0, atol=atol), uid
+
+
+@pytest.mark.asyncio
+@pytest.mark.forked
+async def test_shared_prefix_exact_match(atol: float = 1e-5):
+    page_tokens, batch_size = 4, 2
+    backends = _make_backends(num_blocks=1, page_tokens=page_tokens, share_prefixes=True)
+    (backend,) = backends.values()
+    memory_cache = backend.memory_cache
+    hidden_size = backend.config.hidden_size
+    prefix = torch.randn(batch_size, 2 * page_tokens, hidden_size)
+    first_inputs = torch.cat([prefix, torch.randn(batch_size, 3, hidden_size)], dim=1)
+    second_inputs = torch.cat([prefix, torch.randn(batch_size, 5, hidden_size)], dim=1)
+    length = second_inputs.shape[1]
+
+    async with contextlib.AsyncExitStack() as stack:
+        reference, first, second = [await _allocate_session(stack, backends, batch_size, 32) for _ in range(3)]
+        with torch.inference_mode():
+            memory_cache.share_prefixes = False
+            (info,) = _make_infos(backends, reference, prefix_length=0)
+            (reference_outputs,) = backend.inference_step(second_inputs, DUMMY_INT64, info)
+
+            memory_cache.share_prefixes = True
+            (info,) = _make_infos(backends, first, prefix_length=0)
+            backend.inference_step(first_inputs, DUMMY_INT64, info)  # publishes the pages of the common prefix
+            (info,) = _make_infos(backends, second, prefix_length=0)
+            (second_outputs,) = backend.inference_step(second_inputs, DUMMY_INT64, info)
+            assert torch.allclose(second_outputs, reference_outputs, rtol=0, atol=atol)
+
+            (first_handles,), (second_handles,), (reference_handles,) = first, second, reference
+            with memory_cache.use_cache(*first_handles, *second_handles, *reference_handles) as cache_tensors:
+                num_tensors = len(first_handles)
+                first_tensors = cache_tensors[:num_tensors]
+                second_tensors = cache_tensors[num_tensors : 2 * num_tensors]
+                reference_tensors = cache_tensors[2 * num_tensors :]
+                for first_tensor, second_tensor in zip(first_tensors, second_tensors):
+                    for first_row, second_row in zip(first_tensor.page_table, second_tensor.page_table):
+                        assert second_row[:2] == first_row[:2]  # the prefix pages are shared, not recomputed
+                        assert second_row[2] != first_row[2]
+                second_caches = backend._gather_layer_past(second_tensors, length)
+                reference_caches = backend._gather_layer_past(reference_tensors, length)
+                for second_cache, reference_cache in zip(second_caches, reference_caches):
+                    assert torch.allclose(second_cache, reference_cache, rtol=0, atol=atol)
+                first_caches = backend._gather_layer_past(first_tensors, first_inputs.shape[1])
+
+        with torch.inference_mode():
+            # the second session rewinds into a shared page and writes there: the page is copied first
+            rewind_length = page_tokens + 2
+            (info,) = _make_infos(backends, second, prefix_length=rewind_length)
+            backend.inference_step(torch.randn(batch_size, 1, hidden_size), DUMMY_INT64, info)
+            with memory_cache.use_cache(*first_handles, *second_handles) as cache_tensors:
+                for first_tensor, second_tensor in zip(cache_tensors[:num_tensors], cache_tensors[num_tensors:]):
+                    for first_row, second_row in zip(first_tensor.page_table, second_tensor.page_table):
+                        assert second_row[0] == first_row[0] and second_row[1] != first_row[1]
+                first_caches_after = backend._gather_layer_past(cache_tensors[:num_tensors], first_inputs.shape[1])
+                for cache, cache_after in zip(first_caches, first_caches_after):
+                    assert torch.equal(cache, cache_after)  # the first session's cache is unaffected
@@ -6,7 +6,8 @@ import pytest
 import torch
 from hivemind.moe.server.runtime import Runtime
 
-from farmesh.server.task_pool import PrioritizedTaskPool
+from farmesh.server.task_pool import BatchingTaskPool, PrioritizedTaskPool
+from farmesh.server.task_prioritizer import TaskPrioritizer
 
 
 def _submit_tasks(runtime_ready, pools, results_valid):
@@ -80,3 +81,88 @@ def test_priority_pools():
     #                                                  7 - task with priority 11 from pool B
 
     runtime.shutdown()
+
+
+def _submit_batchable_tasks(runtime_ready, pool, results_valid):
+    runtime_ready.wait()
+
+    futures = [pool.submit_task(torch.tensor([[0]]), priority=1)]
+    time.sleep(0.05)  # the runtime is busy with the first task while the others arrive
+    for i in range(1, 6):
+        futures.append(pool.submit_task(torch.full((1, 1 + i % 2), i), priority=1))
+    for i, f in enumerate(futures):
+        assert (f.result()[0] == i**2).all()
+    results_valid.set()
+
+
+@pytest.mark.skipif(platform.system() == "Darwin", reason="Flapping on macOS due to multiprocessing quirks")
+@pytest.mark.forked
+def test_batching_pool():
+    batches_queue = mp.SimpleQueue()
+    runtime_ready = mp.Event()
+    results_valid = mp.Event()
+
+    def dummy_pool_func(x):
+        time.sleep(0.1)
+        batches_queue.put(x[:, 0].tolist())
+        return (x**2,)
+
+    class DummyBackend:
+        def __init__(self, pools):
+            self.pools = pools
+
+        def get_pools(self):
+            return self.pools
+
+    pool = BatchingTaskPool(
+        dummy_pool_func,
+        batch_key=lambda x: x.shape[1],  # only tasks of the same length can be batched
+        merge_args=lambda tasks_args: (torch.cat([x for (x,) in tasks_args]),),
+        split_outputs=lambda outputs, tasks_args: [(y,) for y in outputs[0].split([len(x) for (x,) in tasks_args])],
+        name="A",
+        max_batch_size=4,
+    )
+
+    proc = mp.context.ForkProcess(target=_submit_batchable_tasks, args=(runtime_ready, pool, results_valid))
+    proc.start()
+
+    runtime = Runtime({"0": DummyBackend([pool])}, prefetch_batches=0)
+    runtime.ready = runtime_ready
+    runtime.start()
+
+    proc.join()
+    assert results_valid.is_set()
+
+    batches = []
+    while not batches_queue.empty():
+        batches.append(batches_queue.get())
+    assert batches == [[0], [1, 3], [2, 4], [5]]
+    #                   0 - first task is loaded immediately
+    #                        1, 3 - tasks of length 2; a third one would exceed max_batch_size
+    #                                2, 4 - tasks of length 1 queued after them
+    #                                        5 - the rest
+
+    runtime.shutdown()
+
+
+def test_task_prioritizer():
+    prioritizer = TaskPrioritizer(prefill_delay=0.1, forward_delay=1.0, max_decode_length=2)
+
+    def hidden_states(length: int) -> torch.Tensor:
+        return torch.empty(1, length, 8)
+
+    forward = prioritizer.prioritize(hidden_states(128), points=0, type="forward")
+    prefill = prioritizer.prioritize(hidden_states(128), torch.empty(0), points=0, type="inference")
+    decode = prioritizer.prioritize(hidden_states(2), torch.empty(0), points=0, type="inference")
+    assert decode < prefill < forward
+    assert prioritizer.prioritize(hidden_states(128), points=0, type="backward") > prefill
+
+    # aging: a forward pass goes before decoding steps submitted more than forward_delay later
+    time.sleep(0.2)
+    assert prioritizer.prioritize(hidden_states(1), points=0, type="inference") > prefill
+    assert prioritizer.prioritize(hidden_states(1), points=0, type="inference") < forward
+
+    paying = TaskPrioritizer(seconds_per_point=0.5)
+    assert paying.prioritize(hidden_states(128), points=4, type="forward") < paying.prioritize(
+        hidden_states(1), points=0, type="inference"
+    )
@@ -0,0 +1,84 @@
+import multiprocessing as mp
+import platform
+
+import pytest
+import torch
+from hivemind.moe.server.runtime import Runtime
+
+from farmesh.server.task_pool import PrioritizedTaskPool
+from farmesh.server.task_transport import SLAB_SLOT_TOKENS, SharedTensorSlab, SlabTensor, get_slab_slot_bytes
+
+
+def test_shared_tensor_slab():
+    slab = SharedTensorSlab(num_slots=2, slot_bytes=1000)
+    assert slab.slot_bytes == 1024
+
+    hidden_states = torch.randn(2, 3, 16, dtype=torch.bfloat16, requires_grad=True)
+    hypo_ids = torch.tensor([1, 0])
+    packed = slab.pack((hidden_states, hypo_ids, None, "adapter"))
+    assert isinstance(packed[0], SlabTensor) and isinstance(packed[1], SlabTensor)
+    assert packed[0].slot == packed[1].slot and packed[1].offset % 64 == 0
+    assert packed[2:] == (None, "adapter")
+    assert slab.num_free_slots == 1
+
+    other = slab.pack((torch.ones(4),))
+    assert isinstance(other[0], SlabTensor) and other[0].slot != packed[0].slot
+    assert isinstance(slab.pack((torch.ones(4),))[0], torch.Tensor)  # no free slots: sent the usual way
+
+    unpacked = slab.unpack(packed)
+    assert torch.equal(unpacked[0], hidden_states) and unpacked[0].requires_grad
+    assert torch.equal(unpacked[1], hypo_ids) and unpacked[2:] == (None, "adapter")
+    assert slab.num_free_slots == 1
+    assert torch.equal(slab.unpack(other)[0], torch.ones(4)) and slab.num_free_slots == 2
+
+    too_large = torch.ones(257)
+    assert slab.pack((too_large,))[0] is too_large and slab.num_free_slots == 2
+
+
+def test_slab_slot_fits_decoding_task():
+    hidden_size, dtype = 4096, torch.bfloat16
+    slab = SharedTensorSlab(num_slots=1, slot_bytes=get_slab_slot_bytes(hidden_size, dtype))
+    hidden_states = torch.zeros(SLAB_SLOT_TOKENS, 1, hidden_size, dtype=dtype)
+    hypo_ids = torch.arange(SLAB_SLOT_TOKENS)
+    packed = slab.pack((hidden_states, hypo_ids, torch.zeros(1), None))
+    assert all(isinstance(value, SlabTensor) for value in packed[:3])
+
+
+def _submit_tasks(runtime_ready, pool, results_valid):
+    runtime_ready.wait()
+    futures = [pool.submit_task(torch.full((1, 1, 4), i), torch.tensor([i])) for i in range(8)]
+    futures.append(pool.submit_task(torch.full((1, 64, 4), 8), torch.tensor([8])))  # does not fit a slot
+    for i, f in enumerate(futures):
+        outputs = f.result()
+        assert len(outputs) == 2 and (outputs[0] == i * 2).all() and outputs[1].item() == i
+    results_valid.set()
+
+
+@pytest.mark.skipif(platform.system() == "Darwin", reason="Flapping on macOS due to multiprocessing quirks")
+@pytest.mark.forked
+def test_pool_with_slab():
+    runtime_ready = mp.Event()
+    results_valid = mp.Event()
+
+    class DummyBackend:
+        def __init__(self, pools):
+            self.pools = pools
+
+        def get_pools(self):
+            return self.pools
+
+    slab = SharedTensorSlab(num_slots=4, slot_bytes=256)
+    pool = PrioritizedTaskPool(lambda x, i: (x * 2, i), name="A", max_batch_size=256, slab=slab)
+
+    proc = mp.context.ForkProcess(target=_submit_tasks, args=(runtime_ready, pool, results_valid))
+    proc.start()
+
+    runtime = Runtime({"0": DummyBackend([pool])}, prefetch_batches=0)
+    runtime.ready = runtime_ready
+    runtime.start()
+
+    proc.join()
+    assert results_valid.is_set()
+    assert slab.num_free_slots == slab.num_slots
+
+    runtime.shutdown()
@@ -6,12 +6,20 @@ rate limiting stubs, and unifies API responses for the frontend.
 
 from __future__ import annotations
 
+import asyncio
+import logging
 import os
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import Any, Dict
+
 import jwt
 from fastapi import Depends, FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 import httpx
 
+from common.membership_events import NodeMembership
+
 SERVICE_ROUTES = {
     "inference": "http://inference-service.internal:8000",
     "gaming": "http://gaming-service.internal:8000",
@@ -21,9 +29,69 @@ SERVICE_ROUTES = {
     "staking": "http://staking-service.internal:8000",
     "payments": "http://payments-service.internal:8000",
     "auth": "http://auth-service.internal:8000",
+    "discovery": os.getenv("FAR_DISCOVERY_URL", "http://far-discovery.internal:8080"),
 }
 
-app = FastAPI(title="Far Labs API Gateway", version="1.0.0")
+logger = logging.getLogger(__name__)
+
+
+class MeshNetworkCache:
+    """Far Mesh node membership, kept current by the discovery service's event stream.
+
+    Instead of polling discovery, the gateway follows /api/nodes/events and applies
+    register/capacity/offline events as they arrive, resuming with Last-Event-ID
+    after a dropped connection.
+    """
+
+    def __init__(self, discovery_url: str) -> None:
+        self.discovery_url = discovery_url
+        self.membership = NodeMembership()
+        self.connected = False
+
+    def summary(self) -> Dict[str, Any]:
+        nodes = self.membership.nodes
+        per_model = Counter(node.get("model_id") for node in nodes.values())
+        return {
+            "stream": "connected" if self.connected else "disconnected",
+            "active_nodes": len(nodes),
+            "models": dict(per_model),
+        }
+
+    async def run(self) -> None:
+        delay = 1.0
+        while True:
+            headers = {"Accept": "text/event-stream"}
+            if self.membership.last_event_id is not None:
+                headers["Last-Event-ID"] = self.membership.last_event_id
+            try:
+                async with httpx.AsyncClient(base_url=self.discovery_url, timeout=httpx.Timeout(10.0, read=None)) as client:
+                    async with client.stream("GET", "/api/nodes/events", headers=headers) as response:
+                        response.raise_for_status()
+                        self.connected = True
+                        delay = 1.0
+                        await self.membership.consume(response)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:  # pragma: no cover - network failure path
+                logger.warning("Mesh membership stream error: %s", exc)
+            self.connected = False
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+
+
+mesh_network_cache = MeshNetworkCache(SERVICE_ROUTES["discovery"])
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    task = asyncio.create_task(mesh_network_cache.run())
+    try:
+        yield
+    finally:
+        task.cancel()
+
+
+app = FastAPI(title="Far Labs API Gateway", version="1.0.0", lifespan=lifespan)
 
 ALLOWED_ORIGINS = os.getenv("ALLOWED_ORIGINS", "https://app.farlabs.ai").split(",")
 app.add_middleware(
@@ -120,7 +188,10 @@ async def gpu_proxy(path: str, request: Request):
 
 @app.get("/api/network/status", dependencies=[Depends(authenticate)])
 async def network_status(request: Request):
-    return await proxy_request("inference", "/api/network/status", request)
+    status = await proxy_request("inference", "/api/network/status", request)
+    if isinstance(status, dict):
+        status["far_mesh"] = mesh_network_cache.summary()
+    return status
 
 
 @app.api_route("/api/payments/{path:path}", methods=["GET", "POST", "PUT", "PATCH", "DELETE"], dependencies=[Depends(authenticate)])
@@ -0,0 +1,73 @@
+"""Client side of the discovery service's node membership event stream (/api/nodes/events)."""
+
+from __future__ import annotations
+
+import json
+import logging
+from typing import Any, Callable, Dict, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+class NodeMembership:
+    """Active Far Mesh nodes (node_id -> node), kept current by applying membership events.
+
+    `last_event_id` is the id of the last event consumed; send it as Last-Event-ID when
+    reconnecting so discovery only replays the changes that were missed.
+    """
+
+    def __init__(self) -> None:
+        self.nodes: Dict[str, Dict[str, Any]] = {}
+        self.last_event_id: Optional[str] = None
+
+    def apply(self, event: str, payload: Dict[str, Any]) -> bool:
+        """Apply one event; returns False for events that do not change membership"""
+        if event == "snapshot":
+            self.nodes = {node["node_id"]: node for node in payload["nodes"]}
+        elif event in ("register", "capacity"):
+            self.nodes[payload["node_id"]] = {**self.nodes.get(payload["node_id"], {}), **payload}
+        elif event == "offline":
+            self.nodes.pop(payload["node_id"], None)
+        else:
+            return False
+        return True
+
+    async def consume(
+        self,
+        response: httpx.Response,
+        on_change: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+    ) -> None:
+        """Apply the events of an open event stream until it ends, calling on_change after each applied event"""
+        event, event_id, data = "message", None, []
+
+        async for line in response.aiter_lines():
+            if line.startswith(":"):
+                continue
+            if line:
+                field, _, value = line.partition(":")
+                value = value[1:] if value.startswith(" ") else value
+                if field == "event":
+                    event = value
+                elif field == "id":
+                    event_id = value
+                elif field == "data":
+                    data.append(value)
+                continue
+
+            if data:
+                try:
+                    payload = json.loads("\n".join(data))
+                    applied = self.apply(event, payload)
+                except (ValueError, KeyError) as exc:
+                    logger.warning("Ignoring malformed membership event: %s", exc)
+                    applied = False
+                if applied and on_change is not None:
+                    try:
+                        on_change(event, payload)
+                    except Exception as exc:
+                        logger.warning("Membership change handler failed: %s", exc)
+            if event_id is not None:
+                self.last_event_id = event_id
+            event, event_id, data = "message", None, []
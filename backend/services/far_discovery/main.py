@@ -10,14 +10,19 @@ This service provides:
 """
 
 import asyncio
+import json
 import logging
 import os
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
 from datetime import datetime, timezone
-from typing import List, Optional
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, HTTPException, status
+from fastapi import FastAPI, Header, HTTPException, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 import uvicorn
 import asyncpg
@@ -35,6 +40,20 @@ logger = logging.getLogger(__name__)
 # Database connection pool
 db_pool: Optional[asyncpg.Pool] = None
 
+# Heartbeat ingestion settings
+HEARTBEAT_FLUSH_INTERVAL_SECONDS = float(os.getenv("HEARTBEAT_FLUSH_INTERVAL_SECONDS", "1.0"))
+NODE_STALE_AFTER_SECONDS = float(os.getenv("NODE_STALE_AFTER_SECONDS", "300"))
+HEARTBEAT_FLUSH_BATCH_SIZE = int(os.getenv("HEARTBEAT_FLUSH_BATCH_SIZE", "5000"))
+
+# Active node snapshot settings
+SNAPSHOT_CHANGELOG_SIZE = int(os.getenv("SNAPSHOT_CHANGELOG_SIZE", "10000"))
+SNAPSHOT_FULL_REBUILD_SECONDS = float(os.getenv("SNAPSHOT_FULL_REBUILD_SECONDS", "300"))
+
+# Membership event stream settings
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "1000"))
+EVENT_KEEPALIVE_SECONDS = float(os.getenv("EVENT_KEEPALIVE_SECONDS", "15"))
+CAPACITY_CHANGE_THRESHOLD_GB = float(os.getenv("CAPACITY_CHANGE_THRESHOLD_GB", "1.0"))
+
 
 class NodeRegistration(BaseModel):
     """Node registration request"""
@@ -67,6 +86,423 @@ class NodeInfo(BaseModel):
     uptime_percentage: float
 
 
+@dataclass
+class PendingHeartbeat:
+    """Heartbeat state for one node that has not been written to Postgres yet"""
+    status: str
+    seen_at: float
+    tokens_served: int = 0
+
+
+class HeartbeatAggregator:
+    """
+    Buffers node heartbeats in memory and writes them to Postgres in bulk.
+
+    Repeated heartbeats from the same node between two flushes collapse into a
+    single row update, with their token counts summed. Liveness is tracked in an
+    OrderedDict kept in heartbeat order, so stale detection only touches the
+    nodes that actually went stale instead of scanning the table.
+    """
+
+    def __init__(self, stale_after_seconds: float, batch_size: int):
+        self.stale_after_seconds = stale_after_seconds
+        self.batch_size = max(1, batch_size)
+        self._known: Set[str] = set()
+        self._pending: Dict[str, PendingHeartbeat] = {}
+        self._last_seen: "OrderedDict[str, float]" = OrderedDict()
+
+    def is_known(self, node_id: str) -> bool:
+        return node_id in self._known
+
+    def is_live(self, node_id: str) -> bool:
+        seen_at = self._last_seen.get(node_id)
+        return seen_at is not None and seen_at >= time.time() - self.stale_after_seconds
+
+    def track(self, node_id: str, seen_at: Optional[float] = None) -> None:
+        """Mark a node as registered and alive (on registration or startup seeding)"""
+        self._known.add(node_id)
+        self._touch(node_id, time.time() if seen_at is None else seen_at)
+
+    def record(self, node_id: str, status: str, tokens_served: int) -> None:
+        """Buffer a heartbeat; only the latest status and the summed tokens are kept"""
+        self._known.add(node_id)
+        now = time.time()
+        pending = self._pending.get(node_id)
+        if pending is None:
+            self._pending[node_id] = PendingHeartbeat(status, now, tokens_served)
+        else:
+            pending.status = status
+            pending.seen_at = now
+            pending.tokens_served += tokens_served
+        self._touch(node_id, now)
+
+    def _touch(self, node_id: str, seen_at: float) -> None:
+        self._last_seen[node_id] = seen_at
+        self._last_seen.move_to_end(node_id)
+
+    def pop_stale(self) -> List[str]:
+        """Remove and return nodes whose last heartbeat is older than the stale window"""
+        cutoff = time.time() - self.stale_after_seconds
+        stale = []
+        while self._last_seen:
+            node_id, seen_at = next(iter(self._last_seen.items()))
+            if seen_at >= cutoff:
+                break
+            self._last_seen.popitem(last=False)
+            stale.append(node_id)
+        return stale
+
+    def _restore(self, batch: Dict[str, PendingHeartbeat]) -> None:
+        # A failed flush must not lose token counts: merge them into whatever
+        # arrived while the write was in flight.
+        for node_id, old in batch.items():
+            newer = self._pending.get(node_id)
+            if newer is None:
+                self._pending[node_id] = old
+            else:
+                newer.tokens_served += old.tokens_served
+
+    async def flush(self, pool: asyncpg.Pool) -> List[str]:
+        """
+        Write all buffered heartbeats in bulk and mark stale nodes offline
+
+        Returns the node_ids that were marked offline.
+        """
+        batch, self._pending = self._pending, {}
+        stale = self.pop_stale()
+        if not batch and not stale:
+            return []
+
+        node_ids = list(batch)
+        written = 0
+        try:
+            async with pool.acquire() as conn:
+                # Large fleets are written in bounded shards so a single
+                # statement never holds row locks on the whole table.
+                for start in range(0, len(node_ids), self.batch_size):
+                    shard = node_ids[start:start + self.batch_size]
+                    await conn.execute(
+                        """
+                        UPDATE gpu_nodes AS n
+                        SET last_heartbeat = to_timestamp(v.seen_at),
+                            status = v.status,
+                            total_tokens_processed = COALESCE(n.total_tokens_processed, 0) + v.tokens_served,
+                            updated_at = NOW()
+                        FROM unnest($1::text[], $2::text[], $3::float8[], $4::bigint[])
+                            AS v(node_id, status, seen_at, tokens_served)
+                        WHERE n.node_id = v.node_id
+                        """,
+                        shard,
+                        [batch[node_id].status for node_id in shard],
+                        [batch[node_id].seen_at for node_id in shard],
+                        [batch[node_id].tokens_served for node_id in shard],
+                    )
+                    written += len(shard)
+                if stale:
+                    await conn.execute(
+                        """
+                        UPDATE gpu_nodes
+                        SET status = 'offline'
+                        WHERE node_type = 'far_mesh'
+                        AND status = 'online'
+                        AND node_id = ANY($1::text[])
+                        """,
+                        stale,
+                    )
+                    logger.info(f"Marked {len(stale)} stale node(s) as offline")
+        except Exception:
+            self._restore({node_id: batch[node_id] for node_id in node_ids[written:]})
+            for node_id in stale:
+                if node_id not in self._last_seen:
+                    self._last_seen[node_id] = 0.0
+                    self._last_seen.move_to_end(node_id, last=False)
+            raise
+        return stale
+
+    async def seed(self, pool: asyncpg.Pool) -> None:
+        """Load currently online nodes so liveness survives a service restart"""
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(
+                """
+                SELECT node_id, EXTRACT(EPOCH FROM last_heartbeat) AS seen_at
+                FROM gpu_nodes
+                WHERE node_type = 'far_mesh'
+                AND status = 'online'
+                ORDER BY last_heartbeat ASC
+                """
+            )
+        for row in rows:
+            self.track(row['node_id'], float(row['seen_at'] or 0.0))
+        logger.info(f"✓ Loaded {len(rows)} online node(s) into heartbeat tracker")
+
+
+heartbeats = HeartbeatAggregator(NODE_STALE_AFTER_SECONDS, HEARTBEAT_FLUSH_BATCH_SIZE)
+
+
+class NodeEventBroadcaster:
+    """
+    Fans out node membership events to server-sent event subscribers.
+
+    Each subscriber gets a bounded queue. A subscriber that cannot keep up is
+    cut off (its stream ends) rather than slowing everyone else down; it is
+    expected to reconnect with Last-Event-ID and catch up from the changelog.
+    """
+
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self._subscribers: Dict[asyncio.Queue, Optional[str]] = {}
+
+    def subscribe(self, model_id: Optional[str]) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers[queue] = model_id
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self._subscribers.pop(queue, None)
+
+    def publish(self, event: str, model_id: str, payload: Dict[str, Any], event_id: Optional[int] = None) -> None:
+        for queue, wanted in list(self._subscribers.items()):
+            if wanted is not None and wanted != model_id:
+                continue
+            try:
+                queue.put_nowait((event, event_id, payload))
+            except asyncio.QueueFull:
+                logger.warning("Dropping slow node event subscriber")
+                self.unsubscribe(queue)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+
+broadcaster = NodeEventBroadcaster(EVENT_QUEUE_SIZE)
+
+
+ACTIVE_NODES_QUERY = """
+    SELECT
+        node_id,
+        peer_id,
+        public_address,
+        model_name,
+        num_blocks,
+        status,
+        last_heartbeat,
+        CASE
+            WHEN last_heartbeat > NOW() - INTERVAL '2 minutes' THEN 99.9
+            ELSE 0.0
+        END as uptime_percentage
+    FROM gpu_nodes
+    WHERE node_type = 'far_mesh'
+    AND status = 'online'
+    AND last_heartbeat > NOW() - INTERVAL '5 minutes'
+"""
+
+
+class ActiveNodeSnapshots:
+    """
+    In-memory, versioned view of active Far Mesh nodes, partitioned by model_id.
+
+    Every change that affects what /api/nodes/active would return bumps a global
+    version and is appended to a bounded changelog, so pollers can revalidate with
+    an ETag or fetch only the changes since the version they already have. Only
+    the snapshot builder (refresh) reads from Postgres; request handlers are
+    served from memory.
+
+    last_heartbeat is refreshed whenever a node is rebuilt, but a newer heartbeat
+    alone does not bump the version, which is why the ETag is weak.
+
+    Membership changes are reported to ``on_event(event, model_id, payload,
+    event_id)`` as they are applied: ``register`` for new nodes, ``capacity``
+    for changed nodes, and ``offline`` for nodes that left the snapshot.
+    """
+
+    def __init__(
+        self,
+        changelog_size: int,
+        on_event: Optional[Callable[[str, str, Dict[str, Any], Optional[int]], None]] = None
+    ):
+        self.on_event = on_event
+        self.version = 0
+        self._vram_available: Dict[str, float] = {}
+        self._nodes: Dict[str, NodeInfo] = {}
+        self._by_model: Dict[str, Dict[str, NodeInfo]] = {}
+        self._model_versions: Dict[str, int] = {}
+        self._changelog: Deque[Tuple[int, str, str]] = deque(maxlen=changelog_size)
+        self._rendered: Dict[Optional[str], List[NodeInfo]] = {}
+        self._dirty: Set[str] = set()
+        self._last_full_rebuild: Optional[float] = None
+
+    def etag(self, model_id: Optional[str] = None) -> str:
+        version = self.version if model_id is None else self._model_versions.get(model_id, 0)
+        return f'W/"{version}"'
+
+    def mark_dirty(self, node_id: str) -> None:
+        """Schedule a node to be re-read from the database on the next refresh"""
+        self._dirty.add(node_id)
+
+    def update_capacity(self, node_id: str, vram_available_gb: float) -> None:
+        """Report a capacity event when a node's free VRAM moves by more than the threshold"""
+        node = self._nodes.get(node_id)
+        if node is None:
+            return
+        previous = self._vram_available.get(node_id)
+        if previous is not None and abs(previous - vram_available_gb) < CAPACITY_CHANGE_THRESHOLD_GB:
+            return
+        self._vram_available[node_id] = vram_available_gb
+        if previous is not None:
+            self._emit("capacity", node.model_id, self._payload(node), None)
+
+    def needs_rebuild(self, node_id: str, node_status: str) -> bool:
+        node = self._nodes.get(node_id)
+        return node is None or node.status != node_status
+
+    def active(self, model_id: Optional[str] = None) -> List[NodeInfo]:
+        rendered = self._rendered.get(model_id)
+        if rendered is None:
+            source = self._nodes if model_id is None else self._by_model.get(model_id, {})
+            rendered = sorted(source.values(), key=lambda node: node.last_heartbeat, reverse=True)
+            self._rendered[model_id] = rendered
+        return rendered
+
+    def changes_since(self, since: int, model_id: Optional[str] = None) -> Optional[Tuple[List[NodeInfo], List[str]]]:
+        """
+        Return (upserted, removed) for changes after version ``since``
+
+        Returns None when the changelog no longer reaches back that far and the
+        caller has to fetch the full snapshot instead.
+        """
+        if since > self.version:
+            return None
+        if since < self.version and (not self._changelog or self._changelog[0][0] > since + 1):
+            return None
+
+        touched: Dict[str, str] = {}
+        for version, changed_model, node_id in reversed(self._changelog):
+            if version <= since:
+                break
+            if model_id is None or changed_model == model_id:
+                touched.setdefault(node_id, changed_model)
+
+        upserted = []
+        removed = []
+        for node_id in touched:
+            node = self._nodes.get(node_id)
+            if node is not None and (model_id is None or node.model_id == model_id):
+                upserted.append(node)
+            else:
+                removed.append(node_id)
+        return upserted, removed
+
+    def remove(self, node_ids: Iterable[str]) -> None:
+        for node_id in node_ids:
+            self._dirty.discard(node_id)
+            self._drop(node_id)
+
+    def _drop(self, node_id: str) -> None:
+        node = self._nodes.pop(node_id, None)
+        self._vram_available.pop(node_id, None)
+        if node is None:
+            return
+        self._by_model.get(node.model_id, {}).pop(node_id, None)
+        self._record_change(node.model_id, node_id)
+        self._emit("offline", node.model_id, {"node_id": node_id, "model_id": node.model_id}, self.version)
+
+    def _put(self, node: NodeInfo) -> None:
+        current = self._nodes.get(node.node_id)
+        if current is not None and current.model_id != node.model_id:
+            self._drop(node.node_id)
+            current = None
+
+        self._nodes[node.node_id] = node
+        self._by_model.setdefault(node.model_id, {})[node.node_id] = node
+        self._rendered.pop(None, None)
+        self._rendered.pop(node.model_id, None)
+
+        unchanged = current is not None and (
+            current.model_dump(exclude={"last_heartbeat", "uptime_percentage"})
+            == node.model_dump(exclude={"last_heartbeat", "uptime_percentage"})
+        )
+        if not unchanged:
+            self._record_change(node.model_id, node.node_id)
+            self._emit("register" if current is None else "capacity", node.model_id, self._payload(node), self.version)
+
+    def _payload(self, node: NodeInfo) -> Dict[str, Any]:
+        payload = node.model_dump(mode="json")
+        if node.node_id in self._vram_available:
+            payload["vram_available_gb"] = self._vram_available[node.node_id]
+        return payload
+
+    def _emit(self, event: str, model_id: str, payload: Dict[str, Any], event_id: Optional[int]) -> None:
+        if self.on_event is not None:
+            self.on_event(event, model_id, payload, event_id)
+
+    def _record_change(self, model_id: str, node_id: str) -> None:
+        self.version += 1
+        self._model_versions[model_id] = self.version
+        self._changelog.append((self.version, model_id, node_id))
+        self._rendered.pop(None, None)
+        self._rendered.pop(model_id, None)
+
+    @staticmethod
+    def _to_node_info(row: Any) -> NodeInfo:
+        return NodeInfo(
+            node_id=row['node_id'],
+            peer_id=row['peer_id'],
+            public_addr=row['public_address'],
+            model_id=row['model_name'],
+            num_blocks=row['num_blocks'] or 0,
+            status=row['status'],
+            last_heartbeat=row['last_heartbeat'],
+            uptime_percentage=row['uptime_percentage']
+        )
+
+    async def refresh(self, pool: asyncpg.Pool) -> None:
+        """
+        Snapshot builder: re-read dirty nodes, or everything when a full rebuild is due
+        """
+        full = (
+            self._last_full_rebuild is None
+            or time.monotonic() - self._last_full_rebuild >= SNAPSHOT_FULL_REBUILD_SECONDS
+        )
+        if not full and not self._dirty:
+            return
+
+        dirty, self._dirty = self._dirty, set()
+        try:
+            async with pool.acquire() as conn:
+                if full:
+                    rows = await conn.fetch(ACTIVE_NODES_QUERY)
+                else:
+                    rows = await conn.fetch(
+                        ACTIVE_NODES_QUERY + " AND node_id = ANY($1::text[])",
+                        list(dirty)
+                    )
+        except Exception:
+            self._dirty |= dirty
+            raise
+
+        fresh = {row['node_id']: self._to_node_info(row) for row in rows}
+        scope = set(self._nodes) if full else dirty
+        for node_id in scope - set(fresh):
+            self._drop(node_id)
+        for node in fresh.values():
+            self._put(node)
+
+        if full:
+            self._last_full_rebuild = time.monotonic()
+            logger.info(f"✓ Rebuilt active node snapshot: {len(self._nodes)} node(s), version {self.version}")
+
+
+snapshots = ActiveNodeSnapshots(SNAPSHOT_CHANGELOG_SIZE, on_event=broadcaster.publish)
+
+
+class NodeChanges(BaseModel):
+    """Changes to the active node set since a given version"""
+    version: int
+    reset: bool = False
+    upserted: List[NodeInfo]
+    removed: List[str]
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Startup and shutdown events"""
@@ -87,8 +523,10 @@ async def lifespan(app: FastAPI):
     db_pool = await asyncpg.create_pool(db_url, min_size=2, max_size=10)
     logger.info("✓ Database connected")
 
-    # Start cleanup task
-    cleanup_task = asyncio.create_task(cleanup_stale_nodes())
+    # Start heartbeat flush task
+    await heartbeats.seed(db_pool)
+    await snapshots.refresh(db_pool)
+    flush_task = asyncio.create_task(flush_heartbeats())
 
     logger.info("=" * 60)
     logger.info("✓ Far Discovery Service Ready")
@@ -98,8 +536,16 @@ async def lifespan(app: FastAPI):
 
     # Shutdown
     logger.info("Shutting down Far Discovery Service...")
-    cleanup_task.cancel()
+    flush_task.cancel()
+    try:
+        await flush_task
+    except asyncio.CancelledError:
+        pass
     if db_pool:
+        try:
+            await heartbeats.flush(db_pool)
+        except Exception as e:
+            logger.error(f"Final heartbeat flush failed: {e}")
         await db_pool.close()
     logger.info("✓ Far Discovery Service stopped")
 
@@ -176,6 +622,8 @@ async def register_node(registration: NodeRegistration):
                 existing['node_id']
             )
 
+            heartbeats.track(existing['node_id'])
+            snapshots.mark_dirty(existing['node_id'])
             logger.info(f"Node re-registered: {existing['node_id']} (peer: {registration.peer_id})")
             return {
                 "node_id": existing['node_id'],
@@ -207,6 +655,8 @@ async def register_node(registration: NodeRegistration):
             registration.torch_dtype
         )
 
+        heartbeats.track(node_id)
+        snapshots.mark_dirty(node_id)
         logger.info(f"New node registered: {node_id} (peer: {registration.peer_id}, model: {registration.model_id})")
 
         return {
@@ -222,96 +672,151 @@ async def node_heartbeat(node_id: str, heartbeat: NodeHeartbeat):
     """
     Update node heartbeat and status
 
-    Nodes should send heartbeats every 30 seconds.
+    Nodes should send heartbeats every 30 seconds. Heartbeats are buffered and
+    written to the database in batches every HEARTBEAT_FLUSH_INTERVAL_SECONDS.
     """
-    async with db_pool.acquire() as conn:
-        # Update heartbeat
-        result = await conn.execute(
-            """
-            UPDATE gpu_nodes
-            SET last_heartbeat = NOW(),
-                status = $1,
-                updated_at = NOW()
-            WHERE node_id = $2
-            """,
-            heartbeat.status,
-            node_id
-        )
-
-        if result == "UPDATE 0":
+    if not heartbeats.is_known(node_id):
+        # The node may have been registered before this process started
+        async with db_pool.acquire() as conn:
+            exists = await conn.fetchval(
+                "SELECT 1 FROM gpu_nodes WHERE node_id = $1",
+                node_id
+            )
+        if not exists:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail=f"Node {node_id} not found"
             )
 
-        # Record tokens served if any
-        if heartbeat.tokens_served_since_last > 0:
-            await conn.execute(
-                """
-                UPDATE gpu_nodes
-                SET total_tokens_processed = COALESCE(total_tokens_processed, 0) + $1
-                WHERE node_id = $2
-                """,
-                heartbeat.tokens_served_since_last,
-                node_id
-            )
+    heartbeats.record(node_id, heartbeat.status, max(heartbeat.tokens_served_since_last, 0))
+    snapshots.update_capacity(node_id, heartbeat.vram_available_gb)
+    if snapshots.needs_rebuild(node_id, heartbeat.status):
+        # Rebuilt after the next flush, once the database has the new state
+        snapshots.mark_dirty(node_id)
+
+    return {
+        "status": "ok",
+        "node_id": node_id,
+        "timestamp": datetime.now(timezone.utc).isoformat()
+    }
 
-        return {
-            "status": "ok",
-            "node_id": node_id,
-            "timestamp": datetime.now(timezone.utc).isoformat()
-        }
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match check: '*' or any tag in the comma-separated list, compared weakly (RFC 9110)"""
+    if not if_none_match:
+        return False
+    opaque_tag = etag.removeprefix("W/")
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == opaque_tag:
+            return True
+    return False
 
 
 @app.get("/api/nodes/active", response_model=List[NodeInfo])
-async def get_active_nodes(model_id: Optional[str] = None):
+async def get_active_nodes(
+    response: Response,
+    model_id: Optional[str] = None,
+    if_none_match: Optional[str] = Header(default=None)
+):
     """
     Get list of active Far Mesh nodes
 
-    Optionally filter by model_id.
+    Optionally filter by model_id. Served from the in-memory snapshot with a
+    weak ETag; send it back in If-None-Match to get 304 when nothing changed.
     """
-    async with db_pool.acquire() as conn:
-        query = """
-            SELECT
-                node_id,
-                peer_id,
-                public_address,
-                model_name,
-                num_blocks,
-                status,
-                last_heartbeat,
-                CASE
-                    WHEN last_heartbeat > NOW() - INTERVAL '2 minutes' THEN 99.9
-                    ELSE 0.0
-                END as uptime_percentage
-            FROM gpu_nodes
-            WHERE node_type = 'far_mesh'
-            AND status = 'online'
-            AND last_heartbeat > NOW() - INTERVAL '5 minutes'
-        """
+    etag = snapshots.etag(model_id)
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
 
-        params = []
-        if model_id:
-            query += " AND model_name = $1"
-            params.append(model_id)
-
-        query += " ORDER BY last_heartbeat DESC"
-
-        rows = await conn.fetch(query, *params)
-
-        return [
-            NodeInfo(
-                node_id=row['node_id'],
-                peer_id=row['peer_id'],
-                public_addr=row['public_address'],
-                model_id=row['model_name'],
-                num_blocks=row['num_blocks'] or 0,
-                status=row['status'],
-                last_heartbeat=row['last_heartbeat'],
-                uptime_percentage=row['uptime_percentage']
-            )
-            for row in rows
-        ]
+    response.headers["ETag"] = etag
+    response.headers["X-Snapshot-Version"] = str(snapshots.version)
+    return snapshots.active(model_id)
+
+
+@app.get("/api/nodes/active/changes", response_model=NodeChanges)
+async def get_active_node_changes(since: int, model_id: Optional[str] = None):
+    """
+    Get changes to the active node list since snapshot version ``since``
+
+    If the version is too old for the retained changelog, ``reset`` is true and
+    ``upserted`` holds the full snapshot.
+    """
+    changes = snapshots.changes_since(since, model_id)
+    if changes is None:
+        return NodeChanges(
+            version=snapshots.version,
+            reset=True,
+            upserted=snapshots.active(model_id),
+            removed=[]
+        )
+
+    upserted, removed = changes
+    return NodeChanges(version=snapshots.version, upserted=upserted, removed=removed)
+
+
+def _sse(event: str, payload: Dict[str, Any], event_id: Optional[int] = None) -> str:
+    message = f"event: {event}\n"
+    if event_id is not None:
+        message += f"id: {event_id}\n"
+    return message + f"data: {json.dumps(payload)}\n\n"
+
+
+@app.get("/api/nodes/events")
+async def node_events(
+    request: Request,
+    model_id: Optional[str] = None,
+    last_event_id: Optional[str] = Header(default=None)
+):
+    """
+    Server-sent event stream of membership changes
+
+    Emits ``register``, ``capacity`` and ``offline`` events (optionally for one
+    model_id). A new subscriber first receives a ``snapshot`` event; a client
+    reconnecting with Last-Event-ID receives only the changes it missed, or a
+    fresh ``snapshot`` if the changelog no longer covers them.
+    """
+    queue = broadcaster.subscribe(model_id)
+
+    async def stream() -> AsyncIterator[str]:
+        try:
+            baseline = snapshots.version
+            since = int(last_event_id) if last_event_id and last_event_id.isdigit() else None
+            changes = snapshots.changes_since(since, model_id) if since is not None else None
+            if changes is None:
+                nodes = [node.model_dump(mode="json") for node in snapshots.active(model_id)]
+                yield _sse("snapshot", {"version": baseline, "nodes": nodes}, baseline)
+            else:
+                upserted, removed = changes
+                for node in upserted:
+                    yield _sse("register", node.model_dump(mode="json"), baseline)
+                for removed_id in removed:
+                    yield _sse("offline", {"node_id": removed_id, "model_id": model_id}, baseline)
+
+            while not await request.is_disconnected():
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout=EVENT_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if item is None:
+                    break
+                event, event_id, payload = item
+                if event_id is not None and event_id <= baseline:
+                    continue
+                yield _sse(event, payload, event_id)
+        finally:
+            broadcaster.unsubscribe(queue)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no",
+        }
+    )
 
 
 @app.get("/api/nodes/{node_id}")
@@ -380,32 +885,19 @@ async def get_network_stats():
         }
 
 
-async def cleanup_stale_nodes():
-    """Background task to mark stale nodes as offline"""
+async def flush_heartbeats():
+    """Background task that writes buffered heartbeats and refreshes the node snapshot"""
     while True:
         try:
-            await asyncio.sleep(60)  # Run every minute
-
-            async with db_pool.acquire() as conn:
-                result = await conn.execute(
-                    """
-                    UPDATE gpu_nodes
-                    SET status = 'offline'
-                    WHERE node_type = 'far_mesh'
-                    AND status = 'online'
-                    AND last_heartbeat < NOW() - INTERVAL '5 minutes'
-                    """
-                )
-
-                if result != "UPDATE 0":
-                    count = int(result.split()[-1])
-                    if count > 0:
-                        logger.info(f"Marked {count} stale node(s) as offline")
+            await asyncio.sleep(HEARTBEAT_FLUSH_INTERVAL_SECONDS)
+            stale = await heartbeats.flush(db_pool)
+            snapshots.remove(stale)
+            await snapshots.refresh(db_pool)
 
         except asyncio.CancelledError:
             break
         except Exception as e:
-            logger.error(f"Error in cleanup task: {e}")
+            logger.error(f"Error flushing heartbeats: {e}")
 
 
 if __name__ == "__main__":
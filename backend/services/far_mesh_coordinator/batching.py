@@ -0,0 +1,273 @@
+"""
+Far Mesh Batched Generation
+
+Packs concurrent generation requests for one model into shared multi-row
+FarMesh inference sessions, so GPU nodes see real batches and every request
+stops paying a full mesh round trip per token on its own.
+
+FarMesh servers keep one attention cache per session with a fixed number of
+rows and no padding mask, so rows are grouped when a session opens rather
+than mid-session. Prompts of different lengths still share a session: all
+rows are prefilled up to the shortest prompt, and longer prompts feed their
+remaining tokens one per step while shorter ones are already generating.
+"""
+
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BatchRow:
+    """One generation request occupying a row of a batched session"""
+    input_ids: torch.Tensor  # 1-D prompt token ids
+    max_new_tokens: int
+    temperature: float
+    top_p: float
+    eos_token_id: Optional[int]
+    on_token: Callable[[int], None]
+    on_finish: Callable[[Optional[BaseException]], None]
+    on_prefill: Optional[Callable[[], None]] = None  # Called when the row's session starts prefilling
+    cancelled: threading.Event = field(default_factory=threading.Event)
+    tokens_generated: int = 0
+    contributions: Dict[str, int] = field(default_factory=dict)  # peer_id -> (block, token) pairs
+    inference_session: Optional[Any] = None  # The batch's InferenceSession while the row is active
+    finished: bool = False  # on_finish was called; the row no longer belongs to its batch
+
+    def live_contributions(self) -> Dict[str, int]:
+        """Work per peer so far: final once the row retired, else read from its running session"""
+        if self.contributions or self.inference_session is None:
+            return self.contributions
+        return self.inference_session.contributions()
+
+    @property
+    def prompt_length(self) -> int:
+        return self.input_ids.shape[0]
+
+
+class GenerationBatcher:
+    """
+    Continuous-batching scheduler for a single distributed model.
+
+    Each worker thread owns at most one inference session at a time. A worker
+    picks the oldest waiting request, waits briefly for others to arrive, and
+    packs every compatible request into the same session. Rows retire on EOS,
+    max_new_tokens, or cancellation; the session closes once all rows retired.
+    """
+
+    def __init__(
+        self,
+        model,
+        max_batch_size: int = 16,
+        batch_wait_seconds: float = 0.01,
+        max_prompt_skew: int = 64,
+        num_workers: int = 8,
+        prefill_chunk_tokens: int = 0,
+        on_server_step: Optional[Callable] = None
+    ):
+        """
+        Args:
+            model: FarMesh distributed causal LM
+            max_batch_size: Maximum rows per inference session
+            batch_wait_seconds: How long a new session waits for more requests
+            max_prompt_skew: Maximum prompt length difference within a session
+            num_workers: Inference sessions that may run concurrently
+            prefill_chunk_tokens: Send prompts through the mesh in chunks of this many tokens (0 = whole prompt)
+            on_server_step: Called with (peer_id, seconds, error) after each server step
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.batch_wait_seconds = batch_wait_seconds
+        self.max_prompt_skew = max_prompt_skew
+        self.num_workers = num_workers
+        self.prefill_chunk_tokens = prefill_chunk_tokens
+        self.on_server_step = on_server_step
+
+        self._pending: List[BatchRow] = []
+        self._condition = threading.Condition()
+        self._workers: List[threading.Thread] = []
+        self._stopped = False
+        self.active_rows = 0
+
+    def start(self):
+        """Start the worker threads"""
+        for i in range(self.num_workers):
+            worker = threading.Thread(target=self._work, name=f"farmesh-batch-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self):
+        """Stop accepting work and fail requests that never started"""
+        with self._condition:
+            self._stopped = True
+            pending, self._pending = self._pending, []
+            self._condition.notify_all()
+        for row in pending:
+            _finish(row, RuntimeError("Generation batcher stopped"))
+
+    def submit(self, row: BatchRow):
+        """Queue a request; it joins the next session a worker opens"""
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError("Generation batcher stopped")
+            self._pending.append(row)
+            self._condition.notify()
+
+    @property
+    def queued_rows(self) -> int:
+        return len(self._pending)
+
+    def _work(self):
+        while True:
+            try:
+                rows = self._take_batch()
+            except Exception as e:
+                # Never let a scheduling bug kill the worker; its requests would hang forever
+                logger.exception(f"Taking a batch failed: {e}")
+                time.sleep(self.batch_wait_seconds)
+                continue
+            if rows is None:
+                return
+
+            with self._condition:
+                self.active_rows += len(rows)
+            try:
+                self._run_batch(rows)
+            except Exception as e:
+                logger.error(f"Batched generation failed ({len(rows)} rows): {e}")
+                error = e
+            else:
+                error = None
+            finally:
+                with self._condition:
+                    self.active_rows -= len(rows)
+            # Rows that retired early were finished by _run_batch already
+            for row in rows:
+                if not row.finished:
+                    _finish(row, error)
+
+    def _take_batch(self) -> Optional[List[BatchRow]]:
+        with self._condition:
+            while True:
+                while not self._pending and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return None
+
+                # Give concurrent requests a moment to arrive before the session opens
+                deadline = time.monotonic() + self.batch_wait_seconds
+                while len(self._pending) < self.max_batch_size and not self._stopped:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                if self._stopped:
+                    return None
+                if not self._pending:
+                    continue  # Another worker waiting at the same time took every request
+
+                anchor = self._pending[0].prompt_length
+                batch, rest = [], []
+                for row in self._pending:
+                    if row.cancelled.is_set():
+                        _finish(row, None)
+                    elif len(batch) < self.max_batch_size and abs(row.prompt_length - anchor) <= self.max_prompt_skew:
+                        batch.append(row)
+                    else:
+                        rest.append(row)
+                self._pending = rest
+
+                # Leftovers may be picked up by another idle worker right away
+                if rest:
+                    self._condition.notify()
+                if batch:
+                    return batch
+
+    def _run_batch(self, rows: List[BatchRow]):
+        if not rows:
+            return
+
+        prompt_lengths = [row.prompt_length for row in rows]
+        prefill_length = min(prompt_lengths)
+        max_length = max(row.prompt_length + row.max_new_tokens for row in rows)
+        max_length += getattr(self.model.config, "pre_seq_len", 0) or 0
+
+        # Retired rows keep stepping with a filler token until the session closes
+        filler = next((row.eos_token_id for row in rows if row.eos_token_id is not None), 0)
+        prefix = torch.stack([row.input_ids[:prefill_length] for row in rows])
+        active = [True] * len(rows)
+
+        session_context = self.model.inference_session(max_length=max_length, on_server_step=self.on_server_step)
+        with torch.inference_mode(), session_context as session:
+            for row in rows:
+                row.inference_session = session
+                if row.on_prefill is not None:
+                    row.on_prefill()
+
+            # Chunked prefill bounds each server's peak activation memory for long prompts
+            chunk = self.prefill_chunk_tokens or prefill_length
+            for start in range(0, prefill_length, chunk):
+                logits = self.model(input_ids=prefix[:, start : start + chunk]).logits[:, -1]
+            position = prefill_length
+
+            while True:
+                next_ids = []
+                for i, row in enumerate(rows):
+                    if active[i] and row.cancelled.is_set():
+                        active[i] = False
+                        _retire(row, session)
+
+                    if not active[i]:
+                        next_ids.append(filler)
+                    elif position < prompt_lengths[i]:
+                        # Longer prompts feed their tail while others generate
+                        next_ids.append(int(row.input_ids[position]))
+                    else:
+                        token_id = _sample(logits[i], row.temperature, row.top_p)
+                        next_ids.append(token_id)
+                        row.tokens_generated += 1
+                        row.on_token(token_id)
+                        if token_id == row.eos_token_id or row.tokens_generated >= row.max_new_tokens:
+                            active[i] = False
+                            _retire(row, session)
+
+                if not any(active):
+                    break
+
+                step_ids = torch.tensor(next_ids, dtype=prefix.dtype).unsqueeze(1)
+                logits = self.model(input_ids=step_ids).logits[:, -1]
+                position += 1
+
+
+def _retire(row: BatchRow, session):
+    """Finish a row as soon as it leaves the batch, without waiting for the rest of its session"""
+    # Every row rides every step, so the session's counters at retirement
+    # are exactly this row's share of the work
+    row.contributions = session.contributions()
+    row.inference_session = None
+    _finish(row, None)
+
+
+def _finish(row: BatchRow, error: Optional[BaseException]):
+    row.finished = True
+    row.on_finish(error)
+
+
+def _sample(logits: torch.Tensor, temperature: float, top_p: float) -> int:
+    """Sample one token id with temperature and nucleus (top-p) filtering"""
+    if temperature <= 0:
+        return int(torch.argmax(logits))
+
+    probs = torch.softmax(logits.float() / temperature, dim=-1)
+    sorted_probs, sorted_ids = torch.sort(probs, descending=True)
+    if top_p < 1.0:
+        # Keep the smallest prefix whose cumulative mass reaches top_p
+        sorted_probs[(torch.cumsum(sorted_probs, dim=-1) - sorted_probs) > top_p] = 0
+    choice = torch.multinomial(sorted_probs, num_samples=1)
+    return int(sorted_ids[choice])
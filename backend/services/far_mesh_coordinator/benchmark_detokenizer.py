@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Measure the per-token CPU cost of turning generated token ids into stream text.
+
+Compares decoding each token on its own (what the coordinator used to do),
+re-decoding the whole sequence for every token, and the incremental
+detokenizer the coordinator uses now.
+
+    python benchmark_detokenizer.py --model meta-llama/Llama-2-7b-chat-hf --num_tokens 512
+"""
+
+import argparse
+from time import perf_counter
+
+from transformers import AutoTokenizer
+
+from detokenizer import IncrementalDetokenizer
+
+SAMPLE_TEXT = (
+    "Distributed inference splits a model's layers across GPU nodes. Ünïcödé, emoji 🚀🔥 and "
+    "CJK 分布式推理 make sure multi-byte characters span several tokens. "
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--model", type=str, required=True, help="Tokenizer to benchmark")
+    parser.add_argument("--num_tokens", type=int, default=512, help="Generated tokens per simulated session")
+    parser.add_argument("--repeats", type=int, default=5, help="Sessions to average over")
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    prompt_ids = tokenizer(SAMPLE_TEXT)["input_ids"]
+    token_ids = []
+    while len(token_ids) < args.num_tokens:
+        token_ids += tokenizer(SAMPLE_TEXT, add_special_tokens=False)["input_ids"]
+    token_ids = token_ids[: args.num_tokens]
+
+    def single_token():
+        return "".join(tokenizer.decode([token_id], skip_special_tokens=True) for token_id in token_ids)
+
+    def full_redecode():
+        emitted = ""
+        for end in range(1, len(token_ids) + 1):
+            text = tokenizer.decode(token_ids[:end], skip_special_tokens=True)
+            emitted += text[len(emitted) :]
+        return emitted
+
+    def incremental():
+        detokenizer = IncrementalDetokenizer(tokenizer, prompt_ids)
+        return "".join(detokenizer.add(token_id) for token_id in token_ids)
+
+    expected = tokenizer.decode(token_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+    for name, fn in [("single-token decode", single_token), ("full re-decode", full_redecode), ("incremental", incremental)]:
+        fn()  # Warm up tokenizer caches
+        start = perf_counter()
+        for _ in range(args.repeats):
+            text = fn()
+        per_token_us = (perf_counter() - start) / (args.repeats * len(token_ids)) * 1e6
+        print(f"{name:>20}: {per_token_us:8.1f} us/token, output matches full decode: {text == expected}")
+
+
+if __name__ == "__main__":
+    main()
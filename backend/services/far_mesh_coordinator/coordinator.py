@@ -10,16 +10,21 @@ This is the core service that:
 
 import asyncio
 import logging
-from typing import AsyncIterator, List, Optional, Dict
+import time
+from typing import AsyncIterator, List, Optional, Dict, Set, Union
 from datetime import datetime, timezone
 from decimal import Decimal
-import uuid
 import os
-import torch
+import socket
 import asyncpg
-from farmesh import AutoDistributedModelForCausalLM
-from transformers import AutoTokenizer
 from pydantic import BaseModel
+from batching import BatchRow
+from detokenizer import IncrementalDetokenizer
+from finalizer import SessionFinalizer
+from membership import MembershipSubscriber
+from metrics import CoordinatorMetrics
+from model_pool import ModelPool
+from session_registry import SessionRegistry
 try:
     from farmesh import DistributedBloomForCausalLM
     FARMESH_FINETUNING_AVAILABLE = True
@@ -37,7 +42,7 @@ class InferenceRequest(BaseModel):
     top_p: float = 0.9
     user_wallet: str
     request_id: str
-    model_id: str = "meta-llama/Llama-2-7b-chat-hf"
+    model_id: Optional[str] = None  # Defaults to the coordinator's model
 
 
 class TokenResponse(BaseModel):
@@ -48,6 +53,15 @@ class TokenResponse(BaseModel):
     cost_far: Decimal
 
 
+class StreamStatus(BaseModel):
+    """Progress of a request before (and after) its tokens stream"""
+    request_id: str
+    status: str  # "accepted", "queued", "prefilling", "completed"
+    time_to_first_token_ms: Optional[float] = None
+    decode_tokens_per_second: Optional[float] = None
+    interrupted: Optional[bool] = None  # Cut short because the coordinator is draining
+
+
 class SessionMetrics(BaseModel):
     """Metrics for completed inference session"""
     request_id: str
@@ -84,6 +98,10 @@ class FineTuningStatus(BaseModel):
     estimated_cost_far: Decimal
 
 
+class CoordinatorDraining(Exception):
+    """Raised for new sessions once the coordinator has started draining"""
+
+
 class FarMeshCoordinator:
     """
     Coordinates distributed inference using FarMesh with payment tracking.
@@ -100,18 +118,44 @@ class FarMeshCoordinator:
         model_id: str,
         dht_bootstrap_addr: Optional[str] = None,
         price_per_token_far: Decimal = Decimal("0.0001"),
-        redis_url: str = "redis://localhost:6379",
-        postgres_url: str = "postgresql://localhost/farlabs"
+        redis_url: Optional[str] = None,
+        postgres_url: str = "postgresql://localhost/farlabs",
+        discovery_url: Optional[str] = None,
+        routing_refresh_seconds: float = 5.0,
+        max_concurrent_generations: int = 8,
+        max_batch_size: int = 16,
+        batch_wait_seconds: float = 0.01,
+        model_idle_timeout_seconds: float = 900.0,
+        supported_models: Optional[List[str]] = None,
+        max_resident_models: int = 4,
+        prefill_chunk_tokens: int = 256,
+        drain_timeout_seconds: float = 300.0,
+        replica_id: Optional[str] = None,
+        replica_url: Optional[str] = None,
+        session_registry_ttl_seconds: float = 30.0
     ):
         """
         Initialize the Far Mesh Coordinator.
 
         Args:
-            model_id: HuggingFace model ID (e.g., "meta-llama/Llama-2-7b-chat-hf")
+            model_id: Default HuggingFace model ID (e.g., "meta-llama/Llama-2-7b-chat-hf")
             dht_bootstrap_addr: DHT bootstrap node address (e.g., "/ip4/1.2.3.4/tcp/31337")
             price_per_token_far: Price per generated token in $FAR
-            redis_url: Redis connection URL
+            redis_url: Redis URL for the session registry shared by replicas (optional)
             postgres_url: PostgreSQL connection URL
+            discovery_url: Far Discovery service URL for membership events (optional)
+            routing_refresh_seconds: Membership events refresh a model's routing at most this often
+            max_concurrent_generations: Batched inference sessions that may run at once
+            max_batch_size: Maximum requests packed into one inference session
+            batch_wait_seconds: How long a new session waits for concurrent requests
+            model_idle_timeout_seconds: Evict models with no sessions for this long (0 = never)
+            supported_models: Model ids requests may name besides model_id; others are rejected
+            max_resident_models: Models that may be loaded at the same time
+            prefill_chunk_tokens: Prompt tokens sent through the mesh per prefill step (0 = whole prompt)
+            drain_timeout_seconds: How long shutdown lets active sessions finish before interrupting them
+            replica_id: Unique id of this replica in the session registry (defaults to the hostname)
+            replica_url: Base URL reconnecting clients can reach this replica on
+            session_registry_ttl_seconds: Registry entries expire after this long without a refresh
         """
         self.model_id = model_id
         self.dht_bootstrap_addr = dht_bootstrap_addr
@@ -119,10 +163,53 @@ class FarMeshCoordinator:
         self.redis_url = redis_url
         self.postgres_url = postgres_url
 
-        self.model: Optional[AutoDistributedModelForCausalLM] = None
-        self.tokenizer: Optional[AutoTokenizer] = None
+        self.drain_timeout_seconds = drain_timeout_seconds
+
         self.active_sessions: Dict[str, dict] = {}
+        self._session_rows: Dict[str, BatchRow] = {}
+        self.draining = False
         self.db_pool: Optional[asyncpg.Pool] = None
+        self.finalizer: Optional[SessionFinalizer] = None
+        self.metrics = CoordinatorMetrics()
+
+        # Distributed models are loaded on demand, one per requested model_id.
+        # Concurrent requests are packed into shared multi-row sessions that run
+        # on worker threads, never on the event loop
+        self.models = ModelPool(
+            allowed_models=[model_id, *(supported_models or [])],
+            dht_bootstrap_addr=dht_bootstrap_addr,
+            max_resident_models=max_resident_models,
+            idle_timeout_seconds=model_idle_timeout_seconds,
+            max_concurrent_generations=max_concurrent_generations,
+            max_batch_size=max_batch_size,
+            batch_wait_seconds=batch_wait_seconds,
+            prefill_chunk_tokens=prefill_chunk_tokens,
+            on_server_step=self._on_server_step
+        )
+
+        # Sessions are visible to every replica, so status covers the whole
+        # deployment and reconnecting clients can find the replica that owns them
+        self.replica_id = replica_id or socket.gethostname()
+        self.registry: Optional[SessionRegistry] = None
+        if redis_url:
+            self.registry = SessionRegistry(
+                redis_url,
+                replica_id=self.replica_id,
+                replica_url=replica_url,
+                ttl_seconds=session_registry_ttl_seconds,
+                sessions=self._registry_sessions,
+                summary=self._replica_summary
+            )
+
+        self.routing_refresh_seconds = routing_refresh_seconds
+        self._routing_refreshed_at: Dict[str, float] = {}
+        self._routing_refresh_pending: Set[str] = set()
+        self.membership: Optional[MembershipSubscriber] = None
+        if discovery_url:
+            self.membership = MembershipSubscriber(
+                discovery_url,
+                on_change=self._on_membership_change
+            )
 
         logger.info(f"Initializing Far Mesh Coordinator for model: {model_id}")
 
@@ -150,52 +237,30 @@ class FarMeshCoordinator:
                 command_timeout=60
             )
             logger.info("✓ PostgreSQL connected")
-            logger.info("✓ Coordinator ready (FarMesh will load on first inference request)")
 
-        except Exception as e:
-            logger.error(f"Failed to initialize coordinator: {e}")
-            raise
-
-    async def _ensure_model_loaded(self):
-        """
-        Lazy-load the FarMesh model on first use.
+            # Session bookkeeping is written in the background, off the request path
+            self.finalizer = SessionFinalizer(self.db_pool)
+            self.finalizer.start()
 
-        This prevents blocking startup when no GPU nodes are available.
-        """
-        if self.model is not None:
-            return  # Already loaded
+            # Follow node membership changes pushed by the discovery service
+            if self.membership:
+                self.membership.start()
 
-        logger.info(f"Loading distributed model: {self.model_id}")
+            if self.registry:
+                self.registry.start()
 
-        try:
-            # Load tokenizer (lightweight, runs locally)
-            self.tokenizer = AutoTokenizer.from_pretrained(self.model_id)
-
-            # Set initial_peers for FarMesh DHT
-            # If no bootstrap address is provided, use a placeholder to satisfy FarMesh requirements
-            # FarMesh will create its own standalone DHT if peers list is provided but empty/invalid
-            initial_peers = [self.dht_bootstrap_addr] if self.dht_bootstrap_addr else [""]
-
-            # Connect to FarMesh swarm
-            # This will automatically discover and connect to GPU nodes
-            # serving this model in the DHT network
-            self.model = AutoDistributedModelForCausalLM.from_pretrained(
-                self.model_id,
-                initial_peers=initial_peers,
-                torch_dtype=torch.float16,
-            )
+            self.models.start()
 
-            logger.info(f"✓ Connected to Far Mesh for model: {self.model_id}")
-            logger.info(f"  Active GPU nodes: {self._get_active_nodes_count()}")
+            logger.info("✓ Coordinator ready (FarMesh will load on first inference request)")
 
         except Exception as e:
-            logger.error(f"Failed to load FarMesh model: {e}")
+            logger.error(f"Failed to initialize coordinator: {e}")
             raise
 
     async def generate_streaming(
         self,
         request: InferenceRequest
-    ) -> AsyncIterator[TokenResponse]:
+    ) -> AsyncIterator[Union[StreamStatus, TokenResponse]]:
         """
         Generate tokens using distributed inference with streaming output.
 
@@ -210,68 +275,127 @@ class FarMeshCoordinator:
             request: Inference request parameters
 
         Yields:
-            TokenResponse objects with each generated token
+            StreamStatus updates ("accepted" immediately, "queued", "prefilling",
+            and "completed" with timing), and TokenResponse objects with each
+            generated token
+
+        Raises:
+            CoordinatorDraining: If the coordinator is draining for shutdown
         """
-        session_id = request.request_id
+        if self.draining:
+            raise CoordinatorDraining("Coordinator is draining, retry on another replica")
 
-        # Lazy-load FarMesh model if not already loaded
-        await self._ensure_model_loaded()
+        session_id = request.request_id
+        model_id = request.model_id or self.model_id
+        request_started = time.monotonic()
+        first_token_at: Optional[float] = None
+        last_token_at: Optional[float] = None
+        status = "cancelled"  # Unless the stream completes or fails
+        row: Optional[BatchRow] = None
+        row_finished = False  # The row has left its batch and its contributions are final
+        stream_closed = False  # The stream ended before the row did
+
+        # Let the client know the request is in before any mesh work starts
+        yield StreamStatus(request_id=session_id, status="accepted")
+
+        # Lazy-load the requested FarMesh model if it isn't resident yet
+        resident = await self.models.lease(model_id)
+        tokenizer = resident.tokenizer
 
         # Start tracking session
         session = {
             "request_id": session_id,
             "user_wallet": request.user_wallet,
-            "model_id": request.model_id,
+            "model_id": model_id,
             "started_at": datetime.now(timezone.utc),
             "tokens_generated": 0,
             "cost_far": Decimal("0"),
-            "nodes_used": {}  # Map of peer_id -> total_layers_processed
+            "nodes_used": {}  # Map of peer_id -> (block, token) pairs processed
         }
         self.active_sessions[session_id] = session
+        if self.registry:
+            self.registry.register(session_id, self._registry_entry(session))
 
         try:
-            # Tokenize prompt
-            inputs = self.tokenizer(request.prompt, return_tensors="pt")
+            # Tokenize prompt (off the event loop; long prompts take a while)
+            inputs = await asyncio.to_thread(tokenizer, request.prompt, return_tensors="pt")
             input_ids = inputs["input_ids"]
 
             logger.info(f"[{session_id}] Starting distributed inference")
             logger.info(f"  Prompt length: {input_ids.shape[1]} tokens")
             logger.info(f"  Max new tokens: {request.max_tokens}")
 
-            # Generate tokens using FarMesh distributed inference
-            # The model is split across multiple GPU nodes
-            # Activations are forwarded through the mesh network
-            with torch.inference_mode():
-                for output in self.model.generate(
-                    input_ids,
-                    max_new_tokens=request.max_tokens,
-                    do_sample=True,
-                    temperature=request.temperature,
-                    top_p=request.top_p,
-                    stream=True  # Stream tokens as they're generated
-                ):
-                    # Decode the latest token
-                    token = self.tokenizer.decode(
-                        output[0][-1:],
-                        skip_special_tokens=True
-                    )
+            # Generate tokens using FarMesh distributed inference; the request
+            # shares a batched mesh session with other concurrent requests and
+            # its tokens are handed back through a queue as they are sampled
+            loop = asyncio.get_running_loop()
+            token_queue: asyncio.Queue = asyncio.Queue()
+            detokenizer = IncrementalDetokenizer(tokenizer, input_ids[0].tolist())
+
+            def on_token(token_id: int):
+                # Runs on the generation thread, so decoding never blocks the event loop
+                text = detokenizer.add(token_id)
+                loop.call_soon_threadsafe(token_queue.put_nowait, ("token", text))
+
+            def on_row_finished(error: Optional[BaseException]):
+                # Runs on the event loop once the batch is done with the row
+                nonlocal row_finished
+                row_finished = True
+                if stream_closed:
+                    self._finalize_interrupted(session, row)
+                else:
+                    token_queue.put_nowait(("end", error))
+
+            row = BatchRow(
+                input_ids=input_ids[0],
+                max_new_tokens=request.max_tokens,
+                temperature=request.temperature,
+                top_p=request.top_p,
+                eos_token_id=tokenizer.eos_token_id,
+                on_token=on_token,
+                on_finish=lambda error: loop.call_soon_threadsafe(on_row_finished, error),
+                on_prefill=lambda: loop.call_soon_threadsafe(token_queue.put_nowait, ("prefilling", None))
+            )
+            self._session_rows[session_id] = row
+            resident.batcher.submit(row)
+            yield StreamStatus(request_id=session_id, status="queued")
+
+            try:
+                while True:
+                    kind, value = await token_queue.get()
+                    if kind == "end":
+                        if value is not None:
+                            raise value
+                        # The row is done with the detokenizer, so the text it held back can go out
+                        tail = detokenizer.flush()
+                        if tail:
+                            yield TokenResponse(
+                                token=tail,
+                                request_id=session_id,
+                                tokens_generated=session["tokens_generated"],
+                                cost_far=session["cost_far"]
+                            )
+                        break
+                    if kind == "prefilling":
+                        yield StreamStatus(request_id=session_id, status="prefilling")
+                        continue
+
+                    # Newly stable text (empty while a multi-byte character is incomplete)
+                    token = value
+
+                    now = time.monotonic()
+                    if last_token_at is None:
+                        first_token_at = now
+                        self.metrics.record_first_token(now - request_started)
+                    else:
+                        self.metrics.record_inter_token(now - last_token_at)
+                    last_token_at = now
 
                     # Update session metrics
                     session["tokens_generated"] += 1
                     token_cost = self.price_per_token_far
                     session["cost_far"] += token_cost
 
-                    # Track which nodes contributed with layer counts
-                    # This accesses FarMesh RemoteSequential to get layer-to-peer mapping
-                    contributing_nodes = self._get_contributing_nodes()
-
-                    # Accumulate layer counts for each node across all tokens
-                    for peer_id, layers in contributing_nodes.items():
-                        if peer_id in session["nodes_used"]:
-                            session["nodes_used"][peer_id] += layers
-                        else:
-                            session["nodes_used"][peer_id] = layers
-
                     # Yield token to user
                     yield TokenResponse(
                         token=token,
@@ -280,256 +404,194 @@ class FarMeshCoordinator:
                         cost_far=session["cost_far"]
                     )
 
-            # Session completed successfully
-            await self._finalize_session(session)
+            finally:
+                # If the stream was cancelled (nobody reattached in time), retire its row
+                row.cancelled.set()
+
+            # Work per peer, counted by the inference session on every mesh step
+            session["nodes_used"] = row.contributions
+
+            # Time to first token and decode speed are reported separately
+            decode_rate = None
+            if last_token_at is not None and session["tokens_generated"] > 1 and last_token_at > first_token_at:
+                decode_rate = (session["tokens_generated"] - 1) / (last_token_at - first_token_at)
+                self.metrics.record_decode(session["tokens_generated"] - 1, last_token_at - first_token_at)
+            yield StreamStatus(
+                request_id=session_id,
+                status="completed",
+                time_to_first_token_ms=(first_token_at - request_started) * 1000 if first_token_at else None,
+                decode_tokens_per_second=decode_rate,
+                interrupted=session.get("interrupted")
+            )
+
+            # Session completed successfully (or was cut short by a drain)
+            status = "completed"
+            self._finalize_session(session)
             logger.info(f"[{session_id}] Completed: {session['tokens_generated']} tokens")
 
         except Exception as e:
+            status = "failed"
             logger.error(f"[{session_id}] Inference failed: {e}")
             await self._rollback_session(session)
             raise
 
         finally:
-            # Clean up session
+            if status == "cancelled" and session["tokens_generated"]:
+                # The client never came back (or the server cancelled the stream); the
+                # tokens it already received are still billed, once the row has
+                # left its batch and its contributions are final
+                if row_finished:
+                    self._finalize_interrupted(session, row)
+                else:
+                    stream_closed = True
+
+            # Clean up session (a row still finishing is tracked until it is finalized)
             if session_id in self.active_sessions:
                 del self.active_sessions[session_id]
+                if self.registry:
+                    self.registry.unregister(session_id)
+            if not stream_closed:
+                self._session_rows.pop(session_id, None)
+            self.models.release(resident)
+            self.metrics.record_session(status, time.monotonic() - request_started, session["tokens_generated"])
+
+    def _registry_entry(self, session: dict) -> dict:
+        """What other replicas see of a session in the registry"""
+        row = self._session_rows.get(session["request_id"])
+        return {
+            "model_id": session["model_id"],
+            "user_wallet": session["user_wallet"],
+            "tokens_generated": session["tokens_generated"],
+            "nodes_used": row.live_contributions() if row is not None else {},
+            "started_at": session["started_at"].isoformat()
+        }
+
+    def _registry_sessions(self) -> Dict[str, dict]:
+        return {
+            session_id: self._registry_entry(session)
+            for session_id, session in list(self.active_sessions.items())
+        }
+
+    def _replica_summary(self) -> dict:
+        models: Dict[str, int] = {}
+        for session in list(self.active_sessions.values()):
+            models[session["model_id"]] = models.get(session["model_id"], 0) + 1
+        return {
+            "active_sessions": len(self.active_sessions),
+            "tokens_in_flight": sum(session["tokens_generated"] for session in list(self.active_sessions.values())),
+            "draining": self.draining,
+            "models": models
+        }
 
-    def _get_active_nodes_count(self) -> int:
+    async def find_session(self, session_id: str) -> Optional[dict]:
         """
-        Get count of active GPU nodes serving this model.
+        Locate an in-flight session on any replica.
 
-        This queries the FarMesh DHT to see how many nodes are online.
+        Returns the registry entry (replica id and URL, model, tokens so far,
+        nodes used) with `local` set when this replica owns it, or None if no
+        replica is running the session.
         """
-        try:
-            if self.model and hasattr(self.model, 'dht'):
-                # Access FarMesh DHT to get node count
-                # This is a simplified implementation
-                # Real implementation would query FarMesh internals
-                return len(self.model.dht.get_visible_peers())
-        except:
-            pass
-        return 0
+        session = self.active_sessions.get(session_id)
+        if session is not None:
+            return {
+                **self._registry_entry(session),
+                "replica_id": self.replica_id,
+                "replica_url": self.registry.replica_url if self.registry else None,
+                "local": True
+            }
+        if self.registry:
+            return await self.registry.lookup(session_id)
+        return None
+
+    def _on_membership_change(self, event: str, payload: dict):
+        """
+        Refresh FarMesh routing soon after discovery reports a membership change.
 
-    def _get_contributing_nodes(self) -> Dict[str, int]:
+        Without this the sequence manager only notices joins and departures on its
+        periodic DHT update. A refresh blocks routing until the DHT answers, so
+        bursts of events are coalesced into at most one refresh per model every
+        `routing_refresh_seconds`, and capacity events (which do not change which
+        servers host which blocks) are ignored.
         """
-        Get map of GPU nodes that contributed to the current inference step
-        with their layer counts.
+        if event not in ("register", "offline"):
+            return
 
-        This accesses FarMesh internal routing information to identify which
-        peers handled layers in the distributed inference.
+        for resident in self.models.resident():
+            if payload.get("model_id") not in (None, resident.model_id):
+                continue
+            self._schedule_routing_refresh(resident.model_id)
+
+    def _schedule_routing_refresh(self, model_id: str):
+        if model_id in self._routing_refresh_pending:
+            return  # The pending refresh will see this change too
+        last_refresh = self._routing_refreshed_at.get(model_id, float("-inf"))
+        delay = max(0.0, last_refresh + self.routing_refresh_seconds - time.monotonic())
+        self._routing_refresh_pending.add(model_id)
+        asyncio.get_running_loop().call_later(delay, self._refresh_routing, model_id)
+
+    def _refresh_routing(self, model_id: str):
+        self._routing_refresh_pending.discard(model_id)
+        self._routing_refreshed_at[model_id] = time.monotonic()
+        resident = self.models.get(model_id)
+        sequence_manager = resident.sequence_manager if resident is not None else None
+        if sequence_manager is not None:
+            logger.debug(f"Membership changed, refreshing {model_id} routing")
+            sequence_manager.update(wait=False)
+
+    def _on_server_step(self, peer_id, seconds: float, error: Optional[Exception]):
+        """Record per-peer step latency and failures (called from generation threads)"""
+        self.metrics.record_server_step(peer_id.to_base58() if peer_id is not None else None, seconds, error)
+
+    def _get_active_nodes_count(self, model_id: Optional[str] = None) -> int:
+        """
+        Get count of active GPU nodes serving a model (the default model if not given).
 
-        Returns:
-            Dictionary mapping node peer IDs to number of layers processed
+        Uses the discovery membership stream when it is connected, and falls back
+        to querying the FarMesh DHT otherwise.
         """
-        contributing_nodes = {}
+        model_id = model_id or self.model_id
+        if self.membership and self.membership.connected:
+            return self.membership.count(model_id)
 
         try:
-            if self.model and hasattr(self.model, 'dht'):
-                # Access RemoteSequential to get layer-to-peer mapping
-                # RemoteSequential manages the distributed transformer blocks
-
-                if hasattr(self.model, 'transformer') and hasattr(self.model.transformer, 'h'):
-                    # Get the remote sequence manager
-                    remote_blocks = self.model.transformer.h
-
-                    if hasattr(remote_blocks, 'sequence_manager'):
-                        sequence_manager = remote_blocks.sequence_manager
-
-                        # Get spans (which peers serve which layer ranges)
-                        if hasattr(sequence_manager, 'state') and hasattr(sequence_manager.state, 'spans'):
-                            spans = sequence_manager.state.spans
-
-                            for span in spans:
-                                # Each span contains: peer_id, start_block, end_block
-                                peer_id = str(span.peer_id) if hasattr(span, 'peer_id') else None
-
-                                if peer_id:
-                                    start_block = getattr(span, 'start', 0)
-                                    end_block = getattr(span, 'end', start_block + 1)
-                                    layers_served = end_block - start_block
-
-                                    # Accumulate layers per peer
-                                    if peer_id in contributing_nodes:
-                                        contributing_nodes[peer_id] += layers_served
-                                    else:
-                                        contributing_nodes[peer_id] = layers_served
-
-                            logger.debug(f"Layer-specific tracking: {len(contributing_nodes)} nodes, "
-                                       f"{sum(contributing_nodes.values())} total layers")
-                        else:
-                            # Fallback: get all visible peers with equal weight
-                            logger.debug("Spans not available, using fallback peer detection")
-                            visible_peers = self.model.dht.get_visible_peers() if hasattr(self.model, 'dht') else []
-
-                            for peer in visible_peers:
-                                peer_id = str(peer.peer_id) if hasattr(peer, 'peer_id') else str(peer)
-                                contributing_nodes[peer_id] = 1  # Equal weight as fallback
-                    else:
-                        # Fallback: get all visible peers with equal weight
-                        logger.debug("Sequence manager not available, using fallback")
-                        visible_peers = self.model.dht.get_visible_peers() if hasattr(self.model, 'dht') else []
-
-                        for peer in visible_peers:
-                            peer_id = str(peer.peer_id) if hasattr(peer, 'peer_id') else str(peer)
-                            contributing_nodes[peer_id] = 1  # Equal weight as fallback
-
-        except Exception as e:
-            logger.warning(f"Could not retrieve layer-specific contributions: {e}")
-            logger.debug("Exception details:", exc_info=True)
-
-            # Ultimate fallback: try to get any visible peers
-            try:
-                if self.model and hasattr(self.model, 'dht'):
-                    visible_peers = self.model.dht.get_visible_peers()
-                    for peer in visible_peers:
-                        peer_id = str(peer.peer_id) if hasattr(peer, 'peer_id') else str(peer)
-                        contributing_nodes[peer_id] = 1
-            except:
-                pass
-
-        return contributing_nodes
+            resident = self.models.get(model_id)
+            if resident and hasattr(resident.model, 'dht'):
+                # Access FarMesh DHT to get node count
+                # This is a simplified implementation
+                # Real implementation would query FarMesh internals
+                return len(resident.model.dht.get_visible_peers())
+        except:
+            pass
+        return 0
 
-    async def _finalize_session(self, session: dict):
+    def _finalize_session(self, session: dict):
         """
         Finalize completed inference session and record for payment.
 
-        This:
+        Also used for sessions cut short by a disconnect or a drain, with the
+        tokens generated so far. The session is queued for the background
+        finalizer, which:
         1. Creates session record in far_mesh_sessions table
         2. Records node contributions in far_session_contributions table
         3. Calculates and distributes payment to GPU providers
         4. Updates node statistics
         """
+        if session.get("completed_at") is not None:
+            return  # Already finalized
         session["completed_at"] = datetime.now(timezone.utc)
 
-        if not self.db_pool:
+        if not self.finalizer:
             logger.error("Database pool not initialized, cannot finalize session")
             return
 
-        try:
-            async with self.db_pool.acquire() as conn:
-                # Generate session UUID
-                session_id = uuid.UUID(session["request_id"])
-
-                # 1. Insert session record
-                await conn.execute("""
-                    INSERT INTO far_mesh_sessions (
-                        id, user_wallet, model_id, status,
-                        tokens_generated, total_cost_far,
-                        created_at, completed_at
-                    ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
-                    ON CONFLICT (id) DO UPDATE SET
-                        status = EXCLUDED.status,
-                        tokens_generated = EXCLUDED.tokens_generated,
-                        total_cost_far = EXCLUDED.total_cost_far,
-                        completed_at = EXCLUDED.completed_at
-                """,
-                    session_id,
-                    session["user_wallet"].lower(),
-                    session["model_id"],
-                    "completed",
-                    session["tokens_generated"],
-                    float(session["cost_far"]),
-                    session["started_at"],
-                    session["completed_at"]
-                )
-
-                # 2. Record node contributions with proportional payment
-                nodes_used = session["nodes_used"]  # Dict of peer_id -> layers_processed
-                if nodes_used:
-                    # Calculate total layers processed across all nodes
-                    total_layers = sum(nodes_used.values())
-
-                    if total_layers > 0:
-                        paid_nodes = 0
-
-                        for peer_id, layers_processed in nodes_used.items():
-                            # Calculate payment proportional to work done
-                            # payment = (layers_processed / total_layers) * total_cost
-                            payment_proportion = Decimal(layers_processed) / Decimal(total_layers)
-                            payment_far = session["cost_far"] * payment_proportion
-
-                            # Try to find node by peer_id in far_nodes table
-                            # If node doesn't exist, we'll skip it (node needs to register first)
-                            node_row = await conn.fetchrow("""
-                                SELECT id FROM far_nodes
-                                WHERE peer_id = $1 AND status = 'active'
-                                LIMIT 1
-                            """, peer_id)
-
-                            if node_row:
-                                node_id = node_row['id']
-
-                                # Insert contribution record with proportional payment
-                                await conn.execute("""
-                                    INSERT INTO far_session_contributions (
-                                        session_id, node_id, tokens_contributed, payment_far
-                                    ) VALUES ($1, $2, $3, $4)
-                                    ON CONFLICT (session_id, node_id) DO UPDATE SET
-                                        tokens_contributed = EXCLUDED.tokens_contributed,
-                                        payment_far = EXCLUDED.payment_far
-                                """,
-                                    session_id,
-                                    node_id,
-                                    layers_processed,  # Number of layers this node processed
-                                    float(payment_far)
-                                )
-                                paid_nodes += 1
-
-                                logger.debug(f"Node {peer_id}: {layers_processed} layers "
-                                           f"({payment_proportion:.1%} of work) = {payment_far:.6f} FAR")
-                            else:
-                                logger.warning(f"Node {peer_id} not found in database, skipping payment")
-
-                        logger.info(f"[{session['request_id']}] Payment distribution:")
-                        logger.info(f"  Total layers: {total_layers}")
-                        logger.info(f"  Nodes paid: {paid_nodes}/{len(nodes_used)}")
-                    else:
-                        logger.warning(f"[{session['request_id']}] No layers tracked, using equal distribution")
-                        # Fallback to equal distribution if no layer tracking
-                        payment_per_node = session["cost_far"] / len(nodes_used)
-
-                        for peer_id in nodes_used.keys():
-                            node_row = await conn.fetchrow("""
-                                SELECT id FROM far_nodes
-                                WHERE peer_id = $1 AND status = 'active'
-                                LIMIT 1
-                            """, peer_id)
-
-                            if node_row:
-                                node_id = node_row['id']
-                                await conn.execute("""
-                                    INSERT INTO far_session_contributions (
-                                        session_id, node_id, tokens_contributed, payment_far
-                                    ) VALUES ($1, $2, $3, $4)
-                                    ON CONFLICT (session_id, node_id) DO UPDATE SET
-                                        tokens_contributed = EXCLUDED.tokens_contributed,
-                                        payment_far = EXCLUDED.payment_far
-                                """,
-                                    session_id,
-                                    node_id,
-                                    1,  # Equal contribution
-                                    float(payment_per_node)
-                                )
-
-                    # 3. Call finalize_session PostgreSQL function to update node stats
-                    await conn.execute("""
-                        SELECT finalize_session($1, $2, $3)
-                    """,
-                        session_id,
-                        session["tokens_generated"],
-                        float(session["cost_far"])
-                    )
-
-                    logger.info(f"[{session['request_id']}] Session finalized:")
-                    logger.info(f"  Tokens: {session['tokens_generated']}")
-                    logger.info(f"  Cost: {session['cost_far']} FAR")
-                    logger.info(f"  Nodes: {len(nodes_used)} unique peers")
-                else:
-                    logger.warning(f"[{session['request_id']}] No contributing nodes found")
+        self.finalizer.submit(session)
 
-        except Exception as e:
-            logger.error(f"Failed to finalize session {session['request_id']}: {e}")
-            # Don't raise - we don't want to fail the user's request if DB write fails
+    def _finalize_interrupted(self, session: dict, row: BatchRow):
+        """Finalize a session whose stream ended before its row left the batch"""
+        session["nodes_used"] = row.contributions
+        self._finalize_session(session)
+        self._session_rows.pop(session["request_id"], None)
+        logger.info(f"[{session['request_id']}] Interrupted after {session['tokens_generated']} tokens")
 
     async def _rollback_session(self, session: dict):
         """
@@ -668,28 +730,141 @@ class FarMeshCoordinator:
             "active_nodes": self._get_active_nodes_count(),
             "active_sessions": len(self.active_sessions),
             "price_per_token_far": str(self.price_per_token_far),
-            "status": "connected" if self.model else "disconnected",
+            "status": "connected" if self.models.get(self.model_id) else "disconnected",
+            "membership_stream": "connected" if self.membership and self.membership.connected else "disconnected",
+            "models": [
+                {**model, "active_nodes": self._get_active_nodes_count(model["model_id"])}
+                for model in self.models.status()
+            ],
+            "pending_finalizations": self.finalizer.pending if self.finalizer else 0,
+            "replica_id": self.replica_id,
+            "cluster": await self._cluster_status(),
+            "network_health": self.metrics.network_health(),
             "fine_tuning_available": FARMESH_FINETUNING_AVAILABLE
         }
 
+    async def _cluster_status(self) -> Optional[dict]:
+        """Sessions across all replicas, from the registry (None if there is no registry)"""
+        if not self.registry:
+            return None
+        try:
+            return await self.registry.cluster_status()
+        except Exception as e:
+            logger.warning(f"Failed to read cluster status from the session registry: {e}")
+            return None
+
+    async def get_node_metrics(self) -> List[dict]:
+        """
+        Per-node performance: live step latency and failure counters joined with
+        contribution and earnings totals from far_session_contributions.
+        """
+        live = self.metrics.peer_summaries()
+        rows = []
+        if self.db_pool:
+            async with self.db_pool.acquire() as conn:
+                rows = await conn.fetch("""
+                    SELECT
+                        n.peer_id,
+                        n.status,
+                        COUNT(c.id) AS sessions_served,
+                        COALESCE(SUM(c.tokens_contributed), 0) AS work_units,
+                        COALESCE(SUM(c.payment_far), 0) AS earned_far,
+                        MAX(c.created_at) AS last_contribution_at
+                    FROM far_nodes n
+                    LEFT JOIN far_session_contributions c ON c.node_id = n.id
+                    WHERE n.status = 'active' OR n.peer_id = ANY($1::text[])
+                    GROUP BY n.id, n.peer_id, n.status
+                """, list(live))
+
+        nodes = []
+        for row in rows:
+            last_contribution_at = row["last_contribution_at"]
+            nodes.append({
+                "peer_id": row["peer_id"],
+                "status": row["status"],
+                "sessions_served": row["sessions_served"],
+                "work_units": row["work_units"],
+                "earned_far": str(row["earned_far"]),
+                "last_contribution_at": last_contribution_at.isoformat() if last_contribution_at else None,
+                "live": live.pop(row["peer_id"], None)
+            })
+
+        # Peers seen in the mesh that haven't registered with Far Labs
+        for peer_id, stats in live.items():
+            nodes.append({"peer_id": peer_id, "status": "unregistered", "live": stats})
+
+        return nodes
+
+    def start_drain(self):
+        """
+        Stop admitting new sessions.
+
+        Readiness reports false from here on, so the load balancer stops
+        routing new requests while active sessions keep streaming.
+        """
+        if not self.draining:
+            self.draining = True
+            logger.info(f"Draining: {len(self.active_sessions)} active sessions")
+
+    async def drain(self, timeout: Optional[float] = None, grace_seconds: float = 10.0):
+        """
+        Drain active sessions before shutdown.
+
+        Sessions get up to `timeout` seconds (default `drain_timeout_seconds`)
+        to finish. Any still running after that are interrupted at their next
+        decode step: they end like a completed session, with the tokens
+        generated so far, and are finalized for payment with the contributions
+        recorded up to that step.
+        """
+        self.start_drain()
+        timeout = self.drain_timeout_seconds if timeout is None else timeout
+
+        if not await self._wait_for_sessions(timeout):
+            logger.warning(f"Drain timed out, interrupting {len(self.active_sessions)} sessions")
+            for session_id, session in list(self.active_sessions.items()):
+                session["interrupted"] = True
+                row = self._session_rows.get(session_id)
+                if row is not None:
+                    row.cancelled.set()
+
+            # Interrupted rows retire within a step; let their streams finish
+            if not await self._wait_for_sessions(grace_seconds):
+                logger.warning(f"{len(self.active_sessions)} sessions still open after drain")
+
+    async def _wait_for_sessions(self, timeout: float) -> bool:
+        """Wait until no session or batch row is left; False if `timeout` passed first"""
+        deadline = time.monotonic() + timeout
+        while self.active_sessions or self._session_rows:
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.1)
+        return True
+
     async def shutdown(self):
         """Gracefully shutdown coordinator"""
         logger.info("Shutting down Far Mesh Coordinator")
 
-        # Wait for active sessions to complete (with timeout)
-        if self.active_sessions:
-            logger.info(f"Waiting for {len(self.active_sessions)} active sessions...")
-            await asyncio.sleep(5)  # Grace period
+        # Let active sessions finish (interrupting them at the drain deadline)
+        await self.drain()
+
+        # Stop following membership events
+        if self.membership:
+            await self.membership.stop()
+
+        # Drop this replica from the shared session registry
+        if self.registry:
+            await self.registry.stop()
+
+        # Stop batched generation workers and release resident models
+        await self.models.stop()
+
+        # Write out sessions still waiting to be finalized
+        if self.finalizer:
+            await self.finalizer.stop()
 
         # Close database pool
         if self.db_pool:
             await self.db_pool.close()
             logger.info("✓ Database pool closed")
 
-        # Close FarMesh connection
-        if self.model:
-            # FarMesh doesn't have explicit close, but we can clear references
-            self.model = None
-            self.tokenizer = None
-
         logger.info("Far Mesh Coordinator shutdown complete")
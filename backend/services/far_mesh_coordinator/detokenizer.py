@@ -0,0 +1,62 @@
+"""
+Incremental Detokenization
+
+Turns a stream of generated token ids into text without decoding tokens one
+at a time (which splits multi-byte characters and drops SentencePiece word
+boundaries) and without re-decoding the whole sequence for every token.
+"""
+
+from typing import List, Sequence
+
+# Prompt tokens kept as left context so the first generated token decodes
+# with the right leading space / merge behaviour
+PROMPT_CONTEXT_TOKENS = 5
+
+
+class IncrementalDetokenizer:
+    """
+    Per-session detokenizer that only decodes a short trailing window.
+
+    Two offsets into the token ids are tracked: `prefix_offset` marks the start
+    of the window used as context and `read_offset` the end of the text that
+    was already emitted. Each new token decodes the window with and without
+    the unread tokens and emits the difference once it is stable, i.e. once it
+    no longer ends in an incomplete UTF-8 sequence.
+    """
+
+    def __init__(self, tokenizer, prompt_ids: Sequence[int] = (), skip_special_tokens: bool = True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.token_ids: List[int] = list(prompt_ids[-PROMPT_CONTEXT_TOKENS:])
+        self.prefix_offset = 0
+        self.read_offset = len(self.token_ids)
+
+    def add(self, token_id: int) -> str:
+        """Append a generated token and return the text that became stable (may be empty)"""
+        self.token_ids.append(token_id)
+
+        prefix_text = self._decode(self.token_ids[self.prefix_offset : self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset :])
+
+        # An incomplete byte sequence decodes to U+FFFD; wait for the rest of it
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            return ""
+
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text) :]
+
+    def flush(self) -> str:
+        """Return the text still held back once the stream ends (e.g. an incomplete character as U+FFFD)"""
+        prefix_text = self._decode(self.token_ids[self.prefix_offset : self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset :])
+
+        self.prefix_offset = self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text) :] if len(new_text) > len(prefix_text) else ""
+
+    def _decode(self, token_ids: List[int]) -> str:
+        return self.tokenizer.decode(
+            token_ids,
+            skip_special_tokens=self.skip_special_tokens,
+            clean_up_tokenization_spaces=False
+        )
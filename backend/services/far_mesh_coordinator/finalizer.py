@@ -0,0 +1,187 @@
+"""
+Far Mesh Session Finalization
+
+Records completed inference sessions and their per-node contributions in
+PostgreSQL off the request path. Each session is written in a single
+transaction with a constant number of statements, however many peers
+served it, and failed writes are retried with backoff.
+"""
+
+import asyncio
+import logging
+import uuid
+from decimal import Decimal
+from typing import List
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+
+class SessionFinalizer:
+    """
+    Background queue that persists finished sessions for payment.
+
+    Sessions are written by a fixed number of workers, so a burst of
+    completions never holds more than `concurrency` database connections.
+    """
+
+    def __init__(
+        self,
+        db_pool: asyncpg.Pool,
+        concurrency: int = 4,
+        max_retries: int = 3,
+        retry_delay: float = 0.5,
+        queue_size: int = 10000
+    ):
+        """
+        Args:
+            db_pool: PostgreSQL connection pool
+            concurrency: Sessions written concurrently
+            max_retries: Attempts per session before it is dropped
+            retry_delay: Initial delay between attempts (doubles each retry)
+            queue_size: Maximum sessions waiting to be written
+        """
+        self.db_pool = db_pool
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._workers: List[asyncio.Task] = []
+
+    def start(self):
+        """Start the background writers"""
+        for _ in range(self.concurrency):
+            self._workers.append(asyncio.create_task(self._work()))
+
+    async def stop(self, timeout: float = 10.0):
+        """Write out queued sessions (up to `timeout` seconds), then stop"""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"{self._queue.qsize()} sessions were not finalized before shutdown")
+
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+
+    def submit(self, session: dict):
+        """Queue a completed session for finalization"""
+        try:
+            self._queue.put_nowait(session)
+        except asyncio.QueueFull:
+            logger.error(f"Finalization queue full, dropping session {session['request_id']}")
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    async def _work(self):
+        while True:
+            session = await self._queue.get()
+            try:
+                await self._finalize(session)
+            finally:
+                self._queue.task_done()
+
+    async def _finalize(self, session: dict):
+        delay = self.retry_delay
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                await self._write(session)
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error(f"Failed to finalize session {session['request_id']}: {e}")
+                    return
+                logger.warning(f"Finalizing session {session['request_id']} failed "
+                               f"(attempt {attempt}/{self.max_retries}, retry in {delay:.1f}s): {e}")
+                await asyncio.sleep(delay)
+                delay *= 2
+
+    async def _write(self, session: dict):
+        session_id = uuid.UUID(session["request_id"])
+        nodes_used = session["nodes_used"]  # Dict of peer_id -> (block, token) pairs processed
+
+        # Everything commits together, so a retry never double-counts node stats
+        async with self.db_pool.acquire() as conn:
+            async with conn.transaction():
+                # 1. Insert session record
+                await conn.execute("""
+                    INSERT INTO far_mesh_sessions (
+                        id, user_wallet, model_id, status,
+                        tokens_generated, total_cost_far,
+                        created_at, completed_at
+                    ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+                    ON CONFLICT (id) DO UPDATE SET
+                        status = EXCLUDED.status,
+                        tokens_generated = EXCLUDED.tokens_generated,
+                        total_cost_far = EXCLUDED.total_cost_far,
+                        completed_at = EXCLUDED.completed_at
+                """,
+                    session_id,
+                    session["user_wallet"].lower(),
+                    session["model_id"],
+                    "completed",
+                    session["tokens_generated"],
+                    float(session["cost_far"]),
+                    session["started_at"],
+                    session["completed_at"]
+                )
+
+                if not nodes_used:
+                    logger.warning(f"[{session['request_id']}] No contributing nodes found")
+                    return
+
+                # 2. Resolve every contributing peer in one query
+                # Nodes that haven't registered yet are skipped (they need to register first)
+                rows = await conn.fetch("""
+                    SELECT DISTINCT ON (peer_id) peer_id, id
+                    FROM far_nodes
+                    WHERE peer_id = ANY($1::text[]) AND status = 'active'
+                """, list(nodes_used))
+                node_ids = {row["peer_id"]: row["id"] for row in rows}
+
+                # 3. Record all contributions with payment proportional to work done
+                # payment = (work / total_work) * total_cost; equal split if no work was counted
+                total_work = sum(nodes_used.values())
+                contributors, work, payments = [], [], []
+                for peer_id, units in nodes_used.items():
+                    node_id = node_ids.get(peer_id)
+                    if node_id is None:
+                        logger.warning(f"Node {peer_id} not found in database, skipping payment")
+                        continue
+                    if total_work > 0:
+                        share = Decimal(units) / Decimal(total_work)
+                    else:
+                        units, share = 1, Decimal(1) / Decimal(len(nodes_used))
+                    contributors.append(node_id)
+                    work.append(units)
+                    payments.append(session["cost_far"] * share)
+
+                if contributors:
+                    await conn.execute("""
+                        INSERT INTO far_session_contributions (
+                            session_id, node_id, tokens_contributed, payment_far
+                        )
+                        SELECT $1, c.node_id, c.tokens_contributed, c.payment_far
+                        FROM unnest($2::uuid[], $3::int[], $4::numeric[])
+                            AS c(node_id, tokens_contributed, payment_far)
+                        ON CONFLICT (session_id, node_id) DO UPDATE SET
+                            tokens_contributed = EXCLUDED.tokens_contributed,
+                            payment_far = EXCLUDED.payment_far
+                    """, session_id, contributors, work, payments)
+
+                # 4. Call finalize_session PostgreSQL function to update node stats
+                await conn.execute("""
+                    SELECT finalize_session($1, $2, $3)
+                """,
+                    session_id,
+                    session["tokens_generated"],
+                    float(session["cost_far"])
+                )
+
+        logger.info(f"[{session['request_id']}] Session finalized: {session['tokens_generated']} tokens, "
+                    f"{session['cost_far']} FAR, {len(contributors)}/{len(nodes_used)} nodes paid")
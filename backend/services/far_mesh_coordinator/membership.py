@@ -0,0 +1,109 @@
+"""
+Far Mesh Membership Subscription
+
+Follows the discovery service's server-sent event stream (/api/nodes/events)
+so the coordinator learns about nodes joining, leaving, or changing capacity
+within a second, without polling the discovery service or its database.
+"""
+
+import asyncio
+import logging
+from typing import Any, Callable, Dict, Optional
+
+import httpx
+from common.membership_events import NodeMembership
+
+logger = logging.getLogger(__name__)
+
+
+class MembershipSubscriber:
+    """
+    Maintains a live view of Far Mesh nodes from discovery membership events.
+
+    The subscriber reconnects with exponential backoff and resumes from the last
+    event id it saw, so a dropped connection only replays the changes it missed.
+    """
+
+    def __init__(
+        self,
+        discovery_url: str,
+        model_id: Optional[str] = None,
+        on_change: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+        reconnect_delay: float = 1.0,
+        max_reconnect_delay: float = 30.0
+    ):
+        """
+        Args:
+            discovery_url: Base URL of the discovery service
+            model_id: Only follow nodes serving this model (None = all models)
+            on_change: Called with (event, payload) after each applied event
+            reconnect_delay: Initial delay before reconnecting after a failure
+            max_reconnect_delay: Upper bound for the reconnect backoff
+        """
+        self.discovery_url = discovery_url.rstrip("/")
+        self.model_id = model_id
+        self.on_change = on_change
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+
+        self.membership = NodeMembership()
+        self.connected = False
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start following the event stream in the background"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop following the event stream"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.connected = False
+
+    @property
+    def nodes(self) -> Dict[str, Dict[str, Any]]:
+        return self.membership.nodes
+
+    def count(self, model_id: Optional[str] = None) -> int:
+        """Number of known active nodes, optionally for a single model"""
+        if model_id is None:
+            return len(self.nodes)
+        return sum(1 for node in self.nodes.values() if node.get("model_id") == model_id)
+
+    async def _run(self):
+        delay = self.reconnect_delay
+        params = {"model_id": self.model_id} if self.model_id else {}
+
+        while True:
+            headers = {"Accept": "text/event-stream"}
+            if self.membership.last_event_id is not None:
+                headers["Last-Event-ID"] = self.membership.last_event_id
+
+            try:
+                async with httpx.AsyncClient(timeout=httpx.Timeout(10.0, read=None)) as client:
+                    async with client.stream(
+                        "GET",
+                        f"{self.discovery_url}/api/nodes/events",
+                        params=params,
+                        headers=headers
+                    ) as response:
+                        response.raise_for_status()
+                        self.connected = True
+                        delay = self.reconnect_delay
+                        logger.info(f"✓ Subscribed to node membership events ({self.model_id or 'all models'})")
+                        await self.membership.consume(response, self.on_change)
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Membership stream error: {e}")
+
+            self.connected = False
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
@@ -0,0 +1,224 @@
+"""
+Far Mesh Coordinator Metrics
+
+In-process latency and throughput metrics for the coordinator: request
+level histograms (time to first token, inter-token latency, tokens/s,
+session duration) and per-peer step latency and failure counts reported
+by FarMesh inference sessions. Exposed as JSON and Prometheus text.
+"""
+
+import bisect
+import math
+import threading
+import time
+from typing import Dict, List, Optional
+
+
+def _log_buckets(lowest: float, highest: float, per_power_of_two: int = 4) -> List[float]:
+    """Bucket upper bounds growing geometrically, HDR-style (~19% relative error)"""
+    bounds = []
+    bound = lowest
+    factor = 2 ** (1 / per_power_of_two)
+    while bound < highest:
+        bounds.append(round(bound, 6))
+        bound *= factor
+    bounds.append(highest)
+    return bounds
+
+
+LATENCY_BUCKETS = _log_buckets(0.001, 120.0)    # 1 ms .. 2 min
+DURATION_BUCKETS = _log_buckets(0.01, 3600.0)   # 10 ms .. 1 h
+RATE_BUCKETS = _log_buckets(0.1, 10000.0)       # 0.1 .. 10k tokens/s
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram with geometric bucket bounds.
+
+    Recording is a bisect plus a few integer increments, so it is cheap enough
+    to call for every token and every server step.
+    """
+
+    def __init__(self, bounds: List[float]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # Last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, value: float):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th quantile (capped at the observed max)"""
+        if self.count == 0:
+            return 0.0
+        rank = math.ceil(q * self.count)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                bound = self.bounds[index] if index < len(self.bounds) else self.max
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.50),
+            "p90": self.quantile(0.90),
+            "p99": self.quantile(0.99),
+            "max": self.max
+        }
+
+    def prometheus(self, name: str, labels: str = "") -> List[str]:
+        prefix = f"{labels}," if labels else ""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{prefix}le="{bound:g}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {self.count}')
+        label_set = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{label_set} {self.sum:.6f}")
+        lines.append(f"{name}_count{label_set} {self.count}")
+        return lines
+
+
+class PeerStats:
+    """Step latency and failures for one mesh server"""
+
+    def __init__(self):
+        self.step_seconds = Histogram(LATENCY_BUCKETS)
+        self.failures = 0
+        self.last_seen: Optional[float] = None  # Unix time of the last step attempt
+
+    def summary(self) -> dict:
+        steps = self.step_seconds.count
+        attempts = steps + self.failures
+        return {
+            "steps": steps,
+            "failures": self.failures,
+            "success_rate": steps / attempts if attempts else None,
+            "step_latency_seconds": self.step_seconds.summary(),
+            "last_seen": self.last_seen
+        }
+
+
+class CoordinatorMetrics:
+    """All coordinator metrics; one instance per coordinator"""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.time_to_first_token = Histogram(LATENCY_BUCKETS)
+        self.inter_token_latency = Histogram(LATENCY_BUCKETS)
+        self.tokens_per_second = Histogram(RATE_BUCKETS)
+        self.session_duration = Histogram(DURATION_BUCKETS)
+        self.sessions: Dict[str, int] = {"completed": 0, "failed": 0}
+        self.tokens_total = 0
+        self.peers: Dict[str, PeerStats] = {}
+        self._lock = threading.Lock()
+
+    def record_first_token(self, seconds: float):
+        self.time_to_first_token.record(seconds)
+
+    def record_inter_token(self, seconds: float):
+        self.inter_token_latency.record(seconds)
+
+    def record_session(self, status: str, duration: float, tokens: int):
+        with self._lock:
+            self.sessions[status] = self.sessions.get(status, 0) + 1
+            self.tokens_total += tokens
+        self.session_duration.record(duration)
+
+    def record_decode(self, tokens: int, seconds: float):
+        """Decode speed: tokens after the first over the time spent generating them"""
+        if tokens > 0 and seconds > 0:
+            self.tokens_per_second.record(tokens / seconds)
+
+    def record_server_step(self, peer_id: Optional[str], seconds: float, error: Optional[Exception]):
+        """Called from FarMesh inference sessions after each server step attempt"""
+        if peer_id is None:
+            return
+        stats = self.peers.get(peer_id)
+        if stats is None:
+            with self._lock:
+                stats = self.peers.setdefault(peer_id, PeerStats())
+        stats.last_seen = time.time()
+        if error is None:
+            stats.step_seconds.record(seconds)
+        else:
+            with self._lock:
+                stats.failures += 1
+
+    def network_health(self) -> float:
+        """Percentage of server step attempts that succeeded"""
+        steps = sum(stats.step_seconds.count for stats in list(self.peers.values()))
+        failures = sum(stats.failures for stats in list(self.peers.values()))
+        return 100.0 * steps / (steps + failures) if steps + failures else 100.0
+
+    def peer_summaries(self) -> Dict[str, dict]:
+        return {peer_id: stats.summary() for peer_id, stats in list(self.peers.items())}
+
+    def snapshot(self) -> dict:
+        return {
+            "uptime_seconds": time.time() - self.started_at,
+            "sessions": dict(self.sessions),
+            "tokens_total": self.tokens_total,
+            "time_to_first_token_seconds": self.time_to_first_token.summary(),
+            "inter_token_latency_seconds": self.inter_token_latency.summary(),
+            "tokens_per_second": self.tokens_per_second.summary(),
+            "session_duration_seconds": self.session_duration.summary(),
+            "network_health": self.network_health()
+        }
+
+    def prometheus(self, gauges: Optional[Dict[str, float]] = None) -> str:
+        """Render all metrics in the Prometheus text exposition format"""
+        lines = []
+
+        def histogram(name: str, help_text: str, values: Histogram):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            lines.extend(values.prometheus(name))
+
+        histogram("farmesh_time_to_first_token_seconds", "Time from request to first generated token",
+                  self.time_to_first_token)
+        histogram("farmesh_inter_token_latency_seconds", "Time between consecutive generated tokens",
+                  self.inter_token_latency)
+        histogram("farmesh_tokens_per_second", "Decode throughput per session, excluding time to first token",
+                  self.tokens_per_second)
+        histogram("farmesh_session_duration_seconds", "Inference session duration", self.session_duration)
+
+        lines.append("# HELP farmesh_sessions_total Finished inference sessions")
+        lines.append("# TYPE farmesh_sessions_total counter")
+        for status, count in self.sessions.items():
+            lines.append(f'farmesh_sessions_total{{status="{status}"}} {count}')
+
+        lines.append("# HELP farmesh_tokens_total Generated tokens")
+        lines.append("# TYPE farmesh_tokens_total counter")
+        lines.append(f"farmesh_tokens_total {self.tokens_total}")
+
+        peers = list(self.peers.items())
+        lines.append("# HELP farmesh_peer_step_seconds Inference step latency per mesh server")
+        lines.append("# TYPE farmesh_peer_step_seconds histogram")
+        for peer_id, stats in peers:
+            lines.extend(stats.step_seconds.prometheus("farmesh_peer_step_seconds", f'peer_id="{peer_id}"'))
+
+        lines.append("# HELP farmesh_peer_step_failures_total Failed inference steps per mesh server")
+        lines.append("# TYPE farmesh_peer_step_failures_total counter")
+        for peer_id, stats in peers:
+            lines.append(f'farmesh_peer_step_failures_total{{peer_id="{peer_id}"}} {stats.failures}')
+
+        for name, value in (gauges or {}).items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,269 @@
+"""
+Far Mesh Model Pool
+
+Keeps one FarMesh distributed model (with its tokenizer and generation
+batcher) resident per model_id, so the coordinator can serve every model a
+request names. Concurrent first requests share a single load, and models
+nobody has used for a while are evicted to free their swarm connections.
+"""
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, List, Optional
+
+import torch
+from farmesh import AutoDistributedModelForCausalLM
+from transformers import AutoTokenizer
+
+from batching import GenerationBatcher
+
+logger = logging.getLogger(__name__)
+
+
+class ModelNotAllowed(ValueError):
+    """Raised for a model_id that is not on the pool's allowlist"""
+
+
+class ModelPoolFull(RuntimeError):
+    """Raised when a new model would exceed max_resident_models and none is idle"""
+
+
+@dataclass
+class ResidentModel:
+    """A loaded distributed model and the state needed to serve it"""
+    model_id: str
+    model: AutoDistributedModelForCausalLM
+    tokenizer: AutoTokenizer
+    batcher: GenerationBatcher
+    load_seconds: float
+    loaded_at: datetime
+    last_used: float
+    active_sessions: int = 0
+
+    @property
+    def sequence_manager(self):
+        """The RemoteSequenceManager that routes the model's remote blocks"""
+        for module in self.model.modules():
+            sequence_manager = getattr(module, "sequence_manager", None)
+            if sequence_manager is not None:
+                return sequence_manager
+        return None
+
+
+class ModelPool:
+    """
+    Keyed pool of FarMesh distributed models.
+
+    Loading is single-flight per model_id: the first request starts the load
+    and every concurrent request for the same model waits on it. A model is
+    evicted once it has had no active sessions for `idle_timeout_seconds`.
+
+    Only allowlisted models are loaded, and at most `max_resident_models` at
+    a time: a new model evicts the least recently used idle one, or is refused
+    when every resident model is busy.
+    """
+
+    def __init__(
+        self,
+        allowed_models: Iterable[str],
+        dht_bootstrap_addr: Optional[str] = None,
+        max_resident_models: int = 4,
+        idle_timeout_seconds: float = 900.0,
+        max_concurrent_generations: int = 8,
+        max_batch_size: int = 16,
+        batch_wait_seconds: float = 0.01,
+        prefill_chunk_tokens: int = 0,
+        on_server_step: Optional[Callable] = None
+    ):
+        """
+        Args:
+            allowed_models: Model ids requests may name; others are rejected
+            dht_bootstrap_addr: DHT bootstrap node address
+            max_resident_models: Models that may be loaded at the same time
+            idle_timeout_seconds: Evict models unused for this long (0 = never)
+            max_concurrent_generations: Batched inference sessions per model
+            max_batch_size: Maximum requests packed into one inference session
+            batch_wait_seconds: How long a new session waits for concurrent requests
+            prefill_chunk_tokens: Prompt tokens sent through the mesh per prefill step (0 = whole prompt)
+            on_server_step: Called with (peer_id, seconds, error) after each server step
+        """
+        self.allowed_models = list(dict.fromkeys(allowed_models))
+        self.dht_bootstrap_addr = dht_bootstrap_addr
+        self.max_resident_models = max_resident_models
+        self.idle_timeout_seconds = idle_timeout_seconds
+        self.max_concurrent_generations = max_concurrent_generations
+        self.max_batch_size = max_batch_size
+        self.batch_wait_seconds = batch_wait_seconds
+        self.prefill_chunk_tokens = prefill_chunk_tokens
+        self.on_server_step = on_server_step
+
+        self._resident: Dict[str, ResidentModel] = {}
+        self._loading: Dict[str, asyncio.Task] = {}
+        self._eviction_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start idle eviction in the background"""
+        if self.idle_timeout_seconds > 0 and self._eviction_task is None:
+            self._eviction_task = asyncio.create_task(self._evict_idle())
+
+    async def stop(self):
+        """Stop eviction and release every resident model"""
+        if self._eviction_task is not None:
+            self._eviction_task.cancel()
+            try:
+                await self._eviction_task
+            except asyncio.CancelledError:
+                pass
+            self._eviction_task = None
+
+        for model_id in list(self._resident):
+            self._evict(model_id)
+
+    def get(self, model_id: str) -> Optional[ResidentModel]:
+        """Return the resident model for `model_id` without loading it"""
+        return self._resident.get(model_id)
+
+    def resident(self) -> List[ResidentModel]:
+        return list(self._resident.values())
+
+    def check_allowed(self, model_id: str):
+        """Raise ModelNotAllowed unless requests may use `model_id`"""
+        if model_id not in self.allowed_models:
+            raise ModelNotAllowed(f"Model {model_id} is not served by this coordinator")
+
+    async def acquire(self, model_id: str) -> ResidentModel:
+        """Return the resident model for `model_id`, loading it at most once"""
+        resident = self._resident.get(model_id)
+        if resident is not None:
+            return resident
+
+        task = self._loading.get(model_id)
+        if task is None:
+            self.check_allowed(model_id)
+            self._make_room()
+            task = asyncio.create_task(self._load(model_id))
+            self._loading[model_id] = task
+            task.add_done_callback(lambda _: self._loading.pop(model_id, None))
+
+        # A cancelled waiter must not cancel the load other requests are waiting on
+        return await asyncio.shield(task)
+
+    async def lease(self, model_id: str) -> ResidentModel:
+        """Hold a model for one inference session; pair with release()"""
+        while True:
+            resident = await self.acquire(model_id)
+            # A freshly loaded model may have been evicted before this waiter resumed
+            if self._resident.get(model_id) is resident:
+                resident.active_sessions += 1
+                return resident
+
+    def release(self, resident: ResidentModel):
+        resident.active_sessions -= 1
+        resident.last_used = time.monotonic()
+
+    def status(self) -> List[dict]:
+        """Load time and activity of each resident model"""
+        now = time.monotonic()
+        return [
+            {
+                "model_id": resident.model_id,
+                "load_time_seconds": round(resident.load_seconds, 2),
+                "loaded_at": resident.loaded_at.isoformat(),
+                "active_sessions": resident.active_sessions,
+                "idle_seconds": 0 if resident.active_sessions else round(now - resident.last_used, 1),
+                "batched_rows": resident.batcher.active_rows,
+                "queued_rows": resident.batcher.queued_rows
+            }
+            for resident in self._resident.values()
+        ]
+
+    def _make_room(self):
+        """Evict the least recently used idle model if a new one would exceed max_resident_models"""
+        if len(self._resident) + len(self._loading) < self.max_resident_models:
+            return
+        idle = [resident for resident in self._resident.values() if resident.active_sessions == 0]
+        if not idle:
+            raise ModelPoolFull(f"All {self.max_resident_models} resident models are serving sessions, retry later")
+        resident = min(idle, key=lambda resident: resident.last_used)
+        logger.info(f"Evicting model {resident.model_id} to make room")
+        self._evict(resident.model_id)
+
+    async def _load(self, model_id: str) -> ResidentModel:
+        logger.info(f"Loading distributed model: {model_id}")
+        started = time.monotonic()
+
+        try:
+            # Loading downloads weights and joins the DHT; keep it off the event loop
+            tokenizer, model = await asyncio.to_thread(self._load_blocking, model_id)
+        except Exception as e:
+            logger.error(f"Failed to load FarMesh model {model_id}: {e}")
+            raise
+
+        batcher = GenerationBatcher(
+            model,
+            max_batch_size=self.max_batch_size,
+            batch_wait_seconds=self.batch_wait_seconds,
+            num_workers=self.max_concurrent_generations,
+            prefill_chunk_tokens=self.prefill_chunk_tokens,
+            on_server_step=self.on_server_step
+        )
+        batcher.start()
+
+        resident = ResidentModel(
+            model_id=model_id,
+            model=model,
+            tokenizer=tokenizer,
+            batcher=batcher,
+            load_seconds=time.monotonic() - started,
+            loaded_at=datetime.now(timezone.utc),
+            last_used=time.monotonic()
+        )
+        self._resident[model_id] = resident
+
+        logger.info(f"✓ Connected to Far Mesh for model: {model_id} ({resident.load_seconds:.1f}s)")
+        return resident
+
+    def _load_blocking(self, model_id: str):
+        """Load the tokenizer and connect to the FarMesh swarm (blocking)"""
+        # Load tokenizer (lightweight, runs locally)
+        tokenizer = AutoTokenizer.from_pretrained(model_id)
+
+        # Set initial_peers for FarMesh DHT
+        # If no bootstrap address is provided, use a placeholder to satisfy FarMesh requirements
+        # FarMesh will create its own standalone DHT if peers list is provided but empty/invalid
+        initial_peers = [self.dht_bootstrap_addr] if self.dht_bootstrap_addr else [""]
+
+        # Connect to FarMesh swarm
+        # This will automatically discover and connect to GPU nodes
+        # serving this model in the DHT network
+        model = AutoDistributedModelForCausalLM.from_pretrained(
+            model_id,
+            initial_peers=initial_peers,
+            torch_dtype=torch.float16,
+        )
+
+        return tokenizer, model
+
+    async def _evict_idle(self):
+        interval = max(self.idle_timeout_seconds / 4, 1.0)
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for resident in list(self._resident.values()):
+                if resident.active_sessions == 0 and now - resident.last_used >= self.idle_timeout_seconds:
+                    logger.info(f"Evicting idle model {resident.model_id}")
+                    self._evict(resident.model_id)
+
+    def _evict(self, model_id: str):
+        resident = self._resident.pop(model_id, None)
+        if resident is None:
+            return
+
+        resident.batcher.stop()
+        sequence_manager = resident.sequence_manager
+        if sequence_manager is not None:
+            # Stops the background routing updates for this model's swarm
+            sequence_manager.shutdown()
@@ -0,0 +1,247 @@
+"""
+Resumable Event Streams
+
+Keeps the SSE events of every in-flight generation in a bounded, numbered
+ring buffer, so a client whose connection drops can reconnect with
+Last-Event-ID, replay what it missed and keep following the live
+generation instead of starting (and paying for) a new one. With Redis the
+events are also mirrored into a capped Redis stream, so a reconnect that
+lands on another replica can be served from there.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "farmesh"
+
+
+def _stream_key(session_id: str) -> str:
+    return f"{KEY_PREFIX}:stream:{session_id}"
+
+
+def _reader_key(session_id: str) -> str:
+    return f"{KEY_PREFIX}:stream:{session_id}:reader"
+
+
+def _owner_key(session_id: str) -> str:
+    return f"{KEY_PREFIX}:stream:{session_id}:owner"
+
+
+def same_user(a: Optional[str], b: Optional[str]) -> bool:
+    """Whether two wallet addresses name the same user (checksummed addresses differ in case only)"""
+    return a is not None and b is not None and a.lower() == b.lower()
+
+
+class ReplayGap(Exception):
+    """The events after the client's Last-Event-ID are no longer retained"""
+
+
+class SessionStream:
+    """
+    Numbered events of one generation.
+
+    Event ids start at 1 and increase by one; only the last `max_events`
+    are kept. Any number of readers can follow the stream at once, but only
+    its owner may attach them.
+    """
+
+    def __init__(self, session_id: str, max_events: int, owner: str):
+        self.session_id = session_id
+        self.owner = owner
+        self.events: Deque[Tuple[int, str]] = deque(maxlen=max_events)
+        self.last_event_id = 0
+        self.closed = False
+        self.readers = 0
+        self.detached_since: Optional[float] = time.monotonic()
+        self._changed = asyncio.Event()
+
+    def append(self, payload: str) -> int:
+        self.last_event_id += 1
+        self.events.append((self.last_event_id, payload))
+        self._notify()
+        return self.last_event_id
+
+    def close(self):
+        self.closed = True
+        self._notify()
+
+    def check(self, after: int):
+        """Raise ReplayGap if events after `after` were already dropped"""
+        if self.events and after < self.events[0][0] - 1:
+            raise ReplayGap(f"Events {after + 1}..{self.events[0][0] - 1} are no longer retained")
+
+    async def follow(self, after: int = 0) -> AsyncIterator[Tuple[int, str]]:
+        """Yield (event_id, payload) for every event after `after`, live until the stream closes"""
+        self.readers += 1
+        self.detached_since = None
+        try:
+            while True:
+                changed = self._changed
+                self.check(after)
+                for event_id, payload in list(self.events):
+                    if event_id > after:
+                        yield event_id, payload
+                        after = event_id
+                if self.closed and after >= self.last_event_id:
+                    return
+                if after >= self.last_event_id:
+                    await changed.wait()
+        finally:
+            self.readers -= 1
+            if self.readers == 0:
+                self.detached_since = time.monotonic()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+
+class StreamHub:
+    """
+    Runs each generation independently of the connection that started it.
+
+    A generation keeps running while nobody is attached for up to
+    `resume_grace_seconds` (then it is cancelled, and billed for the tokens
+    generated so far); its events stay replayable for `retention_seconds`
+    after it finishes.
+    """
+
+    def __init__(
+        self,
+        max_events: int = 2048,
+        resume_grace_seconds: float = 30.0,
+        retention_seconds: float = 60.0,
+        redis=None
+    ):
+        """
+        Args:
+            max_events: Events kept per session for replay
+            resume_grace_seconds: How long a generation runs with no client attached
+            retention_seconds: How long a finished generation stays replayable
+            redis: redis.asyncio client to mirror events into (optional)
+        """
+        self.max_events = max_events
+        self.resume_grace_seconds = resume_grace_seconds
+        self.retention_seconds = retention_seconds
+        self.redis = redis
+
+        self._streams: Dict[str, SessionStream] = {}
+        self._producers: Dict[str, asyncio.Task] = {}
+        self._reaper: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start cancelling abandoned generations in the background"""
+        if self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap_forever())
+
+    async def stop(self):
+        """Cancel the reaper and any generation still running"""
+        tasks = list(self._producers.values())
+        if self._reaper is not None:
+            tasks.append(self._reaper)
+            self._reaper = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def get(self, session_id: str) -> Optional[SessionStream]:
+        return self._streams.get(session_id)
+
+    def open(self, session_id: str, events: AsyncIterator[str], owner: str) -> SessionStream:
+        """Start consuming `events` (formatted SSE payloads) of `owner`'s generation into a new stream"""
+        stream = SessionStream(session_id, self.max_events, owner)
+        self._streams[session_id] = stream
+        self._producers[session_id] = asyncio.create_task(self._produce(stream, events))
+        return stream
+
+    async def follow_remote(
+        self, session_id: str, owner: str, after: int = 0
+    ) -> Optional[AsyncIterator[Tuple[int, str]]]:
+        """
+        Follow a stream mirrored in Redis by another replica.
+
+        Returns None if no replica is mirroring the session for `owner`;
+        raises ReplayGap if the events after `after` were already trimmed.
+        """
+        if self.redis is None:
+            return None
+        if not same_user(await self.redis.get(_owner_key(session_id)), owner):
+            return None
+        first = await self.redis.xrange(_stream_key(session_id), count=1)
+        if not first:
+            return None
+        first_id = int(first[0][0].split("-")[1])
+        if after < first_id - 1:
+            raise ReplayGap(f"Events {after + 1}..{first_id - 1} are no longer retained")
+        return self._follow_redis(session_id, after)
+
+    async def _follow_redis(self, session_id: str, after: int) -> AsyncIterator[Tuple[int, str]]:
+        key = _stream_key(session_id)
+        last = f"0-{after}"
+        while True:
+            # Tells the owning replica somebody is still following the generation
+            await self.redis.set(_reader_key(session_id), 1, ex=max(int(self.resume_grace_seconds), 1))
+            result = await self.redis.xread({key: last}, count=256, block=5000)
+            if not result:
+                if not await self.redis.exists(key):
+                    return
+                continue
+            for entry_id, fields in result[0][1]:
+                if "end" in fields:
+                    return
+                last = entry_id
+                yield int(entry_id.split("-")[1]), fields["data"]
+
+    async def _produce(self, stream: SessionStream, events: AsyncIterator[str]):
+        mirror = self.redis is not None
+        try:
+            async for payload in events:
+                event_id = stream.append(payload)
+                if mirror:
+                    mirror = await self._mirror(stream, {"data": payload}, event_id)
+        finally:
+            stream.close()
+            if mirror:
+                await self._mirror(stream, {"end": 1}, stream.last_event_id + 1, expire=self.retention_seconds)
+            self._producers.pop(stream.session_id, None)
+            asyncio.get_running_loop().call_later(
+                self.retention_seconds, self._streams.pop, stream.session_id, None
+            )
+
+    async def _mirror(self, stream: SessionStream, fields: dict, event_id: int, expire: Optional[float] = None) -> bool:
+        """Append one event to the Redis stream; False (stop mirroring) if Redis fails"""
+        key = _stream_key(stream.session_id)
+        ttl = int(expire or self.resume_grace_seconds + self.retention_seconds)
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.xadd(key, fields, id=f"0-{event_id}", maxlen=self.max_events, approximate=False)
+                pipe.expire(key, ttl)
+                pipe.set(_owner_key(stream.session_id), stream.owner, ex=ttl)
+                await pipe.execute()
+            return True
+        except Exception as e:
+            logger.warning(f"Failed to mirror events to {key}, replays stay local: {e}")
+            return False
+
+    async def _reap_forever(self):
+        interval = max(self.resume_grace_seconds / 4, 1.0)
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for session_id, task in list(self._producers.items()):
+                stream = self._streams[session_id]
+                if stream.detached_since is None or now - stream.detached_since < self.resume_grace_seconds:
+                    continue
+                if self.redis is not None:
+                    try:
+                        if await self.redis.exists(_reader_key(session_id)):
+                            continue  # Followed through another replica
+                    except Exception as e:
+                        logger.warning(f"Failed to check remote readers of {session_id}: {e}")
+                logger.info(f"[{session_id}] No client reattached within {self.resume_grace_seconds:.0f}s, cancelling")
+                task.cancel()
@@ -7,19 +7,24 @@ FastAPI server exposing distributed inference endpoints.
 import logging
 import os
 from contextlib import asynccontextmanager
-from typing import AsyncIterator
+from datetime import datetime, timezone
+from typing import AsyncIterator, Optional, Tuple
+from urllib.parse import quote
 from fastapi import FastAPI, HTTPException, Header
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import json
 
 from coordinator import (
     FarMeshCoordinator,
     InferenceRequest,
+    StreamStatus,
     TokenResponse,
     FineTuningRequest,
     FineTuningStatus
 )
+from model_pool import ModelNotAllowed
+from resumable import ReplayGap, StreamHub, same_user
 
 # Configure logging
 logging.basicConfig(
@@ -30,12 +35,13 @@ logger = logging.getLogger(__name__)
 
 # Global coordinator instance
 coordinator: FarMeshCoordinator | None = None
+streams: StreamHub | None = None
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Startup and shutdown logic"""
-    global coordinator
+    global coordinator, streams
 
     # Startup
     logger.info("Starting Far Mesh Coordinator Service")
@@ -46,9 +52,32 @@ async def lifespan(app: FastAPI):
     coordinator = FarMeshCoordinator(
         model_id=model_id,
         # DHT bootstrap will be configured via environment variables
+        discovery_url=os.getenv("FAR_DISCOVERY_URL"),
+        routing_refresh_seconds=float(os.getenv("ROUTING_REFRESH_SECONDS", "5")),
+        max_concurrent_generations=int(os.getenv("MAX_CONCURRENT_GENERATIONS", "8")),
+        max_batch_size=int(os.getenv("MAX_BATCH_SIZE", "16")),
+        batch_wait_seconds=float(os.getenv("BATCH_WAIT_MS", "10")) / 1000,
+        model_idle_timeout_seconds=float(os.getenv("MODEL_IDLE_TIMEOUT_SECONDS", "900")),
+        supported_models=[m.strip() for m in os.getenv("SUPPORTED_MODELS", "").split(",") if m.strip()],
+        max_resident_models=int(os.getenv("MAX_RESIDENT_MODELS", "4")),
+        prefill_chunk_tokens=int(os.getenv("PREFILL_CHUNK_TOKENS", "256")),
+        drain_timeout_seconds=float(os.getenv("DRAIN_TIMEOUT_SECONDS", "300")),
+        redis_url=os.getenv("REDIS_URL"),
+        replica_id=os.getenv("REPLICA_ID"),
+        replica_url=os.getenv("REPLICA_URL"),
+        session_registry_ttl_seconds=float(os.getenv("SESSION_REGISTRY_TTL_SECONDS", "30")),
     )
 
     await coordinator.initialize()
+
+    # Generations outlive their connection so clients can resume with Last-Event-ID
+    streams = StreamHub(
+        max_events=int(os.getenv("STREAM_BUFFER_EVENTS", "2048")),
+        resume_grace_seconds=float(os.getenv("RESUME_GRACE_SECONDS", "30")),
+        retention_seconds=float(os.getenv("STREAM_RETENTION_SECONDS", "60")),
+        redis=coordinator.registry.redis if coordinator.registry else None
+    )
+    streams.start()
     logger.info("✓ Far Mesh Coordinator initialized and ready")
 
     yield
@@ -57,6 +86,8 @@ async def lifespan(app: FastAPI):
     logger.info("Shutting down Far Mesh Coordinator Service")
     if coordinator:
         await coordinator.shutdown()
+    if streams:
+        await streams.stop()
 
 
 # Create FastAPI app with /api prefix
@@ -90,6 +121,39 @@ async def health_check():
     }
 
 
+@app.get("/health/ready")
+async def readiness_check():
+    """
+    Readiness probe for the load balancer.
+
+    Fails as soon as the coordinator starts draining, so new requests go to
+    other replicas while this one finishes its active sessions.
+    """
+    if not coordinator or coordinator.draining:
+        return JSONResponse(
+            status_code=503,
+            content={"status": "draining" if coordinator else "starting"}
+        )
+    return {"status": "ready", "active_sessions": len(coordinator.active_sessions)}
+
+
+@app.post("/mesh/drain")
+async def start_drain():
+    """
+    Stop admitting new sessions ahead of a shutdown.
+
+    Called from the deploy's pre-stop hook: readiness fails immediately and
+    active sessions keep streaming until they finish (or the process stops,
+    at which point shutdown interrupts whatever is left after
+    DRAIN_TIMEOUT_SECONDS).
+    """
+    if not coordinator:
+        raise HTTPException(status_code=503, detail="Coordinator not initialized")
+
+    coordinator.start_drain()
+    return {"status": "draining", "active_sessions": len(coordinator.active_sessions)}
+
+
 @app.get("/mesh/status")
 async def get_mesh_status():
     """Get Far Mesh network status"""
@@ -117,21 +181,20 @@ async def get_monitoring_metrics():
     try:
         # Get mesh status
         mesh_status = await coordinator.get_mesh_status()
-
-        # TODO: Query PostgreSQL for additional metrics
-        # - Total requests over time
-        # - Node performance statistics
-        # - Cost and earnings data
-        # - Historical latency data
+        metrics = coordinator.metrics.snapshot()
 
         return {
             "mesh": mesh_status,
-            "nodes": [],  # Will be populated from database
+            "nodes": [
+                {"peer_id": peer_id, **stats}
+                for peer_id, stats in coordinator.metrics.peer_summaries().items()
+            ],
             "metrics": {
-                "total_requests": 0,
-                "avg_latency_ms": 0,
-                "total_tokens_processed": 0,
-                "network_health": 95.0
+                "total_requests": sum(metrics["sessions"].values()),
+                "avg_latency_ms": metrics["time_to_first_token_seconds"]["mean"] * 1000,
+                "total_tokens_processed": metrics["tokens_total"],
+                "network_health": metrics["network_health"],
+                **metrics
             },
             "timestamp": datetime.now(timezone.utc).isoformat()
         }
@@ -140,6 +203,22 @@ async def get_monitoring_metrics():
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_prometheus_metrics():
+    """Coordinator metrics in the Prometheus text exposition format"""
+    if not coordinator:
+        raise HTTPException(status_code=503, detail="Coordinator not initialized")
+
+    return PlainTextResponse(
+        coordinator.metrics.prometheus({
+            "farmesh_active_sessions": len(coordinator.active_sessions),
+            "farmesh_resident_models": len(coordinator.models.resident()),
+            "farmesh_pending_finalizations": coordinator.finalizer.pending if coordinator.finalizer else 0
+        }),
+        media_type="text/plain; version=0.0.4"
+    )
+
+
 @app.get("/monitoring/nodes")
 async def get_active_nodes():
     """
@@ -155,13 +234,12 @@ async def get_active_nodes():
         raise HTTPException(status_code=503, detail="Coordinator not initialized")
 
     try:
-        # TODO: Query PostgreSQL far_nodes table for node information
-        # JOIN with far_session_contributions to get earnings data
+        nodes = await coordinator.get_node_metrics()
 
         return {
-            "nodes": [],  # Will be populated from database
-            "total": 0,
-            "active": 0,
+            "nodes": nodes,
+            "total": len(nodes),
+            "active": sum(1 for node in nodes if node["status"] == "active"),
             "timestamp": datetime.now(timezone.utc).isoformat()
         }
     except Exception as e:
@@ -172,45 +250,143 @@ async def get_active_nodes():
 @app.post("/inference/generate")
 async def generate_inference(
     request: InferenceRequest,
-    authorization: str = Header(None)
+    authorization: str = Header(None),
+    last_event_id: Optional[str] = Header(None),
+    x_user_address: Optional[str] = Header(None)
 ):
     """
     Generate text using distributed inference.
 
     This endpoint streams tokens back as they're generated by the mesh network.
+    Every event carries an id; re-sending a request with the same request_id
+    and a `Last-Event-ID` header resumes the running generation instead of
+    starting a new one (for the same user_wallet only).
 
     Returns:
         Server-Sent Events (SSE) stream with generated tokens
     """
-    if not coordinator:
+    if not coordinator or not streams:
         raise HTTPException(status_code=503, detail="Coordinator not initialized")
 
+    # The API gateway passes the address it authenticated; a request may not act for another wallet
+    if x_user_address is not None and not same_user(x_user_address, request.user_wallet):
+        raise HTTPException(status_code=403, detail="user_wallet does not match the authenticated user")
+
+    if streams.get(request.request_id) or last_event_id is not None:
+        return await _resume(request.request_id, request.user_wallet, _parse_event_id(last_event_id))
+
+    if coordinator.draining:
+        raise HTTPException(
+            status_code=503,
+            detail="Coordinator is draining, retry on another replica",
+            headers={"Retry-After": "1"}
+        )
+
     # TODO: Verify JWT token in authorization header
     # For now, we'll trust the user_wallet in the request
 
+    # Loading a model downloads its weights and joins its swarm, so only known models may be named
+    try:
+        coordinator.models.check_allowed(request.model_id or coordinator.model_id)
+    except ModelNotAllowed as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
     logger.info(f"Inference request from {request.user_wallet[:10]}...")
 
-    async def event_generator() -> AsyncIterator[str]:
-        """Generate SSE events for streaming tokens"""
+    stream = streams.open(request.request_id, _generation_events(request), owner=request.user_wallet)
+    return _event_stream(stream.follow(0))
+
+
+@app.get("/inference/sessions/{request_id}/stream")
+async def resume_inference(
+    request_id: str,
+    last_event_id: Optional[str] = Header(None),
+    x_user_address: Optional[str] = Header(None),
+    after: Optional[int] = None,
+    user_wallet: Optional[str] = None
+):
+    """
+    Reattach to a running (or just finished) generation.
+
+    Replays the events after `Last-Event-ID` (or the `after` query parameter)
+    and then follows the live generation. Served from this replica's buffer,
+    from the Redis mirror when the session runs elsewhere, or by redirecting
+    to the replica that owns the session. Only the wallet that started the
+    generation (the gateway's authenticated address, or the `user_wallet`
+    query parameter) may reattach; anyone else gets 404.
+    """
+    if not coordinator or not streams:
+        raise HTTPException(status_code=503, detail="Coordinator not initialized")
+
+    caller = _caller(x_user_address, user_wallet)
+    return await _resume(request_id, caller, after if after is not None else _parse_event_id(last_event_id))
+
+
+def _caller(x_user_address: Optional[str], user_wallet: Optional[str]) -> Optional[str]:
+    """Who is asking: the address the API gateway authenticated, else the wallet the client names"""
+    if x_user_address is not None and user_wallet is not None and not same_user(x_user_address, user_wallet):
+        raise HTTPException(status_code=403, detail="user_wallet does not match the authenticated user")
+    return x_user_address or user_wallet
+
+
+def _parse_event_id(last_event_id: Optional[str]) -> int:
+    if not last_event_id:
+        return 0
+    try:
+        return int(last_event_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Last-Event-ID must be an event id from this stream")
+
+
+async def _resume(request_id: str, caller: Optional[str], after: int):
+    """
+    Stream the events of `request_id` after event `after`, wherever they are buffered.
+
+    Other users' sessions are reported as not found, so request ids cannot be probed.
+    """
+    not_found = HTTPException(status_code=404, detail="Session not found or no longer replayable")
+    if caller is None:
+        raise not_found
+
+    try:
+        stream = streams.get(request_id)
+        if stream is not None:
+            if not same_user(stream.owner, caller):
+                raise not_found
+            stream.check(after)
+            logger.info(f"[{request_id}] Client resumed after event {after}")
+            return _event_stream(stream.follow(after))
+
+        events = await streams.follow_remote(request_id, caller, after)
+        if events is not None:
+            logger.info(f"[{request_id}] Client resumed after event {after} from the Redis mirror")
+            return _event_stream(events)
+    except ReplayGap as e:
+        raise HTTPException(status_code=409, detail=f"Cannot resume: {e}")
+
+    # Without a Redis mirror the events only live on the replica that owns the session
+    session = await coordinator.find_session(request_id)
+    owned = session is not None and same_user(session.get("user_wallet"), caller)
+    if owned and not session["local"] and session.get("replica_url"):
+        return RedirectResponse(
+            f"{session['replica_url']}/api/inference/sessions/{request_id}/stream"
+            f"?after={after}&user_wallet={quote(caller)}",
+            status_code=303
+        )
+    raise not_found
+
+
+def _event_stream(events: AsyncIterator[Tuple[int, str]]) -> StreamingResponse:
+    async def with_ids() -> AsyncIterator[str]:
         try:
-            async for token_response in coordinator.generate_streaming(request):
-                # Format as Server-Sent Event
-                data = token_response.model_dump_json()
-                yield f"data: {data}\n\n"
-
-            # Send completion event
-            yield f"data: {json.dumps({'done': True})}\n\n"
-
-        except Exception as e:
-            logger.error(f"Inference error: {e}")
-            error_data = json.dumps({
-                "error": str(e),
-                "request_id": request.request_id
-            })
-            yield f"data: {error_data}\n\n"
+            async for event_id, payload in events:
+                yield f"id: {event_id}\n{payload}"
+        except ReplayGap as e:
+            # This client fell further behind than the buffer holds
+            yield f"data: {json.dumps({'error': f'Cannot resume: {e}'})}\n\n"
 
     return StreamingResponse(
-        event_generator(),
+        with_ids(),
         media_type="text/event-stream",
         headers={
             "Cache-Control": "no-cache",
@@ -219,6 +395,66 @@ async def generate_inference(
     )
 
 
+async def _generation_events(request: InferenceRequest) -> AsyncIterator[str]:
+    """Generate SSE events for streaming tokens"""
+    done = {"done": True}
+    try:
+        async for event in coordinator.generate_streaming(request):
+            if isinstance(event, StreamStatus):
+                if event.status == "completed":
+                    # Timing rides along with the completion event
+                    done.update(event.model_dump(exclude={"request_id", "status"}, exclude_none=True))
+                else:
+                    # Named event, so clients that only read tokens can ignore it
+                    yield f"event: status\ndata: {event.model_dump_json(exclude_none=True)}\n\n"
+                continue
+
+            # Format as Server-Sent Event
+            data = event.model_dump_json()
+            yield f"data: {data}\n\n"
+
+        # Send completion event
+        yield f"data: {json.dumps(done)}\n\n"
+
+    except Exception as e:
+        logger.error(f"Inference error: {e}")
+        error_data = json.dumps({
+            "error": str(e),
+            "request_id": request.request_id
+        })
+        yield f"data: {error_data}\n\n"
+
+
+@app.get("/inference/sessions/{request_id}")
+async def get_inference_session(
+    request_id: str,
+    x_user_address: Optional[str] = Header(None),
+    user_wallet: Optional[str] = None
+):
+    """
+    Find an in-flight inference session on any coordinator replica.
+
+    Reconnecting clients use this to get back to the replica that owns their
+    session: the response names it (`replica_id`, `replica_url`) along with
+    the model, tokens generated so far and the nodes serving it. `local` is
+    true when this replica owns the session. Like resuming, this only answers
+    the wallet that started the session.
+    """
+    if not coordinator:
+        raise HTTPException(status_code=503, detail="Coordinator not initialized")
+
+    caller = _caller(x_user_address, user_wallet)
+    try:
+        session = await coordinator.find_session(request_id) if caller is not None else None
+    except Exception as e:
+        logger.error(f"Failed to look up session {request_id}: {e}")
+        raise HTTPException(status_code=503, detail="Session registry unavailable")
+
+    if session is None or not same_user(session.pop("user_wallet", None), caller):
+        raise HTTPException(status_code=404, detail="Session not found or already finished")
+    return {"request_id": request_id, **session}
+
+
 @app.get("/models")
 async def list_available_models():
     """
@@ -0,0 +1,228 @@
+"""
+Far Mesh Session Registry
+
+Shares the coordinator's in-flight inference sessions across replicas
+through Redis. Every session has a TTL-refreshed entry naming the replica
+that owns it, so a reconnecting client can be routed back to it, and every
+replica publishes a small summary of its sessions so cluster-wide status is
+read without touching per-session keys.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import redis.asyncio as redis  # type: ignore[import-untyped]
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "farmesh"
+REPLICA_INDEX_KEY = f"{KEY_PREFIX}:replicas"  # Sorted set of replica_id by last heartbeat
+
+
+def _session_key(session_id: str) -> str:
+    return f"{KEY_PREFIX}:session:{session_id}"
+
+
+def _replica_key(replica_id: str) -> str:
+    return f"{KEY_PREFIX}:replica:{replica_id}"
+
+
+class SessionRegistry:
+    """
+    Redis-backed registry of inference sessions across coordinator replicas.
+
+    Entries expire after `ttl_seconds` unless refreshed, so sessions and
+    replicas that disappear without cleaning up (a crash, a killed pod) drop
+    out on their own. Redis failures are logged and never fail inference.
+
+    All writes go through one queue in the order they were made, so a
+    session's removal always lands after its registration, and periodic
+    refreshes read the live sessions when they are written rather than when
+    they were queued (never resurrecting a session that just finished).
+    """
+
+    def __init__(
+        self,
+        redis_url: str,
+        replica_id: str,
+        replica_url: Optional[str] = None,
+        ttl_seconds: float = 30.0,
+        sessions: Optional[Callable[[], Dict[str, dict]]] = None,
+        summary: Optional[Callable[[], dict]] = None
+    ):
+        """
+        Args:
+            redis_url: Redis connection URL
+            replica_id: Unique id of this coordinator replica
+            replica_url: Base URL other replicas and clients can reach this replica on
+            ttl_seconds: Entries expire after this long without a refresh
+            sessions: Returns this replica's live session entries by session id
+            summary: Returns this replica's aggregate counters
+        """
+        self.replica_id = replica_id
+        self.replica_url = replica_url
+        self.ttl_seconds = ttl_seconds
+        self.refresh_interval = ttl_seconds / 3
+        self.sessions = sessions or dict
+        self.summary = summary or dict
+
+        self.redis = redis.from_url(redis_url, decode_responses=True)
+        self._task: Optional[asyncio.Task] = None
+        self._writer: Optional[asyncio.Task] = None
+        # (entries, removed session ids), or None to refresh every live session
+        self._writes: asyncio.Queue = asyncio.Queue()
+
+    def start(self):
+        """Start refreshing this replica's entries in the background"""
+        if self._task is None:
+            self._writer = asyncio.create_task(self._write_forever())
+            self._task = asyncio.create_task(self._refresh_forever())
+
+    async def stop(self):
+        """Stop refreshing and remove this replica's summary"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        if self._writer is not None:
+            await self._writes.join()
+            self._writer.cancel()
+            try:
+                await self._writer
+            except asyncio.CancelledError:
+                pass
+            self._writer = None
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.delete(_replica_key(self.replica_id))
+                pipe.zrem(REPLICA_INDEX_KEY, self.replica_id)
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Failed to deregister replica {self.replica_id}: {e}")
+        await self.redis.aclose()
+
+    def register(self, session_id: str, entry: dict):
+        """Publish a new session right away (without blocking the request)"""
+        self._writes.put_nowait(({session_id: entry}, ()))
+
+    def unregister(self, session_id: str):
+        """Remove a finished session"""
+        self._writes.put_nowait(({}, (session_id,)))
+
+    async def lookup(self, session_id: str) -> Optional[dict]:
+        """Return the entry of a live session on any replica, or None"""
+        raw = await self.redis.hgetall(_session_key(session_id))
+        if not raw:
+            return None
+        entry = dict(raw)
+        entry["tokens_generated"] = int(entry.get("tokens_generated", 0))
+        entry["nodes_used"] = json.loads(entry.get("nodes_used", "{}"))
+        entry["local"] = entry.get("replica_id") == self.replica_id
+        return entry
+
+    async def cluster_status(self) -> dict:
+        """
+        Aggregate session counts over live replicas.
+
+        Reads one summary hash per replica, so the cost does not grow with the
+        number of sessions.
+        """
+        cutoff = time.time() - self.ttl_seconds
+        replica_ids = await self.redis.zrangebyscore(REPLICA_INDEX_KEY, cutoff, "+inf")
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.zremrangebyscore(REPLICA_INDEX_KEY, "-inf", cutoff)
+            for replica_id in replica_ids:
+                pipe.hgetall(_replica_key(replica_id))
+            results = await pipe.execute()
+
+        replicas, models = [], {}
+        active_sessions = tokens_in_flight = 0
+        for replica_id, raw in zip(replica_ids, results[1:]):
+            if not raw:
+                continue  # Expired between the index read and the lookup
+            replica_models = json.loads(raw.get("models", "{}"))
+            replica = {
+                "replica_id": replica_id,
+                "replica_url": raw.get("replica_url") or None,
+                "active_sessions": int(raw.get("active_sessions", 0)),
+                "tokens_in_flight": int(raw.get("tokens_in_flight", 0)),
+                "draining": raw.get("draining") == "1",
+                "models": replica_models,
+                "updated_at": float(raw.get("updated_at", 0))
+            }
+            replicas.append(replica)
+            active_sessions += replica["active_sessions"]
+            tokens_in_flight += replica["tokens_in_flight"]
+            for model_id, count in replica_models.items():
+                models[model_id] = models.get(model_id, 0) + count
+
+        return {
+            "replicas": replicas,
+            "active_sessions": active_sessions,
+            "tokens_in_flight": tokens_in_flight,
+            "sessions_by_model": models
+        }
+
+    async def _refresh_forever(self):
+        while True:
+            self._writes.put_nowait(None)
+            await asyncio.sleep(self.refresh_interval)
+
+    async def _write_forever(self):
+        while True:
+            # Everything queued meanwhile goes out in one pipeline, in order
+            writes = [await self._writes.get()]
+            while not self._writes.empty():
+                writes.append(self._writes.get_nowait())
+            try:
+                await self._publish(writes)
+            finally:
+                for _ in writes:
+                    self._writes.task_done()
+
+    async def _publish(self, writes: List[Optional[Tuple[Dict[str, dict], Sequence[str]]]]):
+        """Apply queued writes and this replica's summary, extending their TTLs"""
+        ttl = int(self.ttl_seconds)
+        now = time.time()
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for write in writes:
+                    sessions, removed = (self.sessions(), ()) if write is None else write
+                    for session_id, entry in sessions.items():
+                        key = _session_key(session_id)
+                        pipe.hset(key, mapping={
+                            "replica_id": self.replica_id,
+                            "replica_url": self.replica_url or "",
+                            "model_id": entry["model_id"],
+                            "user_wallet": entry["user_wallet"],
+                            "tokens_generated": entry["tokens_generated"],
+                            "nodes_used": json.dumps(entry["nodes_used"]),
+                            "started_at": entry["started_at"],
+                            "updated_at": now
+                        })
+                        pipe.expire(key, ttl)
+                    for session_id in removed:
+                        pipe.delete(_session_key(session_id))
+
+                summary = self.summary()
+                pipe.hset(_replica_key(self.replica_id), mapping={
+                    "replica_url": self.replica_url or "",
+                    "active_sessions": summary.get("active_sessions", 0),
+                    "tokens_in_flight": summary.get("tokens_in_flight", 0),
+                    "draining": int(bool(summary.get("draining"))),
+                    "models": json.dumps(summary.get("models", {})),
+                    "updated_at": now
+                })
+                pipe.expire(_replica_key(self.replica_id), ttl)
+                pipe.zadd(REPLICA_INDEX_KEY, {self.replica_id: now})
+
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Session registry update failed: {e}")
@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import json
 import os
+import time
 import uuid
 from datetime import datetime, timezone
 from typing import Any, Dict, List, Optional
@@ -13,7 +14,8 @@ from pydantic import BaseModel, Field
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
 redis_client = redis.from_url(REDIS_URL, decode_responses=True)
 
-NODE_REGISTRY_KEY = "gpu:nodes"
+NODE_KEY_PREFIX = "gpu:node:"
+HEARTBEAT_INDEX_KEY = "gpu:nodes:heartbeat"
 OWNER_INDEX_PREFIX = "gpu:owner:"
 
 
@@ -37,26 +39,53 @@ class NodeHeartbeat(BaseModel):
     tasks_completed: Optional[int] = Field(default=None, ge=0)
 
 
+def node_key(node_id: str) -> str:
+    return f"{NODE_KEY_PREFIX}{node_id}"
+
+
+def encode_fields(fields: Dict[str, Any]) -> Dict[str, str]:
+    return {key: json.dumps(value) for key, value in fields.items() if key != "node_id"}
+
+
+def decode_fields(raw: Dict[str, str]) -> Dict[str, Any]:
+    record: Dict[str, Any] = {}
+    for key, value in raw.items():
+        try:
+            record[key] = json.loads(value)
+        except (TypeError, json.JSONDecodeError):
+            record[key] = value
+    return record
+
+
 async def fetch_nodes() -> List[Dict[str, Any]]:
-    records = await redis_client.hgetall(NODE_REGISTRY_KEY)
+    node_ids = await redis_client.zrange(HEARTBEAT_INDEX_KEY, 0, -1)
+    if not node_ids:
+        return []
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for node_id in node_ids:
+            pipe.hgetall(node_key(node_id))
+        records = await pipe.execute()
     return [
-        {"node_id": node_id, **json.loads(payload)}
-        for node_id, payload in records.items()
+        {"node_id": node_id, **decode_fields(raw)}
+        for node_id, raw in zip(node_ids, records)
+        if raw
     ]
 
 
 async def get_node(node_id: str) -> Dict[str, Any]:
-    payload = await redis_client.hget(NODE_REGISTRY_KEY, node_id)
-    if not payload:
+    raw = await redis_client.hgetall(node_key(node_id))
+    if not raw:
         raise HTTPException(status_code=404, detail="Node not found")
-    return {"node_id": node_id, **json.loads(payload)}
+    return {"node_id": node_id, **decode_fields(raw)}
 
 
 async def persist_node(node_id: str, record: Dict[str, Any]) -> None:
-    stored = {k: v for k, v in record.items() if k != "node_id"}
-    await redis_client.hset(NODE_REGISTRY_KEY, node_id, json.dumps(stored))
-    owner_key = f"{OWNER_INDEX_PREFIX}{stored['wallet_address'].lower()}"
-    await redis_client.sadd(owner_key, node_id)
+    """Write a complete node record and its indexes; used on registration only."""
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hset(node_key(node_id), mapping=encode_fields(record))
+        pipe.zadd(HEARTBEAT_INDEX_KEY, {node_id: time.time()})
+        pipe.sadd(f"{OWNER_INDEX_PREFIX}{record['wallet_address'].lower()}", node_id)
+        await pipe.execute()
 
 
 app = FastAPI(title="Far Labs GPU Service")
@@ -103,13 +132,15 @@ async def get_node_detail(node_id: str) -> Dict[str, Any]:
 
 @app.post("/api/gpu/nodes/{node_id}/heartbeat")
 async def heartbeat(node_id: str, payload: NodeHeartbeat) -> Dict[str, Any]:
-    data = await get_node(node_id)
-    updated = {**data, **payload.model_dump(exclude_unset=True)}
-    updated["last_heartbeat"] = utc_now_iso()
-    if payload.tasks_completed is not None:
-        updated["tasks_completed"] = payload.tasks_completed
-    await persist_node(node_id, updated)
-    return {"node_id": node_id, "record": updated}
+    if not await redis_client.exists(node_key(node_id)):
+        raise HTTPException(status_code=404, detail="Node not found")
+    changes = payload.model_dump(exclude_unset=True)
+    changes["last_heartbeat"] = utc_now_iso()
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hset(node_key(node_id), mapping=encode_fields(changes))
+        pipe.zadd(HEARTBEAT_INDEX_KEY, {node_id: time.time()})
+        await pipe.execute()
+    return {"node_id": node_id, "record": await get_node(node_id)}
 
 
 @app.get("/api/gpu/stats")
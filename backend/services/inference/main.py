@@ -14,6 +14,7 @@ from __future__ import annotations
 import asyncio
 import json
 import os
+import time
 import uuid
 from datetime import datetime, timezone
 from typing import Any, Dict, List, Optional
@@ -73,56 +74,113 @@ JWT_ALGORITHM = "HS256"
 w3 = Web3(Web3.HTTPProvider(BSC_RPC))
 redis_client = redis.from_url(REDIS_URL, decode_responses=True)
 
-GPU_NODE_REGISTRY_KEY = "gpu:nodes"
+GPU_NODE_KEY_PREFIX = "gpu:node:"
+GPU_HEARTBEAT_INDEX_KEY = "gpu:nodes:heartbeat"
 TASK_STORE_KEY = "inference:tasks"
 USER_TASK_INDEX_PREFIX = "inference:user:"
 GPU_OWNER_INDEX_PREFIX = "gpu:owner:"
+NODE_HEARTBEAT_TTL_SECONDS = int(os.getenv("NODE_HEARTBEAT_TTL_SECONDS", "90"))
 
 
 def utc_now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
-async def get_gpu_nodes() -> Dict[str, Dict[str, Any]]:
-    records = await redis_client.hgetall(GPU_NODE_REGISTRY_KEY)
-    nodes: Dict[str, Dict[str, Any]] = {}
-    for node_id, payload in records.items():
+def _node_key(node_id: str) -> str:
+    return f"{GPU_NODE_KEY_PREFIX}{node_id}"
+
+
+def _encode_node_fields(fields: Dict[str, Any]) -> Dict[str, str]:
+    # Every field is JSON-encoded so numbers stay HINCRBY-able and lists round-trip.
+    return {key: json.dumps(value) for key, value in fields.items() if key != "node_id"}
+
+
+def _decode_node_fields(raw: Dict[str, str]) -> Dict[str, Any]:
+    record: Dict[str, Any] = {}
+    for key, value in raw.items():
         try:
-            nodes[node_id] = json.loads(payload)
+            record[key] = json.loads(value)
         except (TypeError, json.JSONDecodeError):
-            continue
-    return nodes
+            record[key] = value
+    return record
+
+
+async def get_gpu_nodes(*, live_only: bool = False) -> Dict[str, Dict[str, Any]]:
+    """Return node records, optionally restricted to nodes with a recent heartbeat."""
+    if live_only:
+        cutoff = time.time() - NODE_HEARTBEAT_TTL_SECONDS
+        node_ids = await redis_client.zrangebyscore(GPU_HEARTBEAT_INDEX_KEY, cutoff, "+inf")
+    else:
+        node_ids = await redis_client.zrange(GPU_HEARTBEAT_INDEX_KEY, 0, -1)
+    if not node_ids:
+        return {}
+
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for node_id in node_ids:
+            pipe.hgetall(_node_key(node_id))
+        records = await pipe.execute()
+
+    return {
+        node_id: _decode_node_fields(raw)
+        for node_id, raw in zip(node_ids, records)
+        if raw
+    }
 
 
 async def get_gpu_node(node_id: str) -> Dict[str, Any]:
-    payload = await redis_client.hget(GPU_NODE_REGISTRY_KEY, node_id)
-    if not payload:
+    raw = await redis_client.hgetall(_node_key(node_id))
+    if not raw:
         raise HTTPException(status_code=404, detail="GPU node not found")
-    return json.loads(payload)
+    return _decode_node_fields(raw)
 
 
 async def persist_gpu_node(node_id: str, record: Dict[str, Any]) -> None:
-    stored = {k: v for k, v in record.items() if k != "node_id"}
-    await redis_client.hset(GPU_NODE_REGISTRY_KEY, node_id, json.dumps(stored))
-    owner_key = f"{GPU_OWNER_INDEX_PREFIX}{stored['wallet_address'].lower()}"
-    await redis_client.sadd(owner_key, node_id)
+    """Write a complete node record. Only registration should need this."""
+    stored = _encode_node_fields(record)
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hset(_node_key(node_id), mapping=stored)
+        pipe.zadd(GPU_HEARTBEAT_INDEX_KEY, {node_id: time.time()})
+        pipe.sadd(f"{GPU_OWNER_INDEX_PREFIX}{record['wallet_address'].lower()}", node_id)
+        await pipe.execute()
+
+
+async def update_gpu_node_fields(
+    node_id: str,
+    fields: Dict[str, Any],
+    *,
+    increments: Optional[Dict[str, int]] = None,
+    heartbeat: bool = False,
+) -> bool:
+    """Update individual fields of an existing node without rewriting the record.
+
+    Returns ``False`` when the node is not registered, so callers never create
+    partial records for unknown nodes.
+    """
+    key = _node_key(node_id)
+    if not await redis_client.exists(key):
+        return False
+    async with redis_client.pipeline(transaction=False) as pipe:
+        if fields:
+            pipe.hset(key, mapping=_encode_node_fields(fields))
+        for field, amount in (increments or {}).items():
+            pipe.hincrby(key, field, amount)
+        if heartbeat:
+            pipe.zadd(GPU_HEARTBEAT_INDEX_KEY, {node_id: time.time()})
+        await pipe.execute()
+    return True
 
 
 async def mark_node_available(node_id: str, *, success: bool, task_id: Optional[str] = None) -> None:
-    try:
-        node_record = await get_gpu_node(node_id)
-    except HTTPException:
-        return
-    node_record["status"] = "available"
-    node_record["last_heartbeat"] = utc_now_iso()
+    fields: Dict[str, Any] = {"status": "available", "last_heartbeat": utc_now_iso()}
+    increments: Dict[str, int] = {}
     if success:
-        node_record["last_completed_task"] = task_id
-        node_record["tasks_completed"] = int(node_record.get("tasks_completed", 0)) + 1
-    await persist_gpu_node(node_id, node_record)
+        fields["last_completed_task"] = task_id
+        increments["tasks_completed"] = 1
+    await update_gpu_node_fields(node_id, fields, increments=increments, heartbeat=True)
 
 
 async def select_best_gpu_node(model: ModelInfo) -> Optional[str]:
-    nodes = await get_gpu_nodes()
+    nodes = await get_gpu_nodes(live_only=True)
     eligible: List[tuple[str, float]] = []
     for node_id, node in nodes.items():
         status = node.get("status", "available")
@@ -140,8 +198,10 @@ async def select_best_gpu_node(model: ModelInfo) -> Optional[str]:
 
 
 async def update_gpu_node_score(node_id: str, performance: Dict[str, float]) -> float:
-    node = await get_gpu_node(node_id)
-    current = float(node.get("score", 100.0))
+    raw_score = await redis_client.hget(_node_key(node_id), "score")
+    if raw_score is None:
+        raise HTTPException(status_code=404, detail="GPU node not found")
+    current = float(json.loads(raw_score))
     uptime_factor = performance.get("uptime", 0) / 100
     speed_expected = max(performance.get("expected_speed", 1), 1)
     speed_factor = min(1.0, performance.get("actual_speed", 0) / speed_expected)
@@ -149,9 +209,10 @@ async def update_gpu_node_score(node_id: str, performance: Dict[str, float]) ->
 
     new_score = (current * 0.7) + (uptime_factor * 10) + (speed_factor * 10) + (accuracy_factor * 10)
     new_score = max(0.0, min(100.0, new_score))
-    node["score"] = new_score
-    node["last_performance_update"] = utc_now_iso()
-    await persist_gpu_node(node_id, node)
+    await update_gpu_node_fields(
+        node_id,
+        {"score": new_score, "last_performance_update": utc_now_iso()},
+    )
 
     adjustment = (new_score - 80.0) / 200.0
     return adjustment
@@ -490,15 +551,11 @@ async def generate_text(
 
     await payment_processor.hold(user_address, estimated_cost, task_id, metadata)
 
-    try:
-        node_record = await get_gpu_node(node_id)
-        node_record["status"] = "busy"
-        node_record["last_task_id"] = task_id
-        node_record["last_assigned_at"] = utc_now_iso()
-        await persist_gpu_node(node_id, node_record)
-    except HTTPException:
-        # If the node record is missing we continue without updating status
-        pass
+    # If the node record is missing we continue without updating status
+    await update_gpu_node_fields(
+        node_id,
+        {"status": "busy", "last_task_id": task_id, "last_assigned_at": utc_now_iso()},
+    )
 
     serialized_task = json.dumps(task_data)
     await redis_client.lpush("inference_queue", serialized_task)
@@ -21,7 +21,8 @@ from transformers import AutoModelForCausalLM, AutoTokenizer, set_seed
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
 QUEUE_KEY = "inference_queue"
 TASK_CHANNEL_TEMPLATE = "task:{task_id}"
-GPU_NODE_REGISTRY_KEY = "gpu:nodes"
+GPU_NODE_KEY_PREFIX = "gpu:node:"
+GPU_HEARTBEAT_INDEX_KEY = "gpu:nodes:heartbeat"
 GPU_OWNER_INDEX_PREFIX = "gpu:owner:"
 
 # Worker configuration
@@ -163,6 +164,26 @@ def utc_now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
+def node_key() -> str:
+    return f"{GPU_NODE_KEY_PREFIX}{NODE_ID}"
+
+
+async def update_node_fields(client: redis.Redis, fields: Dict[str, Any], *, heartbeat: bool = False) -> bool:
+    """Write only the given node fields (JSON-encoded, like the inference service does).
+
+    Returns ``False`` without writing when the node record no longer exists, so a
+    removed node is never recreated as a partial record.
+    """
+    if not await client.exists(node_key()):
+        return False
+    async with client.pipeline(transaction=False) as pipe:
+        pipe.hset(node_key(), mapping={key: json.dumps(value) for key, value in fields.items()})
+        if heartbeat:
+            pipe.zadd(GPU_HEARTBEAT_INDEX_KEY, {NODE_ID: time.time()})
+        await pipe.execute()
+    return True
+
+
 async def register_gpu_node(client: redis.Redis) -> None:
     """Register this worker as an available GPU node in Redis."""
     # Determine supported models based on VRAM
@@ -199,12 +220,12 @@ async def register_gpu_node(client: redis.Redis) -> None:
         "last_heartbeat": utc_now_iso(),
     }
 
-    # Store in GPU node registry
-    await client.hset(GPU_NODE_REGISTRY_KEY, NODE_ID, json.dumps(node_record))
-
-    # Add to owner index
-    owner_key = f"{GPU_OWNER_INDEX_PREFIX}{WORKER_WALLET.lower()}"
-    await client.sadd(owner_key, NODE_ID)
+    # Store in GPU node registry and add to the owner index (registration only)
+    async with client.pipeline(transaction=False) as pipe:
+        pipe.hset(node_key(), mapping={key: json.dumps(value) for key, value in node_record.items()})
+        pipe.zadd(GPU_HEARTBEAT_INDEX_KEY, {NODE_ID: time.time()})
+        pipe.sadd(f"{GPU_OWNER_INDEX_PREFIX}{WORKER_WALLET.lower()}", NODE_ID)
+        await pipe.execute()
 
     print(f"✓ Registered GPU node: {NODE_ID}")
     print(f"  GPU: {WORKER_GPU_MODEL} ({WORKER_VRAM_GB}GB VRAM)")
@@ -217,13 +238,15 @@ async def heartbeat_loop(client: redis.Redis) -> None:
         try:
             await asyncio.sleep(30)  # Heartbeat every 30 seconds
 
-            # Update last_heartbeat timestamp
-            node_data = await client.hget(GPU_NODE_REGISTRY_KEY, NODE_ID)
-            if node_data:
-                node_record = json.loads(node_data)
-                node_record["last_heartbeat"] = utc_now_iso()
-                node_record["status"] = "available"
-                await client.hset(GPU_NODE_REGISTRY_KEY, NODE_ID, json.dumps(node_record))
+            # Only the liveness fields change; the rest of the record is left alone
+            updated = await update_node_fields(
+                client,
+                {"last_heartbeat": utc_now_iso(), "status": "available"},
+                heartbeat=True,
+            )
+            if not updated:
+                print(f"Node record {NODE_ID} is missing, registering again")
+                await register_gpu_node(client)
         except Exception as e:
             print(f"Heartbeat error: {e}")
 
@@ -297,11 +320,7 @@ async def worker() -> None:
     finally:
         # Mark node as unavailable before shutting down
         try:
-            node_data = await client.hget(GPU_NODE_REGISTRY_KEY, NODE_ID)
-            if node_data:
-                node_record = json.loads(node_data)
-                node_record["status"] = "offline"
-                await client.hset(GPU_NODE_REGISTRY_KEY, NODE_ID, json.dumps(node_record))
+            if await update_node_fields(client, {"status": "offline"}):
                 print(f"✓ Marked node {NODE_ID} as offline")
         except Exception:
             pass
@@ -113,10 +113,10 @@ aws ecr get-login-password --region ${AWS_REGION} | sudo docker login --username
 # Note: ECR repository should already exist (created during infrastructure setup)
 echo "Using ECR repository: ${SERVICE_NAME}"
 
-cd /home/ec2-user/build/backend/services/far_mesh_coordinator
+cd /home/ec2-user/build/backend
 
 echo "Building Far Mesh Coordinator (no cache)..."
-sudo docker build --no-cache -t ${SERVICE_NAME}:latest .
+sudo docker build --no-cache -f services/far_mesh_coordinator/Dockerfile -t ${SERVICE_NAME}:latest .
 sudo docker tag ${SERVICE_NAME}:latest ${ECR_REGISTRY}/${SERVICE_NAME}:latest
 
 echo "Pushing to ECR..."
@@ -32,10 +32,8 @@ echo "✓ ECR repository ready"
 echo ""
 
 echo "[3/5] Building Docker image..."
-cd backend/services/far_mesh_coordinator
-docker build -t "$SERVICE_NAME:latest" .
+docker build -f backend/services/far_mesh_coordinator/Dockerfile -t "$SERVICE_NAME:latest" backend
 docker tag "$SERVICE_NAME:latest" "$ECR_REGISTRY/$SERVICE_NAME:latest"
-cd ../../..
 echo "✓ Image built"
 echo ""
 
@@ -201,11 +201,11 @@ cd ../../..
 
 # Build and push api-gateway
 echo "Building API gateway..."
-cd backend/api-gateway
-docker build -t farlabs-api-gateway-free:latest .
+cd backend
+docker build -f api-gateway/Dockerfile -t farlabs-api-gateway-free:latest .  # from backend/ for common/
 docker tag farlabs-api-gateway-free:latest ${ECR_REGISTRY}/farlabs-api-gateway-free:latest
 docker push ${ECR_REGISTRY}/farlabs-api-gateway-free:latest
-cd ../..
+cd ..
 
 # Build and push payments
 echo "Building payments service..."